@@ -5,11 +5,30 @@ Main command-line interface for the application
 import argparse
 
 from RestlessFunnelBot import BOT_NAME, __description__, run
+from RestlessFunnelBot.models import Platform
 
 parser = argparse.ArgumentParser(prog=BOT_NAME, description=__description__)
-
-args = parser.parse_args()
+parser.add_argument(
+    "platforms",
+    nargs="*",
+    type=Platform,
+    metavar="platform",
+    help="platforms to run: "
+    + ", ".join(platform.value for platform in Platform)
+    + " (default: options.PLATFORMS)",
+)
+parser.add_argument(
+    "--processes",
+    action="store_true",
+    help="run every platform in its own process, with one process for the database",
+)
 
 
 if __name__ == "__main__":
-    run()
+    args = parser.parse_args()
+    if args.processes:
+        from RestlessFunnelBot.supervisor import supervise
+
+        supervise(args.platforms or None)
+    else:
+        run(args.platforms or None)
@@ -0,0 +1,308 @@
+"""
+Archive of the old messages
+---
+Messages older than options.RETENTION_DAYS are moved out of the message
+table into gzipped json lines files, one per chat and time range.
+Files are only ever added, never changed, and the segment table
+tells which messages of which chat are in which file.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from heapq import merge
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, cast
+
+import sqlalchemy
+from sqlalchemy import delete, func, tuple_
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.elements import ColumnElement
+from sqlmodel import select
+
+from . import database, options
+from .cache import LRUCache
+from .database import MEMORY_PATH, DataBase, make_db
+from .models import Chat, Message, Platform, Segment, col
+from .ttldict import Sweeper
+
+logger = logging.getLogger(__name__)
+
+# (timestamp, id), the order in which /list shows the messages
+MessageKey = Tuple[datetime, int]
+
+CACHE_TTL = 10 * 60
+# decompressed messages of the segments, by the ids of the segments
+segment_cache: LRUCache[int, List[Message]] = LRUCache(
+    CACHE_TTL, options.ARCHIVE_CACHE_SIZE
+)
+
+WORD = re.compile(r"\w+")
+# about 1% of the segments without the word are opened by the search
+FILTER_BITS_PER_WORD = 10
+FILTER_HASHES = 7
+
+
+def message_key(msg: Message) -> MessageKey:
+    return msg.timestamp, cast(int, msg.id)
+
+
+def archive_path() -> Path:
+    if options.ARCHIVE_PATH:
+        return Path(options.ARCHIVE_PATH)
+    # next to the sqlite database, wherever DATABASE_URL puts it
+    url = database.engine.url
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", MEMORY_PATH):
+        raise RuntimeError("options.ARCHIVE_PATH is needed for this database")
+    return Path(url.database).parent / "archive"
+
+
+def message_row(msg: Message) -> Dict[str, Any]:
+    return dict(
+        id=msg.id,
+        target_id=msg.target_id,
+        platform=msg.platform.value,
+        text=msg.text,
+        timestamp=msg.timestamp.isoformat(),
+        author_id=msg.author_id,
+        chat_id=msg.chat_id,
+    )
+
+
+def dump_rows(rows: List[Dict[str, Any]]) -> bytes:
+    lines = [json.dumps(row, ensure_ascii=False) + "\n" for row in rows]
+    return gzip.compress("".join(lines).encode())
+
+
+def load_messages(data: bytes) -> List[Message]:
+    messages = []
+    for line in gzip.decompress(data).decode().splitlines():
+        row = json.loads(line)
+        row["platform"] = Platform(row["platform"])
+        row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+        messages.append(Message(**row))
+    return messages
+
+
+def word_bits(word: str, size: int) -> List[int]:
+    # stable across the processes, unlike hash()
+    digest = hashlib.blake2b(word.encode(), digest_size=4 * FILTER_HASHES).digest()
+    return [
+        int.from_bytes(digest[i : i + 4], "little") % size
+        for i in range(0, len(digest), 4)
+    ]
+
+
+def word_filter(messages: List[Message]) -> bytes:
+    words = set()
+    for msg in messages:
+        words.update(WORD.findall(msg.text.lower()))
+    bits = bytearray(max(len(words) * FILTER_BITS_PER_WORD // 8, 8))
+    size = len(bits) * 8
+    for word in words:
+        for bit in word_bits(word, size):
+            bits[bit >> 3] |= 1 << (bit & 7)
+    return bytes(bits)
+
+
+def may_have_words(segment: Segment, words: List[str]) -> bool:
+    bits = segment.words
+    if not bits:
+        return True
+    size = len(bits) * 8
+    return all(
+        bits[bit >> 3] & 1 << (bit & 7)
+        for word in words
+        for bit in word_bits(word, size)
+    )
+
+
+def write_file(path: Path, data: bytes) -> None:
+    # written under another name first, so the file is either whole or absent
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(path.name + ".tmp")
+    with open(temporary, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def read_file(path: Path) -> List[Message]:
+    return load_messages(path.read_bytes())
+
+
+def segment_path(chat_id: int, first: Message, last: Message) -> str:
+    return f"{chat_id}/{first.timestamp:%Y%m%d%H%M%S}-{first.id}-{last.id}.jsonl.gz"
+
+
+async def archive_chat(
+    platform: Platform, chat_id: int, cutoff: datetime, segment_size: int
+) -> int:
+    selection = (
+        select(Message)
+        .filter(col(Message.chat_id) == chat_id, col(Message.timestamp) < cutoff)
+        .order_by(col(Message.timestamp), col(Message.id))
+        .limit(segment_size)
+    )
+    async with make_db(platform, readonly=True) as db:
+        messages = (await db.fetch(selection)).all()
+    if not messages:
+        return 0
+
+    # the file is written before the writer is taken, if the commit fails
+    # the file is not in the index and the messages are archived again
+    first, last = messages[0], messages[-1]
+    path = segment_path(chat_id, first, last)
+    rows = [message_row(msg) for msg in messages]
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, dump_rows, rows)
+    words = await loop.run_in_executor(None, word_filter, messages)
+    await loop.run_in_executor(None, write_file, archive_path() / path, data)
+
+    async with make_db(platform) as db:
+        db.add(
+            Segment(
+                chat_id=chat_id,
+                first_timestamp=first.timestamp,
+                first_id=first.id,
+                last_timestamp=last.timestamp,
+                last_id=last.id,
+                count=len(messages),
+                path=path,
+                words=words,
+            )
+        )
+        ids = [msg.id for msg in messages]
+        await db.execute(delete(Message).filter(col(Message.id).in_(ids)))
+    return len(messages)
+
+
+async def compact(cutoff: datetime, segment_size: int = 0) -> int:
+    """
+    Moves the messages older than the cutoff to the archive,
+    returns how many were moved.
+    """
+
+    segment_size = segment_size or options.ARCHIVE_SEGMENT_SIZE
+    old_chats = select(Message.chat_id).filter(col(Message.timestamp) < cutoff)
+    moved = 0
+    for platform in Platform:
+        selection = select(Chat.id).filter(
+            col(Chat.platform) == platform, col(Chat.id).in_(old_chats)
+        )
+        async with make_db(platform, readonly=True) as db:
+            chat_ids = (await db.fetch(selection)).all()
+
+        for chat_id in chat_ids:
+            while True:
+                count = await archive_chat(platform, chat_id, cutoff, segment_size)
+                moved += count
+                if count < segment_size:
+                    break
+    return moved
+
+
+async def compact_old() -> None:
+    if options.RETENTION_DAYS <= 0:
+        return
+    cutoff = datetime.utcnow() - timedelta(days=options.RETENTION_DAYS)
+    moved = await compact(cutoff)
+    if moved:
+        logger.info("Archived %d messages older than %s", moved, cutoff)
+
+
+retention = Sweeper(options.RETENTION_INTERVAL, compact_old)
+
+
+async def load_segment(segment: Segment, cache: bool = True) -> List[Message]:
+    id = cast(int, segment.id)
+    messages = segment_cache.get(id) if cache else None
+    if messages is None:
+        path = archive_path() / segment.path
+        loop = asyncio.get_running_loop()
+        messages = await loop.run_in_executor(None, read_file, path)
+        if cache:
+            segment_cache.set(id, messages)
+    return messages
+
+
+async def read_after(
+    db: DataBase, chat_ids: Select, after: Optional[MessageKey], limit: int
+) -> List[Message]:
+    """
+    Up to `limit` archived messages of the chats that go after the key,
+    in the order of (timestamp, id).
+    """
+
+    selection = select(Segment).filter(col(Segment.chat_id).in_(chat_ids))
+    if after is not None:
+        # the values have different types, the comparison takes them as Any
+        key: Tuple[Any, ...] = after
+        last: ColumnElement = tuple_(col(Segment.last_timestamp), col(Segment.last_id))
+        selection = selection.filter(last > tuple_(*key))
+    selection = selection.order_by(
+        col(Segment.first_timestamp), col(Segment.first_id)
+    )
+
+    result: List[Message] = []
+    for segment in (await db.fetch(selection)).all():
+        # segments go by their first messages, so the rest can't get in
+        first = (segment.first_timestamp, segment.first_id)
+        if len(result) >= limit and message_key(result[limit - 1]) < first:
+            break
+        messages: Sequence[Message] = await load_segment(segment)
+        if after is not None:
+            messages = [msg for msg in messages if message_key(msg) > after]
+        result = list(merge(result, messages, key=message_key))[:limit]
+    return result
+
+
+def has_words(words: List[str], text: str) -> bool:
+    found = set(WORD.findall(text.lower()))
+    return all(word in found for word in words)
+
+
+async def search_archive(
+    db: DataBase, chat_ids: Select, query: str, offset: int, limit: int
+) -> List[Message]:
+    """
+    Archived messages of the chats that contain all of the words
+    of the query, the newest segments go first.
+    Only the segments that may have the words are opened.
+    """
+
+    words = WORD.findall(query.lower())
+    if not words:
+        return []
+
+    selection = (
+        select(Segment)
+        .filter(col(Segment.chat_id).in_(chat_ids))
+        .order_by(col(Segment.last_timestamp).desc(), col(Segment.last_id).desc())
+    )
+    found: List[Message] = []
+    for segment in (await db.fetch(selection)).all():
+        if not may_have_words(segment, words):
+            continue
+        for msg in reversed(await load_segment(segment)):
+            if not has_words(words, msg.text):
+                continue
+            if offset:
+                offset -= 1
+                continue
+            found.append(msg)
+            if len(found) == limit:
+                return found
+    return found
+
+
+async def count_archived(db: DataBase, chat_ids: Select) -> int:
+    total = func.coalesce(func.sum(col(Segment.count)), 0)
+    selection = sqlalchemy.select(total).filter(col(Segment.chat_id).in_(chat_ids))
+    return (await db.execute(selection)).scalar_one()
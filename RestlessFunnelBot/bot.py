@@ -1,44 +1,279 @@
+import asyncio
+import os
 import re
-from typing import Any, Awaitable, Callable, Dict, Optional, Type, TypeVar
+from pathlib import Path
+from typing import (
+    Any,
+    AsyncContextManager,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Type,
+    TypeVar,
+)
 
-from .database import DataBase
-from .models import Message
+from . import options
+from .database import DataBase, make_db
+from .metrics import COMMANDS
+from .models import Message, Platform
+from .outbox import Outbox, RateLimit
+from .profiling import rename as rename_profile
 
 T = TypeVar("T", bound=Any)
 SendFunc = Callable[[T, str, bool, bool], Awaitable[None]]
 MapToFunc = Dict[Type[T], SendFunc]
+# sends the file from the path as an attachment with the name
+FileFunc = Callable[[T, Path, str], Awaitable[None]]
 
-CommandHandler = Callable[["Bot", str], Awaitable[None]]
+CommandHandler = Callable[["Context", str], Awaitable[None]]
 CommandMap = Dict[str, CommandHandler]
 
 
 COMMAND_REGEXP = r"(?:/(\S+))? *(.*)"
 DEFAULT_COMMAND = chr(1).join("$default$")
+DEFAULT_MAX_LENGTH = 2000
 
 
-class Bot:
+def split_text(text: str, limit: int) -> List[str]:
+    """
+    Splits the text into parts that are not longer than the limit,
+    line breaks are preferred as split points.
+    """
+
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            parts.append(text[:limit])
+            text = text[limit:]
+        else:
+            parts.append(text[:cut])
+            text = text[cut + 1 :]
+    parts.append(text)
+    return parts
+
+
+def remove_file(path: Path) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # it was handed over to someone else
+        pass
+
+
+class TextChunks:
+    """
+    Joins lines into chunks that are not longer than the limit.
+    """
+
+    __slots__ = "limit", "lines", "length"
+
+    limit: int
+    lines: List[str]
+    length: int
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.lines = []
+        self.length = 0
+
+    def add(self, line: str) -> List[str]:
+        ready = []
+        if self.lines and self.length + 1 + len(line) > self.limit:
+            ready = self.finish()
+
+        self.lines.append(line)
+        self.length += len(line) + (1 if len(self.lines) > 1 else 0)
+        if self.length > self.limit:
+            ready.extend(self.finish())
+        return ready
+
+    def finish(self) -> List[str]:
+        if not self.lines:
+            return []
+        text = "\n".join(self.lines)
+        self.lines = []
+        self.length = 0
+        return split_text(text, self.limit)
+
+
+class Context:
+    """
+    State of a single command
+    ---
+    Every message gets its own context,
+    so commands can be handled concurrently.
+    """
+
+    __slots__ = "bot", "db", "msg", "target_message", "_pending", "_mention"
+
+    bot: "Bot"
     db: DataBase
     msg: Message
     target_message: Any
+    # texts that are joined into one message before sending
+    _pending: TextChunks
+    _mention: bool
+
+    def __init__(
+        self, bot: "Bot", db: DataBase, msg: Message, target_message: Any
+    ) -> None:
+        self.bot = bot
+        self.db = db
+        self.msg = msg
+        self.target_message = target_message
+        self._pending = TextChunks(self.max_length)
+        self._mention = False
+
+    @property
+    def max_length(self) -> int:
+        return self.bot.max_lengths[type(self.target_message)]
+
+    @property
+    def max_file_size(self) -> int:
+        # 0 if the platform can't send files
+        return self.bot.max_file_sizes.get(type(self.target_message), 0)
+
+    async def send(self, text: str, mention: bool = False, raw: bool = False) -> None:
+        """
+        Replies to the message.
+        ---
+        Consecutive texts are joined into as few messages as possible,
+        they are queued by flush() or by the next raw text.
+        """
+
+        if raw or mention != self._mention:
+            await self.flush()
+        if raw:
+            await self._put(text, mention, raw)
+            return
+
+        self._mention = mention
+        for part in self._pending.add(text):
+            await self._put(part, mention, raw)
+
+    async def flush(self) -> None:
+        for part in self._pending.finish():
+            await self._put(part, self._mention, False)
+
+    async def send_file(self, path: Path, name: str) -> None:
+        """
+        Replies with the file as an attachment, after the texts sent before.
+        The file is removed once it is sent.
+        """
+
+        await self.flush()
+        await self.bot.put_file(self.msg.chat_id, self.target_message, path, name)
+
+    async def _put(self, text: str, mention: bool, raw: bool) -> None:
+        msg = self.target_message
+        send = self.bot.send_functions[type(msg)]
+        await self.bot.outbox.put(self.msg.chat_id, send, msg, text, mention, raw)
+
+    def read_db(self) -> AsyncContextManager[DataBase]:
+        # a separate read-only session that does not hold the writer
+        return make_db(self.db.platform, readonly=True)
+
+
+class Bot:
     command_pattern: re.Pattern
+    max_commands: int
+    outbox: Outbox
+    _semaphore: Optional[asyncio.Semaphore]
+    _loop: Optional[asyncio.AbstractEventLoop]
 
-    def __init__(self) -> None:
-        self.target_message = None
+    def __init__(self, max_commands: int = options.MAX_CONCURRENT_COMMANDS) -> None:
         self.command_pattern = re.compile(COMMAND_REGEXP)
         self.default_handler = None
+        self.max_commands = max_commands
+        self._semaphore = None
+        self._loop = None
+        self.outbox = Outbox(
+            options.OUTBOX_WORKERS,
+            options.OUTBOX_QUEUE_SIZE,
+            options.SEND_RETRIES,
+            options.SEND_BACKOFF,
+        )
 
     send_functions: MapToFunc = {}
+    max_lengths: Dict[Type[Any], int] = {}
+    file_functions: Dict[Type[Any], FileFunc] = {}
+    max_file_sizes: Dict[Type[Any], int] = {}
+
+    def send_function(
+        self,
+        type: Type[Any],
+        platform: Platform,
+        max_length: int = DEFAULT_MAX_LENGTH,
+        rate_limit: Optional[RateLimit] = None,
+        chat_rate_limit: Optional[RateLimit] = None,
+    ) -> Callable[[SendFunc], SendFunc]:
+        """
+        Registers the function that sends messages of the platform
+        which messages have this type, the platform labels their metrics,
+        max_length is the longest text that the platform accepts,
+        rate limits are for the whole platform and for a single chat.
+        The function raises outbox.RetryAfter when asked to slow down.
+        """
 
-    def send_function(self, type: Type[Any]) -> Callable[[SendFunc], SendFunc]:
         def inner(f: SendFunc) -> SendFunc:
             self.send_functions[type] = f
+            self.max_lengths[type] = max_length
+            self.outbox.limit(type, platform.value, rate_limit, chat_rate_limit)
             return f
 
         return inner
 
-    async def send(self, text: str, mention: bool = False, raw: bool = False) -> None:
-        msg = self.target_message
-        await self.send_functions[type(msg)](msg, text, mention, raw)
+    def file_function(
+        self, type: Type[Any], max_size: int
+    ) -> Callable[[FileFunc], FileFunc]:
+        """
+        Registers the function that sends files of the platform as attachments,
+        max_size is the largest file in bytes that the platform accepts.
+        The function raises outbox.RetryAfter when asked to slow down.
+        """
+
+        def inner(f: FileFunc) -> FileFunc:
+            self.file_functions[type] = f
+            self.max_file_sizes[type] = max_size
+            return f
+
+        return inner
+
+    async def put_file(
+        self, chat: Hashable, target: Any, path: Path, name: str
+    ) -> None:
+        """
+        Queues the file, it is sent later in reply to the target
+        and removed after that.
+        """
+
+        send_file = self.file_functions[type(target)]
+
+        async def send(target: Any, text: str, mention: bool, raw: bool) -> None:
+            await send_file(target, path, name)
+            remove_file(path)
+
+        # also when the outbox runs out of retries
+        await self.outbox.put(
+            chat, send, target, name, on_give_up=lambda: remove_file(path)
+        )
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        """
+        Limits how many commands are handled at once.
+        """
+
+        # created for each loop, a semaphore can't be shared between them
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_commands)
+            self._loop = loop
+        return self._semaphore
 
     commands: CommandMap = {}
     default_handler: Optional[CommandHandler]
@@ -54,10 +289,6 @@ class Bot:
         return inner
 
     async def handle_message(self, db: DataBase, in_msg: Any, msg: Message) -> None:
-        self.target_message = in_msg
-        self.db = db
-        self.msg = msg
-
         match = self.command_pattern.match(msg.text)
 
         if match is None:
@@ -65,10 +296,19 @@ class Bot:
             func = self.default_handler
         else:
             command, text = match.groups()
-            func = self.commands.get(command, self.default_handler)
+            func = self.commands.get(command)
+            if func is None:
+                func = self.default_handler
+            else:
+                COMMANDS.inc(command)
+                rename_profile(f"/{command}")
 
         if func is not None:
-            await func(self, text)
+            ctx = Context(self, db, msg, in_msg)
+            try:
+                await func(ctx, text)
+            finally:
+                await ctx.flush()
 
 
 bot = Bot()
@@ -0,0 +1,140 @@
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+from .models import Platform
+from .ttldict import TTLDict
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Bounded cache on top of TTLDict.
+    ---
+    Entries live for at most `ttl` seconds,
+    and when there are more than `max_size` of them
+    the least recently used one is evicted.
+    """
+
+    __slots__ = "data", "max_size", "hits", "misses"
+
+    data: TTLDict[K, V]
+    max_size: int
+    hits: int
+    misses: int
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.data = TTLDict(ttl)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key: K) -> Optional[V]:
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # move the entry to the end, keeping its expiration time
+        dict.__setitem__(self.data, key, dict.pop(self.data, key))
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.max_size:
+            self.data.pop(next(iter(self.data)))
+
+    def pop(self, key: K) -> Optional[V]:
+        return self.data.pop(key, None)
+
+    def pop_if(self, predicate: Callable[[K, V], bool]) -> None:
+        keys = [
+            key
+            for key, value in dict.items(self.data)
+            if predicate(key, value.value)  # type: ignore[attr-defined]
+        ]
+        for key in keys:
+            self.data.pop(key)
+
+    def expire(self) -> None:
+        self.data.expire()
+
+    def clear(self) -> None:
+        self.data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return dict(size=len(self), hits=self.hits, misses=self.misses)
+
+
+PlatformKey = Tuple[Platform, int]
+ChatEntry = Tuple[int, str]
+UserEntry = Tuple[int, int]
+MembershipKey = Tuple[int, int, int]
+
+
+class IdentityCache:
+    """
+    Maps platform ids of chats and users to their database ids,
+    so that the known senders do not need to be looked up in the database.
+    """
+
+    chats: LRUCache[PlatformKey, ChatEntry]
+    users: LRUCache[PlatformKey, UserEntry]
+    memberships: LRUCache[MembershipKey, bool]
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.chats = LRUCache(ttl, max_size)
+        self.users = LRUCache(ttl, max_size)
+        self.memberships = LRUCache(ttl, max_size)
+
+    def get_chat_id(self, platform: Platform, fields: Dict[str, Any]) -> Optional[int]:
+        entry = self.chats.get((platform, fields["target_id"]))
+        if entry is None:
+            return None
+        id, name = entry
+        if name != fields.get("name"):
+            # chat was renamed, it has to be updated in the database
+            return None
+        return id
+
+    def set_chat(self, platform: Platform, fields: Dict[str, Any], id: int) -> None:
+        self.chats.set((platform, fields["target_id"]), (id, fields["name"]))
+
+    def get_user(self, platform: Platform, target_id: int) -> Optional[UserEntry]:
+        return self.users.get((platform, target_id))
+
+    def set_user(
+        self, platform: Platform, target_id: int, id: int, connection_id: int
+    ) -> None:
+        self.users.set((platform, target_id), (id, connection_id))
+
+    def has_membership(self, user_id: int, connection_id: int, chat_id: int) -> bool:
+        return self.memberships.get((user_id, connection_id, chat_id)) is not None
+
+    def add_membership(self, user_id: int, connection_id: int, chat_id: int) -> None:
+        self.memberships.set((user_id, connection_id, chat_id), True)
+
+    def forget_connection(self, connection_id: int) -> None:
+        self.users.pop_if(lambda key, value: value[1] == connection_id)
+        self.memberships.pop_if(lambda key, value: key[1] == connection_id)
+
+    def expire(self) -> None:
+        self.chats.expire()
+        self.users.expire()
+        self.memberships.expire()
+
+    def clear(self) -> None:
+        self.chats.clear()
+        self.users.clear()
+        self.memberships.clear()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return dict(
+            chats=self.chats.stats(),
+            users=self.users.stats(),
+            memberships=self.memberships.stats(),
+        )
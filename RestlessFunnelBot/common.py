@@ -1,23 +1,66 @@
-from typing import Any, Set, cast
+from datetime import datetime
+from heapq import merge
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    cast,
+)
+import logging
+import os
 import secrets
 import string
+import tempfile
+from time import perf_counter
+from pathlib import Path
 
+import sqlalchemy
+from sqlalchemy import and_, delete, func, literal, tuple_, update
+from sqlalchemy.engine import CursorResult
+from sqlalchemy.sql import Select
+from sqlmodel import select
+
+from . import archive, export, options
 from .__metadata__ import BOT_NAME
-from .bot import DEFAULT_COMMAND, Bot, bot
+from .bot import DEFAULT_COMMAND, Context, TextChunks, bot
+from .cache import IdentityCache, PlatformKey
 from .database import DataBase, make_db
+from .ingest import BatchQueue, KeyedLock, TaskSet
 from .mappers import map_model
-from .models import Chat, ConnectedUser, Message, Platform, User, col, to_moscow_tz
-from .ttldict import TTLDict
+from .metrics import DISPATCH_WAIT, MESSAGES, Gauge, stage
+from .profiling import profile
+from .search import search_messages
+from .models import (
+    Chat,
+    ConnectedUser,
+    ConnectionChat,
+    Message,
+    Platform,
+    ReadCursor,
+    User,
+    UserChat,
+    col,
+    to_moscow_tz,
+)
+from .ttldict import Sweeper, TTLDict
+
+logger = logging.getLogger(__name__)
 
 
 @bot.command("start", "help")
-async def greet(bot: Bot, text: str) -> None:
-    await bot.send(
+async def greet(ctx: Context, text: str) -> None:
+    await ctx.send(
         f"Hi, I'm {BOT_NAME}!\n"
         "I listen to others, and then I retell everything to you 🤗\n"
     )
-    await commands(bot, text)
-    await bot.send(
+    await commands(ctx, text)
+    await ctx.send(
         "If you want me to listen to some chat, "
         "add me there, give me required permissions "
         "and send one message there"
@@ -25,18 +68,18 @@ async def greet(bot: Bot, text: str) -> None:
 
 
 @bot.command("commands")
-async def commands(bot: Bot, text: str) -> None:
-    await bot.send(
+async def commands(ctx: Context, text: str) -> None:
+    await ctx.send(
         "Here are my commands:\n"
         + "\n".join(
-            "- /" + com for com in bot.commands.keys() if com != DEFAULT_COMMAND
+            "- /" + com for com in ctx.bot.commands.keys() if com != DEFAULT_COMMAND
         )
     )
 
 
 @bot.command(DEFAULT_COMMAND)
-async def default_response(bot: Bot, text: str) -> None:
-    await bot.send(
+async def default_response(ctx: Context, text: str) -> None:
+    await ctx.send(
         "Sorry, I don't understand you, can you repeat again, please?\n"
         "If you are lost check out /help command!"
     )
@@ -45,36 +88,339 @@ async def default_response(bot: Bot, text: str) -> None:
 TIME_FORMAT = "%d %B %Y - %H:%M:%S (%Z)"
 
 
+LIST_PAGE_SIZE = 50
+LIST_TTL = 10 * 60
+NEXT_PAGE = "next"
+# (timestamp, id) of the last shown message and the number of shown messages
+ListCursor = Tuple[datetime, int, int]
+list_cursors: TTLDict[int, ListCursor] = TTLDict(LIST_TTL)
+
+
+def accessible_chat_ids(connection_id: int) -> Select:
+    return select(ConnectionChat.chat_id).filter_by(connection_id=connection_id)
+
+
+def format_message(number: int, msg: Message) -> str:
+    date = to_moscow_tz(msg.timestamp).strftime(TIME_FORMAT)
+    return f"{number}) {date}:\n{msg.text}\n"
+
+
 @bot.command("list")
-async def all_messages(bot: Bot, text: str) -> None:
-    messages = []
-    criteria = col(Message.chat_id).in_(bot.msg.author.connection.chats)
-    for i, msg in enumerate(await bot.db.read_all(Message, criteria)):
-        date = to_moscow_tz(msg.timestamp).strftime(TIME_FORMAT)
-        messages.append(f"{i+1}) {date}:\n{msg.text}\n")
-    await bot.send("List of all messages\n" + "\n".join(messages))
+async def all_messages(ctx: Context, text: str) -> None:
+    connection_id = ctx.msg.author.connection_id
+    text = text.strip(" ")
+
+    accessible = accessible_chat_ids(connection_id)
+    selection = select(Message).filter(col(Message.chat_id).in_(accessible))
+    after: Optional[archive.MessageKey] = None
+    if text == NEXT_PAGE:
+        cursor = list_cursors.get(connection_id)
+        if cursor is None:
+            await ctx.send("There is nothing to continue, use /list first")
+            return
+        timestamp, id, shown = cursor
+        after = timestamp, id
+        # the values have different types, the comparison takes them as Any
+        key: Tuple[Any, ...] = after
+        selection = selection.filter(
+            tuple_(col(Message.timestamp), col(Message.id)) > tuple_(*key)
+        )
+    else:
+        shown = 0
+
+    selection = selection.order_by(col(Message.timestamp), col(Message.id))
+    # one more message tells if there is a next page
+    selection = selection.limit(LIST_PAGE_SIZE + 1)
+
+    async with ctx.read_db() as db:
+        messages = (await db.fetch(selection)).all()
+        # the oldest messages may be in the archive
+        archived = await archive.read_after(db, accessible, after, LIST_PAGE_SIZE + 1)
+    if archived:
+        messages = list(merge(archived, messages, key=archive.message_key))
+    has_more = len(messages) > LIST_PAGE_SIZE
+
+    chunks = TextChunks(ctx.max_length)
+    if shown == 0:
+        chunks.add("List of all messages")
+
+    last: Optional[Message] = None
+    for msg in messages[:LIST_PAGE_SIZE]:
+        shown += 1
+        last = msg
+        for chunk in chunks.add(format_message(shown, msg)):
+            await ctx.send(chunk)
+
+    if last is None:
+        list_cursors.pop(connection_id, None)
+        await ctx.send("There are no more messages" if shown else "There are no messages")
+        return
+
+    for chunk in chunks.finish():
+        await ctx.send(chunk)
+    if has_more:
+        list_cursors[connection_id] = last.timestamp, cast(int, last.id), shown
+        await ctx.send(f"/list {NEXT_PAGE}", raw=True)
+    else:
+        list_cursors.pop(connection_id, None)
+
+
+def unread_messages(connection_id: int, limit: int) -> Select:
+    # starts from the chats, so every chat is a range scan of its new ids,
+    # the rest of the history is never touched
+    cursor = and_(
+        col(ReadCursor.connection_id) == connection_id,
+        col(ReadCursor.chat_id) == col(ConnectionChat.chat_id),
+    )
+    unread = and_(
+        col(Message.chat_id) == col(ConnectionChat.chat_id),
+        col(Message.id) > func.coalesce(col(ReadCursor.last_id), 0),
+    )
+    return (
+        select(Message)
+        .select_from(ConnectionChat)
+        .outerjoin(ReadCursor, cursor)
+        .join(Message, unread)
+        .filter(col(ConnectionChat.connection_id) == connection_id)
+        .order_by(col(Message.id))
+        .limit(limit)
+    )
+
+
+@bot.command("new")
+async def new_messages(ctx: Context, text: str) -> None:
+    connection_id = ctx.msg.author.connection_id
+
+    # one more message tells if there are more of them
+    selection = unread_messages(connection_id, LIST_PAGE_SIZE + 1)
+    messages = (await ctx.db.fetch(selection)).all()
+    if not messages:
+        await ctx.send("There are no new messages")
+        return
+    has_more = len(messages) > LIST_PAGE_SIZE
+    messages = messages[:LIST_PAGE_SIZE]
+
+    # messages go by ids, so the last one of each chat is the furthest read
+    last_ids = {msg.chat_id: cast(int, msg.id) for msg in messages}
+    await ctx.db.insert_or_raise(
+        ReadCursor,
+        [
+            dict(connection_id=connection_id, chat_id=chat_id, last_id=last_id)
+            for chat_id, last_id in last_ids.items()
+        ],
+        "last_id",
+    )
+
+    chunks = TextChunks(ctx.max_length)
+    chunks.add("New messages")
+    for i, msg in enumerate(messages):
+        for chunk in chunks.add(format_message(i + 1, msg)):
+            await ctx.send(chunk)
+    for chunk in chunks.finish():
+        await ctx.send(chunk)
+    if has_more:
+        await ctx.send("/new", raw=True)
 
 
 CHAT_SEP = "/"
 
 
 @bot.command("chats")
-async def accessible_chats(bot: Bot, text: str) -> None:
-    criteria = col(Chat.id).in_(bot.msg.author.connection.chats)
-    chats = await bot.db.read_all(Chat, criteria)
+async def accessible_chats(ctx: Context, text: str) -> None:
+    selection = select(Chat).join(
+        ConnectionChat, col(ConnectionChat.chat_id) == col(Chat.id)
+    )
+    selection = selection.filter_by(connection_id=ctx.msg.author.connection_id)
+    async with ctx.read_db() as db:
+        chats = (await db.fetch(selection)).all()
     names = [f"{i+1} {chat.represent_name(CHAT_SEP)}" for i, chat in enumerate(chats)]
-    await bot.send("List of accessible chats\n" + "\n".join(names))
+    await ctx.send("List of accessible chats\n" + "\n".join(names))
+
+
+STATS_TOP_AUTHORS = 5
+
+
+def format_time(timestamp: Optional[datetime]) -> str:
+    if timestamp is None:
+        return "-"
+    return to_moscow_tz(timestamp).strftime(TIME_FORMAT)
+
+
+@bot.command("stats")
+async def statistics(ctx: Context, text: str) -> None:
+    # everything is counted by the database, messages are never loaded
+    accessible = col(Message.chat_id).in_(
+        accessible_chat_ids(ctx.msg.author.connection_id)
+    )
+    async with ctx.read_db() as db:
+        total = await db.count(Message, accessible)
+        archived = await archive.count_archived(
+            db, accessible_chat_ids(ctx.msg.author.connection_id)
+        )
+        first, last = await db.min_max(Message, Message.timestamp, accessible)
+        per_chat = await db.count_by(Message, Message.chat_id, accessible)
+        per_author = await db.count_by(
+            Message, Message.author_id, accessible, limit=STATS_TOP_AUTHORS
+        )
+
+        chat_ids = [id for id, _ in per_chat]
+        chats = {
+            chat.id: chat
+            for chat in await db.read_all(Chat, col(Chat.id).in_(chat_ids))
+        }
+        author_ids = [id for id, _ in per_author]
+        authors = {
+            user.id: user
+            for user in await db.read_all(User, col(User.id).in_(author_ids))
+        }
+
+    lines = [
+        "Statistics of accessible chats",
+        f"Messages: {total}",
+        f"First message: {format_time(first)}",
+        f"Last message: {format_time(last)}",
+    ]
+    if archived:
+        # only the messages in the database are counted below
+        lines.insert(2, f"Archived messages: {archived}")
+    lines.extend(["", "Messages per chat:"])
+    lines.extend(
+        f"{i+1} {chats[id].represent_name(CHAT_SEP)} - {amount}"
+        for i, (id, amount) in enumerate(per_chat)
+    )
+    lines.extend(["", "Most active authors:"])
+    lines.extend(
+        f"{i+1} {authors[id].platform.value} {authors[id].target_id} - {amount}"
+        for i, (id, amount) in enumerate(per_author)
+    )
+    await ctx.send("\n".join(lines))
+
+
+SEARCH_PAGE_SIZE = 10
+SEARCH_TTL = 10 * 60
+# query, number of shown results and the number of the results
+# in the database once they all were shown, then the archive is searched
+SearchCursor = Tuple[str, int, Optional[int]]
+search_pages: TTLDict[int, SearchCursor] = TTLDict(SEARCH_TTL)
+
+
+@bot.command("search")
+async def search(ctx: Context, text: str) -> None:
+    text = text.strip(" ")
+    connection_id = ctx.msg.author.connection_id
+
+    found: Optional[int]
+    if text == NEXT_PAGE:
+        query, offset, found = search_pages.get(connection_id, ("", 0, None))
+        if not query:
+            await ctx.send("There is no search to continue, start a new one")
+            return
+    elif text:
+        query, offset, found = text, 0, None
+    else:
+        await ctx.send("Tell me what to search for")
+        await ctx.send("/search <words>", raw=True)
+        return
+
+    chat_ids = accessible_chat_ids(connection_id)
+    accessible = col(Message.chat_id).in_(chat_ids)
+    messages: List[Message] = []
+    async with ctx.read_db() as db:
+        if found is None:
+            selection = search_messages(db.dialect, query, accessible)
+            selection = selection.offset(offset).limit(SEARCH_PAGE_SIZE)
+            messages = list((await db.fetch(selection)).all())
+            if len(messages) < SEARCH_PAGE_SIZE:
+                found = offset + len(messages)
+        if found is not None and len(messages) < SEARCH_PAGE_SIZE:
+            messages += await archive.search_archive(
+                db,
+                chat_ids,
+                query,
+                offset + len(messages) - found,
+                SEARCH_PAGE_SIZE - len(messages),
+            )
+
+    if not messages:
+        search_pages.pop(connection_id, None)
+        await ctx.send("Nothing more was found" if offset else "Nothing was found")
+        return
+
+    search_pages[connection_id] = query, offset + len(messages), found
+    results = [format_message(offset + i + 1, msg) for i, msg in enumerate(messages)]
+    await ctx.send(f"Search results for '{query}'\n" + "\n".join(results))
+    if len(messages) == SEARCH_PAGE_SIZE:
+        await ctx.send(f"/search {NEXT_PAGE}", raw=True)
+
+
+EXPORT_USAGE = "/export [jsonl|csv][.gz] [YYYY-MM-DD..YYYY-MM-DD]"
+MEGABYTE = 1024 * 1024
+
+
+@bot.command("export")
+async def export_messages(ctx: Context, text: str) -> None:
+    if not ctx.max_file_size:
+        await ctx.send("Sorry, I can't send files here")
+        return
+
+    format, compress = export.FORMATS[0], False
+    time_range: export.TimeRange = None, None
+    for word in text.split():
+        parsed_format = export.parse_format(word)
+        parsed_range = export.parse_range(word)
+        if parsed_format is not None:
+            format, compress = parsed_format
+        elif parsed_range is not None:
+            time_range = parsed_range
+        else:
+            await ctx.send(f"I don't understand '{word}', here's how to export")
+            await ctx.send(EXPORT_USAGE, raw=True)
+            return
+
+    await ctx.send("Exporting the messages, it may take a while")
+    await ctx.flush()
+
+    suffix = f".{format}" + (export.COMPRESSED if compress else "")
+    descriptor, name = tempfile.mkstemp(suffix=suffix)
+    os.close(descriptor)
+    path = Path(name)
+    try:
+        chat_ids = accessible_chat_ids(ctx.msg.author.connection_id)
+        async with ctx.read_db() as db:
+            written = await export.export(
+                db, chat_ids, path, format, compress, time_range, CHAT_SEP
+            )
+        size = path.stat().st_size
+    except BaseException:
+        path.unlink()
+        raise
+
+    if not written:
+        path.unlink()
+        await ctx.send("There are no messages to export")
+        return
+    if size > ctx.max_file_size:
+        path.unlink()
+        await ctx.send(
+            f"The export takes {size / MEGABYTE:.1f} MB, I can send only "
+            f"{ctx.max_file_size / MEGABYTE:.0f} MB here, "
+            "try a shorter range or a compressed format"
+        )
+        return
+
+    await ctx.send(f"Exported {written} messages")
+    await ctx.send_file(path, f"{BOT_NAME}-export{suffix}")
 
 
 AUTH_TTL = 60
-EXPIRE_COUNT = 128
-auth_ids: TTLDict[int, bool] = TTLDict(AUTH_TTL, EXPIRE_COUNT)
-auth_keys: TTLDict[str, int] = TTLDict(AUTH_TTL, EXPIRE_COUNT)
+auth_ids: TTLDict[int, bool] = TTLDict(AUTH_TTL)
+auth_keys: TTLDict[str, int] = TTLDict(AUTH_TTL)
 
 
 def expire_auth():
     for id in auth_keys.expire():
-        auth_ids.pop(id)
+        # might have expired on its own during the previous sweep
+        auth_ids.pop(id, None)
     auth_ids.expire()
 
 
@@ -84,19 +430,22 @@ def set_auth_key(id: int, key: str) -> str:
     return key
 
 
-async def actually_link(bot: Bot, other_user_id: int) -> None:
-    other = await bot.db.read_one(User, id=other_user_id)
-    if other.connection_id == bot.msg.author.connection_id:
+async def actually_link(ctx: Context, other_user_id: int) -> None:
+    connection_id = ctx.msg.author.connection_id
+    selection = select(User.connection_id).filter_by(id=other_user_id)
+    other_id = (await ctx.db.execute(selection)).scalar_one()
+    if other_id == connection_id:
         return
-    other_connection = await bot.db.read_one(ConnectedUser, id=other.connection_id)
 
-    all_others = await bot.db.read_all(User, connection_id=other.connection_id)
-    for user in all_others:
-        user.connection_id = bot.msg.author.connection_id
-        user.connection = bot.msg.author.connection
-
-    bot.msg.author.connection.add_chats_from(other_connection)
-    await bot.db.delete(other_connection)
+    # the same number of statements however many users and chats there are
+    moved = update(User).filter_by(connection_id=other_id)
+    await ctx.db.execute(moved.values(connection_id=connection_id))
+    await add_chats_from(ctx.db, connection_id, other_id)
+    await add_cursors_from(ctx.db, connection_id, other_id)
+    await delete_connection(ctx.db, other_id)
+    # still in the transaction, so the ingestor can't cache the old rows again
+    identity_cache.forget_connection(connection_id)
+    identity_cache.forget_connection(other_id)
 
 
 KEY_ALPHABET = string.digits * 10 + string.ascii_letters * 7 + "!?$%^&.,_~@:;/\\=" * 4
@@ -108,27 +457,27 @@ def generate_auth_key(length: int = 42) -> str:
 
 
 @bot.command("link")
-async def link(bot: Bot, text: str) -> None:
+async def link(ctx: Context, text: str) -> None:
     text = text.strip(" ")
-    user_id = cast(int, bot.msg.author.id)
+    user_id = cast(int, ctx.msg.author.id)
 
     if text:
         other_user_id = auth_keys.get(text)
         if other_user_id is None:
-            await bot.send("This secret code is outdated or invalid :(")
+            await ctx.send("This secret code is outdated or invalid :(")
         elif other_user_id == user_id:
-            await bot.send("You can't link to the same account")
+            await ctx.send("You can't link to the same account")
         else:
             del auth_ids[other_user_id]
             del auth_keys[text]
-            await actually_link(bot, other_user_id)
-            await bot.send("Successfully linked!")
+            await actually_link(ctx, other_user_id)
+            await ctx.send("Successfully linked!")
     else:
         if auth_ids.get(user_id):
-            await bot.send("You have already generated a secret code")
+            await ctx.send("You have already generated a secret code")
         else:
             key = set_auth_key(user_id, generate_auth_key())
-            await bot.send(
+            await ctx.send(
                 "With this command you link your account to another account\n"
                 "\n"
                 f"I created a temporary a secret code for you\n"
@@ -136,63 +485,117 @@ async def link(bot: Bot, text: str) -> None:
                 "\n"
                 "To use it log into another account and send this message:"
             )
-            await bot.send(f"/link {key}", raw=True)
+            await ctx.send(f"/link {key}", raw=True)
+
+
+async def actually_unlink(ctx: Context, left_ids: Set[int]) -> None:
+    """
+    Moves the users to a new connection, the rest of the linked users
+    stay in the current one.
+    """
+
+    connection_id = ctx.msg.author.connection_id
+    left_connection = ctx.db.create(ConnectedUser)
+    await ctx.db.flush()
+    left_id = cast(int, left_connection.id)
+
+    moved = cast(
+        CursorResult,
+        await ctx.db.execute(
+            update(User)
+            .filter(
+                col(User.connection_id) == connection_id, col(User.id).in_(left_ids)
+            )
+            .values(connection_id=left_id)
+        ),
+    )
+    await set_chats_from_users(ctx.db, connection_id)
+    await set_chats_from_users(ctx.db, left_id)
+    await add_cursors_from(ctx.db, left_id, connection_id)
+
+    if await ctx.db.count(User, connection_id=connection_id) == 0:
+        await delete_connection(ctx.db, connection_id)
+    if moved.rowcount == 0:
+        await delete_connection(ctx.db, left_id)
+    identity_cache.forget_connection(connection_id)
+    identity_cache.forget_connection(left_id)
 
 
-async def actually_unlink(bot: Bot, unlink_ids: Set[int]) -> None:
-    all_linked = await bot.db.read_all(User, connection_id=bot.msg.author.connection_id)
+@bot.command("unlink")
+async def unlink(ctx: Context, text: str) -> None:
+    text = text.strip(" ")
 
-    to_unlink = []
-    left_linked = []
-    for user in all_linked:
-        if user.id in unlink_ids:
-            to_unlink.append(user)
+    if text:
+        if text == "all":
+            # the author is the only one who is left linked to itself
+            await actually_unlink(ctx, {cast(int, ctx.msg.author.id)})
+            await ctx.send(f"Successfully unlinked all")
         else:
-            left_linked.append(user)
+            await ctx.send(f"I could not find unlink option '{text}'")
+    else:
+        await ctx.send("You need to specify which accounts are going to be unlinked")
+        await ctx.send("/unlink options", raw=True)
+        await ctx.send("Current options are:\n" "- all")
 
-    unlink_connection = bot.msg.author.connection
-    left_connection = bot.db.create(ConnectedUser)
-    await bot.db.flush()
 
-    unlink_connection.chats = sorted(set().union(*(user.chats for user in to_unlink)))
-    left_connection.chats = sorted(set().union(*(user.chats for user in left_linked)))
+identity_cache = IdentityCache(
+    options.IDENTITY_CACHE_TTL, options.IDENTITY_CACHE_SIZE
+)
 
-    assert left_connection.id is not None
-    for user in left_linked:
-        user.connection_id = left_connection.id
-        user.connection = left_connection
 
-    if len(to_unlink) == 0:
-        await bot.db.delete(unlink_connection)
-    if len(left_linked) == 0:
-        await bot.db.delete(left_connection)
+async def add_chat(
+    db: DataBase, user_id: int, connection_id: int, chat_id: int
+) -> None:
+    if identity_cache.has_membership(user_id, connection_id, chat_id):
+        return
+    await db.insert_ignore(UserChat, [dict(user_id=user_id, chat_id=chat_id)])
+    await db.insert_ignore(
+        ConnectionChat, [dict(connection_id=connection_id, chat_id=chat_id)]
+    )
+    identity_cache.add_membership(user_id, connection_id, chat_id)
 
 
-@bot.command("unlink")
-async def unlink(bot: Bot, text: str) -> None:
-    text = text.strip(" ")
+async def add_chats_from(db: DataBase, connection_id: int, other_id: int) -> None:
+    selection = sqlalchemy.select(
+        literal(connection_id), ConnectionChat.chat_id
+    ).filter(col(ConnectionChat.connection_id) == other_id)
+    await db.insert_ignore_from(
+        ConnectionChat, ["connection_id", "chat_id"], selection
+    )
 
-    if text:
-        if text == "all":
-            linked = await bot.db.read_all(
-                User, connection_id=bot.msg.author.connection_id
-            )
-            await actually_unlink(
-                bot,
-                {cast(int, user.id) for user in linked}
-                - {cast(int, bot.msg.author.id)},
-            )
-            await bot.send(f"Successfully unlinked all")
-        else:
-            await bot.send(f"I could not find unlink option '{text}'")
-    else:
-        await bot.send("You need to specify which accounts are going to be unlinked")
-        await bot.send("/unlink options", raw=True)
-        await bot.send("Current options are:\n" "- all")
+
+async def add_cursors_from(db: DataBase, connection_id: int, other_id: int) -> None:
+    # the messages that were read by any of the accounts stay read
+    selection = sqlalchemy.select(
+        literal(connection_id), ReadCursor.chat_id, ReadCursor.last_id
+    ).filter(col(ReadCursor.connection_id) == other_id)
+    await db.insert_or_raise_from(
+        ReadCursor, ["connection_id", "chat_id", "last_id"], selection, "last_id"
+    )
+
+
+async def set_chats_from_users(db: DataBase, connection_id: int) -> None:
+    # chats of the connection are the chats of its users
+    await db.execute(delete(ConnectionChat).filter_by(connection_id=connection_id))
+    user_ids = select(User.id).filter_by(connection_id=connection_id)
+    selection = (
+        sqlalchemy.select(literal(connection_id), UserChat.chat_id)
+        .filter(col(UserChat.user_id).in_(user_ids))
+        .distinct()
+    )
+    await db.insert_ignore_from(
+        ConnectionChat, ["connection_id", "chat_id"], selection
+    )
+
+
+async def delete_connection(db: DataBase, connection_id: int) -> None:
+    await db.execute(delete(ConnectionChat).filter_by(connection_id=connection_id))
+    await db.execute(delete(ReadCursor).filter_by(connection_id=connection_id))
+    await db.execute(delete(ConnectedUser).filter_by(id=connection_id))
 
 
 async def read_or_create_user(db: DataBase, **fields: Any) -> User:
-    user = await db.read_one_or_none(User, **fields)
+    user = await db.read_by_key(User, **fields)
     if user is not None:
         user.connection = await db.read_one(ConnectedUser, id=user.connection_id)
         return user
@@ -204,31 +607,330 @@ async def read_or_create_user(db: DataBase, **fields: Any) -> User:
     return db.create(User, **fields)
 
 
-async def make_message(
-    db: DataBase, in_msg: Any, chat: Any, author: Any, is_private: bool
-) -> Message:
-    fields = map_model(in_msg)
+class Incoming(NamedTuple):
+    platform: Platform
+    message: Dict[str, Any]
+    chat: Dict[str, Any]
+    author: Dict[str, Any]
+
+
+def map_incoming(platform: Platform, in_msg: Any, chat: Any, author: Any) -> Incoming:
+    return Incoming(platform, map_model(in_msg), map_model(chat), map_model(author))
+
+
+async def read_chat_id(db: DataBase, fields: Dict[str, Any]) -> int:
+    id = identity_cache.get_chat_id(db.platform, fields)
+    if id is None:
+        chat = await db.upsert(Chat, **fields)
+        await db.flush()
+        id = cast(int, chat.id)
+        identity_cache.set_chat(db.platform, fields, id)
+    return id
+
+
+async def read_user_ids(db: DataBase, fields: Dict[str, Any]) -> Tuple[int, int]:
+    ids = identity_cache.get_user(db.platform, fields["target_id"])
+    if ids is None:
+        user = await read_or_create_user(db, **fields)
+        await db.flush()
+        ids = cast(int, user.id), user.connection_id
+        identity_cache.set_user(db.platform, fields["target_id"], *ids)
+    return ids
+
+
+async def make_message(db: DataBase, incoming: Incoming, is_private: bool) -> Message:
+    fields = dict(incoming.message)
+
+    if is_private:
+        # commands need the whole objects, not just the ids
+        chat = await db.upsert(Chat, **incoming.chat)
+        author = await read_or_create_user(db, **incoming.author)
+        await db.flush()
+
+        fields["chat_id"] = chat.id
+        fields["author_id"] = author.id
+        return db.create_no_add(Message, chat=chat, author=author, **fields)
+
+    chat_id = fields["chat_id"] = await read_chat_id(db, incoming.chat)
+    author_id, connection_id = await read_user_ids(db, incoming.author)
+    fields["author_id"] = author_id
+
+    await add_chat(db, author_id, connection_id, chat_id)
+    # redelivered messages are updated in place instead of being duplicated
+    return await db.upsert(Message, **fields)
+
+
+def platform_key(platform: Platform, fields: Dict[str, Any]) -> PlatformKey:
+    return platform, fields["target_id"]
+
+
+async def write_chats(db: DataBase, batch: List[Incoming]) -> Dict[PlatformKey, int]:
+    ids: Dict[PlatformKey, int] = {}
+    rows: Dict[PlatformKey, Dict[str, Any]] = {}
+    for incoming in batch:
+        key = platform_key(incoming.platform, incoming.chat)
+        id = identity_cache.get_chat_id(incoming.platform, incoming.chat)
+        if id is None:
+            # the last name wins, if the chat was renamed within the batch
+            rows[key] = dict(incoming.chat, platform=incoming.platform)
+        elif key not in rows:
+            ids[key] = id
+    if not rows:
+        return ids
+
+    await db.upsert_all(Chat, rows.values(), ["name"])
+    for id, platform, target_id in await db.read_ids(Chat, rows):
+        key = platform, target_id
+        ids[key] = id
+        identity_cache.set_chat(platform, rows[key], id)
+    return ids
+
+
+async def write_users(
+    db: DataBase, batch: List[Incoming]
+) -> Dict[PlatformKey, Tuple[int, int]]:
+    ids: Dict[PlatformKey, Tuple[int, int]] = {}
+    rows: Dict[PlatformKey, Dict[str, Any]] = {}
+    for incoming in batch:
+        key = platform_key(incoming.platform, incoming.author)
+        cached = identity_cache.get_user(*key)
+        if cached is None:
+            rows[key] = dict(incoming.author, platform=incoming.platform)
+        else:
+            ids[key] = cached
+    if not rows:
+        return ids
+
+    found = await db.read_ids(User, rows, User.connection_id)
+    existing = {(platform, target_id) for _, platform, target_id, _ in found}
+    new = [key for key in rows if key not in existing]
+    if new:
+        # every new user gets a connection of its own
+        connections = [ConnectedUser() for _ in new]
+        db.add_all(connections)
+        await db.flush()
+        await db.insert_ignore(
+            User,
+            [
+                dict(rows[key], connection_id=connection.id)
+                for key, connection in zip(new, connections)
+            ],
+        )
+        found += await db.read_ids(User, new, User.connection_id)
+    for id, platform, target_id, connection_id in found:
+        ids[platform, target_id] = id, connection_id
+        identity_cache.set_user(platform, target_id, id, connection_id)
+    return ids
+
+
+async def write_batch(db: DataBase, batch: List[Incoming]) -> None:
+    """
+    Writes the public messages with a statement or two per table,
+    the chats and the users that are cached are not looked up.
+    """
+
+    chat_ids = await write_chats(db, batch)
+    user_ids = await write_users(db, batch)
+
+    memberships = set()
+    messages: Dict[Tuple[Platform, int, int], Dict[str, Any]] = {}
+    for incoming in batch:
+        platform = incoming.platform
+        chat_id = chat_ids[platform_key(platform, incoming.chat)]
+        author_id, connection_id = user_ids[platform_key(platform, incoming.author)]
+        if not identity_cache.has_membership(author_id, connection_id, chat_id):
+            memberships.add((author_id, connection_id, chat_id))
+        fields = dict(
+            incoming.message, platform=platform, chat_id=chat_id, author_id=author_id
+        )
+        # redelivered messages are updated in place instead of being duplicated
+        messages[platform, chat_id, fields["target_id"]] = fields
 
-    chat = fields["chat"] = await db.read_or_create(Chat, **map_model(chat))
-    author = fields["author"] = await read_or_create_user(db, **map_model(author))
-    await db.flush()
+    await db.insert_ignore(
+        UserChat,
+        [dict(user_id=user, chat_id=chat) for user, _, chat in memberships],
+    )
+    connection_chats = {(connection, chat) for _, connection, chat in memberships}
+    await db.insert_ignore(
+        ConnectionChat,
+        [
+            dict(connection_id=connection, chat_id=chat)
+            for connection, chat in connection_chats
+        ],
+    )
+    for membership in memberships:
+        identity_cache.add_membership(*membership)
 
-    fields["chat_id"] = chat.id
-    fields["author_id"] = author.id
+    await db.upsert_all(Message, messages.values(), ["text", "timestamp", "author_id"])
+
+
+async def write_messages(batch: List[Incoming]) -> None:
+    # the whole batch is written in a single transaction
+    try:
+        with stage("write_batch"), profile("ingest", len(batch)):
+            async with make_db(batch[0].platform) as db:
+                await write_batch(db, batch)
+        return
+    except Exception:
+        # ids of the rolled back rows could get into the cache
+        identity_cache.clear()
+        if len(batch) == 1:
+            raise
+        logger.exception("Failed to write a batch, writing messages one by one")
+
+    for incoming in batch:
+        try:
+            with profile("ingest"):
+                async with make_db(incoming.platform) as db:
+                    await make_message(db, incoming, False)
+        except Exception:
+            identity_cache.clear()
+            logger.exception("Failed to write a message")
+
+
+ingestor: BatchQueue[Incoming] = BatchQueue(
+    write_messages,
+    options.INGEST_BATCH_SIZE,
+    options.INGEST_FLUSH_INTERVAL_MS / 1000,
+    options.INGEST_QUEUE_SIZE,
+)
+
+
+def sweep() -> None:
+    expire_auth()
+    list_cursors.expire()
+    search_pages.expire()
+    identity_cache.expire()
+    bot.outbox.expire()
+    archive.segment_cache.expire()
 
-    msg = db.create_no_add(Message, **fields)
+
+sweeper = Sweeper(options.SWEEP_INTERVAL, sweep)
+
+ChatKey = Tuple[Platform, int]
+chat_locks: KeyedLock[ChatKey] = KeyedLock()
+
+
+async def handle_incoming(
+    incoming: Incoming, in_msg: Any, is_private: bool, dispatched: float = 0
+) -> None:
+    """
+    Queues a public message for writing or handles a command,
+    dispatched is the perf_counter() of dispatch_incoming, if it was called.
+    """
+
+    platform = incoming.platform
+    kind = "private" if is_private else "public"
+    MESSAGES.inc(platform.value, kind)
     if not is_private:
-        author.add_chat(chat)
-        db.add(msg)
-    return msg
+        await ingestor.put(incoming)
+        if dispatched:
+            DISPATCH_WAIT.observe_since(dispatched, platform.value, kind)
+        return
+
+    # commands of the same chat are handled one after another
+    async with chat_locks((platform, incoming.chat["target_id"])), bot.semaphore:
+        if dispatched:
+            DISPATCH_WAIT.observe_since(dispatched, platform.value, kind)
+        try:
+            with profile("command"):
+                with stage("make_message"):
+                    async with make_db(platform) as db:
+                        msg = await make_message(db, incoming, is_private)
+                # the writer is given back, so that other commands don't wait
+                # for this one, the session of the command takes it if it writes
+                with stage("command"):
+                    async with make_db(platform) as db:
+                        await bot.handle_message(db, in_msg, msg)
+        except Exception:
+            identity_cache.clear()
+            raise
+    # print(auth_ids, auth_keys)
 
 
 async def handle_message(
     platform: Platform, in_msg: Any, chat: Any, author: Any, is_private: bool
 ) -> None:
-    expire_auth()
-    async with make_db(platform) as db:
-        msg = await make_message(db, in_msg, chat, author, is_private)
-        if is_private:
-            await bot.handle_message(db, in_msg, msg)
-    # print(auth_ids, auth_keys)
+    with stage("map"):
+        incoming = map_incoming(platform, in_msg, chat, author)
+    await handle_incoming(incoming, in_msg, is_private)
+
+
+# commands run in their own tasks, at most bot.max_commands at once
+dispatcher = TaskSet(options.DISPATCH_QUEUE_SIZE)
+
+# set in the processes of the platforms, there the messages are handed
+# to the writer process instead of being handled, see supervisor
+forward: Optional[Callable[[Incoming, Any, bool], Awaitable[None]]] = None
+
+
+async def dispatch_message(
+    platform: Platform, in_msg: Any, chat: Any, author: Any, is_private: bool
+) -> None:
+    """
+    Same as handle_message, but a command is handled in its own task,
+    and this function returns as soon as the message is queued.
+    """
+
+    with stage("map"):
+        incoming = map_incoming(platform, in_msg, chat, author)
+    if forward is not None:
+        await forward(incoming, in_msg, is_private)
+    else:
+        await dispatch_incoming(incoming, in_msg, is_private)
+
+
+async def dispatch_incoming(incoming: Incoming, in_msg: Any, is_private: bool) -> None:
+    dispatched = perf_counter()
+    if is_private:
+        await dispatcher.submit(
+            handle_incoming, incoming, in_msg, is_private, dispatched
+        )
+    else:
+        # public messages are only queued, they never wait for the commands
+        await handle_incoming(incoming, in_msg, is_private, dispatched)
+
+
+def ttldict_sizes() -> Dict[Tuple[str, ...], float]:
+    return {
+        ("auth_ids",): len(auth_ids),
+        ("auth_keys",): len(auth_keys),
+        ("list_cursors",): len(list_cursors),
+        ("search_pages",): len(search_pages),
+        ("identity_chats",): len(identity_cache.chats),
+        ("identity_users",): len(identity_cache.users),
+        ("identity_memberships",): len(identity_cache.memberships),
+    }
+
+
+def queue_depths() -> Dict[Tuple[str, ...], float]:
+    return {
+        ("ingestor",): ingestor.depth,
+        ("dispatcher",): len(dispatcher),
+        ("outbox",): bot.outbox.depth,
+    }
+
+
+Gauge(
+    "restless_ttldict_size",
+    "Items in the expiring dicts, including the expired ones not swept yet",
+    ("dict",),
+    ttldict_sizes,
+)
+Gauge("restless_queue_depth", "Items waiting in the queues", ("queue",), queue_depths)
+
+
+def identity_cache_stats() -> Dict[Tuple[str, ...], float]:
+    return {
+        (table, kind): value
+        for table, stats in identity_cache.stats().items()
+        for kind, value in stats.items()
+    }
+
+
+Gauge(
+    "restless_identity_cache",
+    "Size, hits and misses of the tables of the identity cache",
+    ("table", "kind"),
+    identity_cache_stats,
+)
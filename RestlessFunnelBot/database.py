@@ -1,37 +1,187 @@
 from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Any, AsyncGenerator, List, Optional, Type, TypeVar
+from typing import (
+    Any,
+    AsyncGenerator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    cast,
+)
 
-from sqlalchemy.engine import Result, ScalarResult
-from sqlalchemy.ext.asyncio import create_async_engine
+import sqlalchemy
+from sqlalchemy import event, func, inspect, or_, tuple_
+from sqlalchemy.engine import Result, ScalarResult, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
 from sqlalchemy.sql import Select
-from sqlalchemy.orm import load_only
 from sqlmodel import SQLModel, select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from . import options
-from .models import Platform
+from . import options, profiling
+from .metrics import stage
+from .migrations import migrate
+from .models import Platform, insert_for
 
-DATABASE_URL = f"sqlite+aiosqlite:///{Path(__file__).parent}/sqlite.db"
+DATABASE_PATH = Path(__file__).parent / "sqlite.db"
+MEMORY_PATH = ":memory:"
 
-engine = create_async_engine(
-    DATABASE_URL, future=True, connect_args={"check_same_thread": False}
-)
+# all writes go through this engine, for sqlite it has exactly one connection
+engine: AsyncEngine = cast(AsyncEngine, None)
+# read-only connections, same as engine if readers are not separated
+read_engine: AsyncEngine = cast(AsyncEngine, None)
+
+
+def sqlite_url(path: Union[str, Path], readonly: bool = False) -> str:
+    if str(path) == MEMORY_PATH:
+        return "sqlite+aiosqlite://"
+    if readonly:
+        return f"sqlite+aiosqlite:///file:{path}?mode=ro&uri=true"
+    return f"sqlite+aiosqlite:///{path}"
+
+
+def database_url() -> str:
+    return options.DATABASE_URL or sqlite_url(DATABASE_PATH)
+
+
+def is_sqlite(engine: AsyncEngine) -> bool:
+    return engine.dialect.name == "sqlite"
+
+
+def sqlite_pragmas(readonly: bool) -> Dict[str, Any]:
+    pragmas: Dict[str, Any] = dict(
+        synchronous=options.SQLITE_SYNCHRONOUS,
+        cache_size=options.SQLITE_CACHE_SIZE,
+        mmap_size=options.SQLITE_MMAP_SIZE,
+        busy_timeout=options.SQLITE_BUSY_TIMEOUT_MS,
+        temp_store=options.SQLITE_TEMP_STORE,
+    )
+    if not readonly:
+        # journal mode is persistent and can't be changed by the readers
+        pragmas["journal_mode"] = options.SQLITE_JOURNAL_MODE
+    return pragmas
+
+
+def apply_pragmas(engine: AsyncEngine, pragmas: Dict[str, Any]) -> None:
+    @event.listens_for(engine.sync_engine, "connect")
+    def on_connect(dbapi_connection: Any, connection_record: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
+def create_sqlite_engine(path: Union[str, Path], readonly: bool, size: int) -> AsyncEngine:
+    result = create_async_engine(
+        sqlite_url(path, readonly),
+        future=True,
+        connect_args={"check_same_thread": False},
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=size,
+        max_overflow=0,
+    )
+    apply_pragmas(result, sqlite_pragmas(readonly))
+    return result
+
+
+def setup_sqlite_engines(path: str) -> None:
+    global engine, read_engine
+
+    if path == MEMORY_PATH:
+        # every connection would get its own in-memory database
+        engine = create_async_engine(
+            sqlite_url(path),
+            future=True,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        apply_pragmas(engine, sqlite_pragmas(readonly=True))
+        read_engine = engine
+        return
+
+    engine = create_sqlite_engine(path, readonly=False, size=1)
+    if options.SQLITE_SEPARATE_READERS:
+        read_engine = create_sqlite_engine(
+            path, readonly=True, size=options.SQLITE_READERS
+        )
+    else:
+        read_engine = engine
+
+
+def setup_engines(url: Optional[str] = None) -> None:
+    global engine, read_engine
+
+    parsed = make_url(url or database_url())
+    if parsed.get_backend_name() == "sqlite":
+        return setup_sqlite_engines(parsed.database or MEMORY_PATH)
+
+    # server databases handle concurrent writers themselves
+    engine = read_engine = create_async_engine(
+        parsed,
+        future=True,
+        pool_size=options.DATABASE_POOL_SIZE,
+        max_overflow=options.DATABASE_MAX_OVERFLOW,
+        pool_recycle=options.DATABASE_POOL_RECYCLE,
+        pool_pre_ping=options.DATABASE_POOL_PRE_PING,
+    )
+
+
+async def report_settings() -> None:
+    settings = []
+    if is_sqlite(engine):
+        names = ["journal_mode", *sqlite_pragmas(readonly=True)]
+        async with engine.connect() as conn:
+            for name in names:
+                value = (await conn.exec_driver_sql(f"PRAGMA {name}")).scalar()
+                settings.append(f"{name}={value}")
+    else:
+        settings.append(f"pool_size={options.DATABASE_POOL_SIZE}")
+        settings.append(f"max_overflow={options.DATABASE_MAX_OVERFLOW}")
+
+    if options.PROFILE_QUERIES:
+        settings.append(f"query_budget={options.QUERY_BUDGET}")
+
+    readers = "separate readers" if read_engine is not engine else "shared readers"
+    # repr hides the password
+    print(f"Database: {engine.url!r}, {readers}, " + ", ".join(settings))
 
 
 async def db_startup() -> None:
+    if engine is None:
+        setup_engines()
+    if options.PROFILE_QUERIES:
+        profiling.enable()
+
     async with engine.begin() as conn:
         if options.DEV_MODE:
             await conn.run_sync(SQLModel.metadata.drop_all)
         await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(migrate)
+    await report_settings()
+
+
+async def dispose_engines() -> None:
+    # pooled connections keep their threads alive otherwise
+    await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
 
 
 async def db_shutdown() -> None:
+    if options.PROFILE_QUERIES and profiling.totals:
+        print("Queries:\n" + profiling.report())
+
     if options.DEV_MODE:
         async with engine.begin() as conn:
             await conn.run_sync(SQLModel.metadata.drop_all)
 
-    await engine.dispose()
+    await dispose_engines()
 
 
 @asynccontextmanager
@@ -40,7 +190,11 @@ async def db_tables() -> AsyncGenerator[None, None]:
     try:
         yield
     except Exception:
+        # db_shutdown disposes the engines too
         await db_shutdown()
+        raise
+    else:
+        await dispose_engines()
 
 
 T = TypeVar("T", bound=Any)
@@ -51,13 +205,45 @@ class DataBase(AsyncSession):
         super().__init__(*args, **kwargs)
         self.platform = platform
 
+    async def flush(self, objects: Optional[Iterable[Any]] = None) -> None:
+        with stage("flush"):
+            await super().flush(objects)
+
     async def fetch(self, selection: Select) -> ScalarResult:
         result: Result = await self.execute(selection)
         return result.scalars()
 
     async def count(self, model: Type[T], *args, **kwargs: Any) -> int:
-        selection = select(model).filter(*args).filter_by(**kwargs).options(load_only())
-        return len((await self.fetch(selection)).all())
+        selection = sqlalchemy.select(func.count()).select_from(model)
+        selection = selection.filter(*args).filter_by(**kwargs)
+        return (await self.execute(selection)).scalar_one()
+
+    async def count_by(
+        self,
+        model: Type[T],
+        key: Any,
+        *args,
+        limit: Optional[int] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Any, int]]:
+        """
+        Returns (key, count) pairs, the most frequent keys go first.
+        """
+
+        amount = func.count().label("amount")
+        selection = sqlalchemy.select(key, amount).select_from(model)
+        selection = selection.filter(*args).filter_by(**kwargs).group_by(key)
+        selection = selection.order_by(amount.desc(), key).limit(limit)
+        return [(row[0], row[1]) for row in await self.execute(selection)]
+
+    async def min_max(
+        self, model: Type[T], column: Any, *args, **kwargs: Any
+    ) -> Tuple[Any, Any]:
+        selection = sqlalchemy.select(func.min(column), func.max(column))
+        selection = selection.select_from(model)
+        selection = selection.filter(*args).filter_by(**kwargs)
+        minimum, maximum = (await self.execute(selection)).one()
+        return minimum, maximum
 
     async def read_all(self, model: Type[T], *args, **kwargs: Any) -> List[T]:
         selection = select(model).filter(*args).filter_by(**kwargs)
@@ -73,6 +259,99 @@ class DataBase(AsyncSession):
         selection = select(model).filter(*args).filter_by(**kwargs)
         return (await self.fetch(selection)).one_or_none()
 
+    @property
+    def dialect(self) -> str:
+        return cast(AsyncEngine, self.bind).dialect.name
+
+    def insert(self, model: Type[T]) -> Any:
+        return insert_for(self.dialect, model)
+
+    async def insert_ignore(
+        self, model: Type[T], rows: Iterable[Dict[str, Any]]
+    ) -> None:
+        rows = list(rows)
+        if rows:
+            statement = self.insert(model).values(rows)
+            with stage("insert"):
+                await self.execute(statement.on_conflict_do_nothing())
+
+    async def insert_ignore_from(
+        self, model: Type[T], names: List[str], selection: Select
+    ) -> None:
+        statement = self.insert(model).from_select(names, selection)
+        with stage("insert"):
+            await self.execute(statement.on_conflict_do_nothing())
+
+    async def upsert_all(
+        self, model: Type[T], rows: Iterable[Dict[str, Any]], update: Sequence[str]
+    ) -> None:
+        """
+        Inserts the rows with one statement, the rows that exist already
+        by the natural key get the `update` columns changed if they differ.
+        """
+
+        rows = list(rows)
+        if not rows:
+            return
+        statement = self.insert(model).values(rows)
+        if update:
+            new = statement.excluded
+            statement = statement.on_conflict_do_update(
+                index_elements=list(model.natural_key),
+                set_={name: new[name] for name in update},
+                where=or_(*(getattr(model, name) != new[name] for name in update)),
+            )
+        else:
+            statement = statement.on_conflict_do_nothing()
+        with stage("insert"):
+            await self.execute(statement)
+
+    async def read_ids(
+        self, model: Type[T], keys: Iterable[Tuple[Any, ...]], *columns: Any
+    ) -> List[Tuple[Any, ...]]:
+        """
+        (id, *natural key, *columns) of the rows with the natural keys.
+        """
+
+        keys = list(keys)
+        if not keys:
+            return []
+        key_columns = [getattr(model, name) for name in model.natural_key]
+        selection = select(model.id, *key_columns, *columns).filter(
+            tuple_(*key_columns).in_(keys)
+        )
+        with stage("read"):
+            return [tuple(row) for row in await self.execute(selection)]
+
+    def _raise_on_conflict(self, model: Type[T], statement: Any, column: str) -> Any:
+        current = getattr(model, column)
+        new = getattr(statement.excluded, column)
+        keys = [key.name for key in inspect(model).primary_key]
+        return statement.on_conflict_do_update(
+            index_elements=keys, set_={column: new}, where=current < new
+        )
+
+    async def insert_or_raise(
+        self, model: Type[T], rows: Iterable[Dict[str, Any]], column: str
+    ) -> None:
+        """
+        Inserts the rows, the rows that exist already only get the column
+        raised to the new value, it is never lowered.
+        """
+
+        rows = list(rows)
+        if rows:
+            statement = self.insert(model).values(rows)
+            with stage("insert"):
+                await self.execute(self._raise_on_conflict(model, statement, column))
+
+    async def insert_or_raise_from(
+        self, model: Type[T], names: List[str], selection: Select, column: str
+    ) -> None:
+        statement = self.insert(model).from_select(names, selection)
+        with stage("insert"):
+            await self.execute(self._raise_on_conflict(model, statement, column))
+
     def create_no_add(self, model: Type[T], **kwargs: Any) -> T:
         kwargs["platform"] = self.platform
         return model(**kwargs)
@@ -82,27 +361,54 @@ class DataBase(AsyncSession):
         self.add(instance)
         return instance
 
-    async def read_or_create(self, model: Type[T], **kwargs: Any) -> T:
+    def natural_key(self, model: Type[T], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        names = getattr(model, "natural_key", None)
+        if names is None:
+            return kwargs
+        return {name: kwargs[name] for name in names}
+
+    async def read_by_key(self, model: Type[T], **kwargs: Any) -> Optional[T]:
         kwargs["platform"] = self.platform
-        instance = await self.read_one_or_none(model, **kwargs)
+        with stage("read"):
+            return await self.read_one_or_none(model, **self.natural_key(model, kwargs))
+
+    async def read_or_create(self, model: Type[T], **kwargs: Any) -> T:
+        instance = await self.read_by_key(model, **kwargs)
         if instance is not None:
             return instance
         return self.create(model, **kwargs)
 
+    async def upsert(self, model: Type[T], **kwargs: Any) -> T:
+        """
+        Reads the instance by its natural key and updates the changed fields,
+        or creates it if it does not exist yet.
+        """
+
+        instance = await self.read_by_key(model, **kwargs)
+        if instance is None:
+            return self.create(model, **kwargs)
+
+        for name, value in kwargs.items():
+            if getattr(instance, name) != value:
+                setattr(instance, name, value)
+        return instance
+
 
-def make_session(platform: Platform) -> DataBase:
-    return DataBase(bind=engine, expire_on_commit=False, platform=platform)
+def make_session(platform: Platform, readonly: bool = False) -> DataBase:
+    bind = read_engine if readonly else engine
+    return DataBase(bind=bind, expire_on_commit=False, platform=platform)
 
 
 async def get_db(
-    platform: Platform, commit: bool = True
+    platform: Platform, commit: bool = True, readonly: bool = False
 ) -> AsyncGenerator[DataBase, None]:
-    async with make_session(platform) as session:
+    async with make_session(platform, readonly) as session:
         async with session.begin():
             try:
                 yield session
                 if commit:
-                    await session.commit()
+                    with stage("commit"):
+                        await session.commit()
             except Exception:
                 await session.rollback()
                 raise
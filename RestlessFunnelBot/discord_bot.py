@@ -1,4 +1,5 @@
 import logging
+from pathlib import Path
 from typing import Any, Dict, Optional
 
 import discord
@@ -10,12 +11,21 @@ from discord.user import BaseUser as TargetUser
 from discord.user import _UserTag as TargetUserTag
 from discord.utils import MISSING
 
-from . import bot_secrets
+from . import bot_secrets, options
 from .bot import bot as main_bot
-from .common import handle_message
+from .common import dispatch_message
 from .mappers import model_mapper
 from .models import DISCORD as PLATFORM
 from .models import Chat, Message, User
+from .outbox import RateLimit, RetryAfter
+
+# https://discord.com/developers/docs/resources/channel#create-message
+MAX_MESSAGE_LENGTH = 2000
+# https://discord.com/developers/docs/topics/rate-limits
+RATE_LIMIT = RateLimit(rate=50, burst=50)
+CHAT_RATE_LIMIT = RateLimit(rate=1, burst=5)
+# https://support.discord.com/hc/en-us/articles/25444343291031
+MAX_FILE_SIZE = 10 * 1024 * 1024
 
 
 @model_mapper(TargetMessage, Message)
@@ -53,7 +63,9 @@ def private_chat_to_model(chat: TargetPrivateChat) -> Dict[str, Any]:
     )
 
 
-@main_bot.send_function(TargetMessage)
+@main_bot.send_function(
+    TargetMessage, PLATFORM, MAX_MESSAGE_LENGTH, RATE_LIMIT, CHAT_RATE_LIMIT
+)
 async def send(msg: TargetMessage, text: str, mention: bool, raw: bool) -> None:
     if raw:
         if "\n" in text:
@@ -61,16 +73,41 @@ async def send(msg: TargetMessage, text: str, mention: bool, raw: bool) -> None:
         else:
             text = f"`{text}`"
 
-    if mention:
-        await msg.channel.send(text, reference=msg)
-    else:
-        await msg.channel.send(text)
+    try:
+        if mention:
+            await msg.channel.send(text, reference=msg)
+        else:
+            await msg.channel.send(text)
+    except discord.RateLimited as e:
+        # the library waits for the short limits by itself
+        raise RetryAfter(e.retry_after) from e
+
+
+@main_bot.file_function(TargetMessage, MAX_FILE_SIZE)
+async def send_file(msg: TargetMessage, path: Path, name: str) -> None:
+    try:
+        await msg.channel.send(file=discord.File(path, filename=name))
+    except discord.RateLimited as e:
+        raise RetryAfter(e.retry_after) from e
 
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-client = discord.Client(intents=intents)
+client: discord.Client
+if options.DISCORD_SHARDS == 1:
+    client = discord.Client(intents=intents)
+elif options.DISCORD_SHARD_ID < 0:
+    # all of the shards in this process
+    client = discord.AutoShardedClient(
+        intents=intents, shard_count=options.DISCORD_SHARDS
+    )
+else:
+    client = discord.Client(
+        intents=intents,
+        shard_id=options.DISCORD_SHARD_ID,
+        shard_count=options.DISCORD_SHARDS,
+    )
 
 
 @client.event
@@ -87,7 +124,7 @@ async def on_message(in_msg: TargetMessage) -> None:
         return
 
     is_private = in_msg.channel.type == TargetChatType.private
-    await handle_message(PLATFORM, in_msg, in_msg.channel, in_msg.author, is_private)
+    await dispatch_message(PLATFORM, in_msg, in_msg.channel, in_msg.author, is_private)
 
 
 async def run(reconnect: bool = True) -> None:
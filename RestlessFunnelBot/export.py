@@ -0,0 +1,191 @@
+"""
+Export of the messages into files
+---
+Rows are streamed from the database and written in batches,
+so exporting the whole history takes constant memory.
+"""
+
+import asyncio
+import csv
+import gzip
+import json
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import IO, AsyncIterator, List, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy.sql import Select
+from sqlmodel import select
+
+from . import archive
+from .database import DataBase
+from .models import Chat, Message, Platform, Segment, User, col, from_moscow_tz
+
+FORMATS = ("jsonl", "csv")
+COMPRESSED = ".gz"
+FIELDS = ("timestamp", "platform", "chat", "author", "text")
+DATE_FORMAT = "%Y-%m-%d"
+RANGE_SEP = ".."
+# rows that are written at once, and fetched from the database at once
+BATCH_SIZE = 1000
+
+# timestamp, platform, chat, author, text
+ExportRow = Tuple[str, str, str, int, str]
+TimeRange = Tuple[Optional[datetime], Optional[datetime]]
+
+
+def parse_format(word: str) -> Optional[Tuple[str, bool]]:
+    """
+    "csv" or "csv.gz" -> ("csv", compress)
+    """
+
+    compress = word.endswith(COMPRESSED)
+    if compress:
+        word = word[: -len(COMPRESSED)]
+    if word not in FORMATS:
+        return None
+    return word, compress
+
+
+def parse_date(text: str) -> Optional[datetime]:
+    if not text:
+        return None
+    # the dates are shown in moscow time, they are stored in utc
+    date = datetime.strptime(text, DATE_FORMAT)
+    return from_moscow_tz(date).replace(tzinfo=None)
+
+
+def parse_range(word: str) -> Optional[TimeRange]:
+    """
+    "2024-01-01..2024-01-31", either side can be omitted,
+    a single date is that day, the end is included.
+    """
+
+    start, sep, end = word.partition(RANGE_SEP)
+    if not sep:
+        end = start
+    try:
+        first, last = parse_date(start), parse_date(end)
+    except ValueError:
+        return None
+    if last is not None:
+        last += timedelta(days=1)
+    return first, last
+
+
+def in_range(timestamp: datetime, time_range: TimeRange) -> bool:
+    start, end = time_range
+    return (start is None or timestamp >= start) and (end is None or timestamp < end)
+
+
+def make_row(
+    timestamp: datetime, platform: Platform, chat: str, author: int, text: str
+) -> ExportRow:
+    return timestamp.isoformat(), platform.value, chat, author, text
+
+
+async def export_rows(
+    db: DataBase, chat_ids: Select, time_range: TimeRange, chat_sep: str
+) -> AsyncIterator[ExportRow]:
+    """
+    Messages of the chats, the archived ones go first, one segment at a time.
+    """
+
+    chats = {
+        chat.id: chat.represent_name(chat_sep)
+        for chat in await db.read_all(Chat, col(Chat.id).in_(chat_ids))
+    }
+    start, end = time_range
+
+    segments = select(Segment).filter(col(Segment.chat_id).in_(chat_ids))
+    if start is not None:
+        segments = segments.filter(col(Segment.last_timestamp) >= start)
+    if end is not None:
+        segments = segments.filter(col(Segment.first_timestamp) < end)
+    segments = segments.order_by(col(Segment.first_timestamp), col(Segment.first_id))
+    for segment in (await db.fetch(segments)).all():
+        # not cached, the export would push out the pages of /list
+        messages = await archive.load_segment(segment, cache=False)
+        author_ids = {msg.author_id for msg in messages}
+        authors = {
+            user.id: user.target_id
+            for user in await db.read_all(User, col(User.id).in_(author_ids))
+        }
+        for msg in messages:
+            if in_range(msg.timestamp, time_range):
+                author = authors[msg.author_id]
+                chat = chats[msg.chat_id]
+                yield make_row(msg.timestamp, msg.platform, chat, author, msg.text)
+
+    selection = (
+        sqlalchemy.select(
+            Message.timestamp,
+            Message.platform,
+            Message.chat_id,
+            User.target_id,
+            Message.text,
+        )
+        .join(User, col(Message.author_id) == col(User.id))
+        .filter(col(Message.chat_id).in_(chat_ids))
+    )
+    if start is not None:
+        selection = selection.filter(col(Message.timestamp) >= start)
+    if end is not None:
+        selection = selection.filter(col(Message.timestamp) < end)
+    selection = selection.order_by(col(Message.timestamp), col(Message.id))
+    # fetched in batches, not all at once
+    selection = selection.execution_options(yield_per=BATCH_SIZE)
+    async for timestamp, platform, chat_id, author, text in await db.stream(selection):
+        yield make_row(timestamp, platform, chats[chat_id], author, text)
+
+
+def open_file(path: Path, compress: bool) -> IO[str]:
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+
+def write_rows(file: IO[str], format: str, rows: List[ExportRow]) -> None:
+    if format == "csv":
+        csv.writer(file).writerows(rows)
+    else:
+        file.writelines(
+            json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + "\n"
+            for row in rows
+        )
+
+
+async def export(
+    db: DataBase,
+    chat_ids: Select,
+    path: Path,
+    format: str,
+    compress: bool,
+    time_range: TimeRange,
+    chat_sep: str,
+) -> int:
+    """
+    Writes the messages of the chats into the file,
+    returns how many were written.
+    """
+
+    # files are written in another thread, so the loop is not held up
+    loop = asyncio.get_running_loop()
+    file = await loop.run_in_executor(None, open_file, path, compress)
+    written = 0
+    try:
+        if format == "csv":
+            csv.writer(file).writerow(FIELDS)
+        batch: List[ExportRow] = []
+        async for row in export_rows(db, chat_ids, time_range, chat_sep):
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                await loop.run_in_executor(None, write_rows, file, format, batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            await loop.run_in_executor(None, write_rows, file, format, batch)
+            written += len(batch)
+    finally:
+        await loop.run_in_executor(None, file.close)
+    return written
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    cast,
+)
+
+T = TypeVar("T")
+K = TypeVar("K", bound=Hashable)
+BatchHandler = Callable[[List[T]], Awaitable[None]]
+Job = Callable[..., Awaitable[None]]
+
+logger = logging.getLogger(__name__)
+
+_STOP: Any = object()
+
+
+class BatchQueue(Generic[T]):
+    """
+    Collects items and hands them to the handler in batches.
+    ---
+    A batch is handed over when it has `batch_size` items
+    or when `flush_interval` seconds passed since its first item,
+    whichever comes first.
+    """
+
+    handler: BatchHandler
+    batch_size: int
+    flush_interval: float
+    max_size: int
+
+    def __init__(
+        self,
+        handler: BatchHandler,
+        batch_size: int,
+        flush_interval: float,
+        max_size: int = 0,
+    ) -> None:
+        self.handler = handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        # created lazily, so it is bound to the running loop
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_size)
+        return self._queue
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def depth(self) -> int:
+        return 0 if self._queue is None else self._queue.qsize()
+
+    async def put(self, item: T) -> None:
+        if not self.is_running:
+            self.start()
+        await self.queue.put(item)
+
+    def start(self) -> None:
+        if not self.is_running:
+            self._task = asyncio.ensure_future(self._work())
+
+    async def stop(self) -> None:
+        if self.is_running:
+            await self.queue.put(_STOP)
+            await cast(asyncio.Task, self._task)
+        self._task = None
+        # the next start may happen in another loop
+        self._queue = None
+
+    @asynccontextmanager
+    async def running(self) -> AsyncGenerator["BatchQueue[T]", None]:
+        self.start()
+        try:
+            yield self
+        finally:
+            await self.stop()
+
+    async def _collect(self) -> Tuple[List[T], bool]:
+        queue = self.queue
+        batch: List[T] = []
+        item = await queue.get()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+
+        while item is not _STOP:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                return batch, False
+
+            if not queue.empty():
+                item = queue.get_nowait()
+                continue
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                return batch, False
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return batch, False
+
+        return batch, True
+
+    async def _work(self) -> None:
+        stop = False
+        while not stop:
+            batch, stop = await self._collect()
+            if not batch:
+                continue
+            try:
+                await self.handler(batch)
+            except Exception:
+                logger.exception("Failed to handle a batch of %d items", len(batch))
+
+
+class KeyedLock(Generic[K]):
+    """
+    Separate lock for every key, the unused locks are removed.
+    """
+
+    def __init__(self) -> None:
+        # lock and the number of its holders and waiters
+        self._locks: Dict[K, List[Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def __call__(self, key: K) -> AsyncGenerator[None, None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+class TaskSet:
+    """
+    Runs every job in its own task and keeps track of the unfinished ones.
+    ---
+    With `max_size`, submitting waits while that many jobs are unfinished.
+    """
+
+    max_size: int
+
+    def __init__(self, max_size: int = 0) -> None:
+        self.max_size = max_size
+        self._tasks: Set[asyncio.Task] = set()
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    @property
+    def is_running(self) -> bool:
+        return bool(self._tasks)
+
+    async def submit(self, job: Job, *args: Any) -> None:
+        if self.max_size:
+            if self._slots is None:
+                # created here, so it is bound to the running loop
+                self._slots = asyncio.Semaphore(self.max_size)
+            await self._slots.acquire()
+        task = asyncio.ensure_future(self._run(job, args))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    async def stop(self) -> None:
+        await self.join()
+        # the next start may happen in another loop
+        self._slots = None
+
+    @asynccontextmanager
+    async def running(self) -> AsyncGenerator["TaskSet", None]:
+        try:
+            yield self
+        finally:
+            await self.stop()
+
+    async def join(self) -> None:
+        """
+        Waits until the jobs that are already submitted are done.
+        """
+
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def _run(self, job: Job, args: Tuple[Any, ...]) -> None:
+        try:
+            await job(*args)
+        except Exception:
+            logger.exception("Failed to run a job")
+
+    def _done(self, task: "asyncio.Task[None]") -> None:
+        self._tasks.discard(task)
+        if self._slots is not None:
+            self._slots.release()
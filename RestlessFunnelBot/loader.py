@@ -0,0 +1,143 @@
+"""
+Batched and cached lookups of platform objects
+---
+Lookups that happen at the same time are combined into one request,
+and the results are cached for a while.
+"""
+
+import asyncio
+import logging
+from time import monotonic
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from .cache import LRUCache
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+Fetch = Callable[[List[K]], Awaitable[Dict[K, V]]]
+
+logger = logging.getLogger(__name__)
+
+
+def _retrieve(future: "asyncio.Future[Any]") -> None:
+    # nobody might wait for a background refresh
+    if not future.cancelled():
+        future.exception()
+
+
+class BatchLoader(Generic[K, V]):
+    """
+    Loads objects by their keys with `fetch`, at most `max_batch` at once.
+    ---
+    The keys that are requested during the same iteration of the loop
+    go to the same batch. The values are cached for `ttl` seconds,
+    and the ones that are older than `refresh_after` seconds are
+    still returned, but they are loaded again in the background.
+    """
+
+    fetch: Fetch
+    max_batch: int
+    refresh_after: Optional[float]
+    cache: LRUCache[K, Tuple[V, float]]
+    batches: int
+
+    def __init__(
+        self,
+        fetch: Fetch,
+        ttl: float,
+        max_size: int,
+        refresh_after: Optional[float] = None,
+        max_batch: int = 100,
+    ) -> None:
+        self.fetch = fetch
+        self.max_batch = max_batch
+        self.refresh_after = refresh_after
+        self.cache = LRUCache(ttl, max_size)
+        self.batches = 0
+        self._pending: Dict[K, "asyncio.Future[V]"] = {}
+        self._batch: List[K] = []
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    async def load(self, key: K) -> V:
+        """
+        Returns the value of the key, raises KeyError if there is none.
+        """
+
+        entry = self.cache.get(key)
+        if entry is None:
+            return await self._schedule(key)
+
+        value, loaded = entry
+        if self.refresh_after is not None and monotonic() - loaded > self.refresh_after:
+            self._schedule(key)
+        return value
+
+    def refresh(self, key: K) -> None:
+        """
+        Loads the value again, the next load() waits for it.
+        """
+
+        self.cache.pop(key)
+        self._schedule(key)
+
+    def _schedule(self, key: K) -> "asyncio.Future[V]":
+        future = self._pending.get(key)
+        if future is not None:
+            return future
+
+        loop = asyncio.get_running_loop()
+        future = self._pending[key] = loop.create_future()
+        future.add_done_callback(_retrieve)
+        self._batch.append(key)
+        if len(self._batch) >= self.max_batch:
+            self._dispatch()
+        elif len(self._batch) == 1:
+            loop.call_soon(self._dispatch)
+        return future
+
+    def _dispatch(self) -> None:
+        keys, self._batch = self._batch, []
+        if keys:
+            self.batches += 1
+            task = asyncio.ensure_future(self._load_batch(keys))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _load_batch(self, keys: List[K]) -> None:
+        try:
+            values = await self.fetch(keys)
+        except Exception as e:
+            logger.warning("Failed to load %d keys: %r", len(keys), e)
+            for key in keys:
+                self._pending.pop(key).set_exception(e)
+            return
+
+        loaded = monotonic()
+        for key in keys:
+            future = self._pending.pop(key)
+            if key in values:
+                self.cache.set(key, (values[key], loaded))
+                future.set_result(values[key])
+            else:
+                future.set_exception(KeyError(key))
+
+    def expire(self) -> None:
+        self.cache.expire()
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.cache.stats(), batches=self.batches)
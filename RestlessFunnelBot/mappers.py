@@ -1,4 +1,4 @@
-from typing import Any, Callable, Dict, Optional, Tuple, Type, TypeVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type, TypeVar
 
 T = TypeVar("T", bound=Any)
 M = TypeVar("M", bound=Any)
@@ -7,24 +7,34 @@ MapToModel = Dict[Type[T], Tuple[M, Mapper]]
 
 
 _model_mappers: MapToModel = {}
+# registered type that is used for the type, filled on the first use
+_resolved: Dict[Type[Any], Optional[Type[Any]]] = {}
 
 
 def model_mapper(type: Type[T], to_type: Type[M]) -> Callable[[Mapper], Mapper]:
     def inner(f: Mapper) -> Mapper:
         _model_mappers[type] = (to_type, f)
+        # the new mapper may be closer to some of the already resolved types
+        _resolved.clear()
         return f
 
     return inner
 
 
 def get_mapped_type(type: Type[Any]) -> Optional[Type[Any]]:
-    intersection = _model_mappers.keys() & type.__mro__
-    if len(intersection) == 0:
-        return None
-    elif len(intersection) == 1:
-        return intersection.pop()
-    else:
-        assert False, "Not Implemented yet"
+    """
+    Returns the registered type that is the closest to the type in its mro,
+    so a mapper of a subclass wins over the mapper of its base class.
+    """
+
+    try:
+        return _resolved[type]
+    except KeyError:
+        pass
+
+    mapped = next((base for base in type.__mro__ if base in _model_mappers), None)
+    _resolved[type] = mapped
+    return mapped
 
 
 def optional_map_model(obj: Any, recursive: bool) -> Optional[Dict[str, Any]]:
@@ -49,3 +59,11 @@ def map_model(obj: Any, recursive: bool = False) -> Dict[str, Any]:
     if result is None:
         raise KeyError(f"No mapping found for type {type(obj)}")
     return result
+
+
+def map_models(objs: Iterable[Any], recursive: bool = False) -> List[Dict[str, Any]]:
+    """
+    Same as map_model for every object, for bulk imports.
+    """
+
+    return [map_model(obj, recursive) for obj in objs]
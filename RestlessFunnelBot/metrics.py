@@ -0,0 +1,252 @@
+"""
+Counters, gauges and histograms of the pipeline stages
+---
+Nothing is measured until enable() is called, then
+the values can be served in the prometheus text format by running().
+"""
+
+from bisect import bisect_left
+from contextlib import asynccontextmanager, nullcontext
+from time import perf_counter
+from typing import (
+    Any,
+    AsyncGenerator,
+    Callable,
+    ContextManager,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+Labels = Tuple[str, ...]
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)  # fmt: skip
+
+enabled = False
+
+
+def enable() -> None:
+    global enabled
+    enabled = True
+
+
+def disable() -> None:
+    global enabled
+    enabled = False
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ""
+    pairs = (f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    name: str
+    help: str
+    label_names: Labels
+
+    def __init__(self, name: str, help: str, label_names: Labels = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        registry.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(header + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    values: Dict[Labels, float]
+
+    def __init__(self, name: str, help: str, label_names: Labels = ()) -> None:
+        super().__init__(name, help, label_names)
+        self.values = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        if enabled:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {value}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Gauge(Metric):
+    """
+    Value that is read by the function when the metrics are rendered,
+    so it costs nothing in between.
+    """
+
+    kind = "gauge"
+
+    function: Callable[[], Dict[Labels, float]]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Labels,
+        function: Callable[[], Dict[Labels, float]],
+    ) -> None:
+        super().__init__(name, help, label_names)
+        self.function = function
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {value}"
+            for labels, value in self.function().items()
+        ]
+
+
+class _Timer:
+    __slots__ = "histogram", "labels", "start"
+
+    def __init__(self, histogram: "Histogram", labels: Labels) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> None:
+        self.start = perf_counter()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.histogram.observe(perf_counter() - self.start, *self.labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    buckets: Sequence[float]
+    # counts of the buckets, sum and count for every labels
+    values: Dict[Labels, Tuple[List[int], List[float]]]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Labels = (),
+        buckets: Sequence[float] = BUCKETS,
+    ) -> None:
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = entry
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def observe_since(self, start: float, *labels: str) -> None:
+        """
+        Observes the seconds since start, a perf_counter() value.
+        """
+
+        if enabled:
+            self.observe(perf_counter() - start, *labels)
+
+    def time(self, *labels: str) -> ContextManager[None]:
+        if not enabled:
+            return _NOTHING
+        return _Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                bucket_labels = _format_labels(
+                    self.label_names + ("le",), labels + (str(bound),)
+                )
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {total[0]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+_NOTHING: ContextManager[None] = nullcontext()
+registry: List[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "restless_stage_seconds", "Time spent in each stage of the pipeline", ("stage",)
+)
+# kind is "private" for the commands and "public" for the chat messages
+MESSAGES = Counter(
+    "restless_messages_total", "Received messages", ("platform", "kind")
+)
+# till a public message is queued for writing, or a command starts
+DISPATCH_WAIT = Histogram(
+    "restless_dispatch_wait_seconds",
+    "Time from dispatching a message till it is taken",
+    ("platform", "kind"),
+)
+COMMANDS = Counter("restless_commands_total", "Handled commands", ("command",))
+SENT = Counter("restless_sent_total", "Sent messages", ("platform",))
+RETRIES = Counter(
+    "restless_send_retries_total", "Sends that were asked to slow down", ("platform",)
+)
+
+
+def stage(name: str) -> ContextManager[None]:
+    """
+    Measures the time of the with block as the stage with this name.
+    """
+
+    if not enabled:
+        return _NOTHING
+    return _Timer(STAGE_SECONDS, (name,))
+
+
+@asynccontextmanager
+async def running(host: str, port: Optional[int]) -> AsyncGenerator[None, None]:
+    """
+    Serves the metrics at http://host:port/metrics, does nothing if port is 0.
+    """
+
+    if not port:
+        yield
+        return
+
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    enable()
+    print(f"Metrics: http://{host}:{port}/metrics")
+    try:
+        yield
+    finally:
+        disable()
+        await runner.cleanup()
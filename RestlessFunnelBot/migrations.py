@@ -0,0 +1,210 @@
+"""
+Brings already existing databases up to date with the models
+"""
+
+import json
+from typing import Any, List, Optional, Sequence, Tuple
+
+from sqlalchemy import and_, bindparam, delete, exists, func, inspect, select, text
+from sqlalchemy import update
+from sqlalchemy.engine import Connection
+from sqlmodel import SQLModel
+
+from . import search
+from .models import Chat, ConnectionChat, Message, User, UserChat, insert_for
+
+# column that points to the merged rows, and the other column
+# of the primary key, if the column is a part of one
+Reference = Tuple[Any, str, Optional[str]]
+
+
+def create_missing_indexes(conn: Connection) -> None:
+    # create_all does not add new indexes to already existing tables
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+# indexes that are covered by newer ones
+REPLACED_INDEXES = ("ix_message_chat_id",)
+
+
+def drop_replaced_indexes(conn: Connection) -> None:
+    for name in REPLACED_INDEXES:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+def _load_chats(value: Any) -> List[int]:
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value or []
+
+
+def migrate_chat_lists(conn: Connection) -> None:
+    # chats used to be stored as json lists in the "chats" columns
+    memberships = [
+        ("user", "user_id", UserChat),
+        ("connecteduser", "connection_id", ConnectionChat),
+    ]
+    inspector = inspect(conn)
+
+    for table, key, model in memberships:
+        columns = {column["name"] for column in inspector.get_columns(table)}
+        if "chats" not in columns:
+            continue
+
+        rows = [
+            {key: id, "chat_id": chat_id}
+            for id, chats in conn.execute(text(f'SELECT id, chats FROM "{table}"'))
+            for chat_id in _load_chats(chats)
+        ]
+        if rows:
+            statement = insert_for(conn.dialect.name, model)
+            conn.execute(statement.on_conflict_do_nothing(), rows)
+        conn.execute(text(f'ALTER TABLE "{table}" DROP COLUMN chats'))
+
+
+def has_index(conn: Connection, table: str, name: str) -> bool:
+    return any(index["name"] == name for index in inspect(conn).get_indexes(table))
+
+
+def merge_duplicates(
+    conn: Connection, model: Any, carried: Sequence[str], references: List[Reference]
+) -> bool:
+    """
+    Older versions could store the same object several times. The row with
+    the lowest id of every natural key is kept, it gets the carried columns
+    of the newest row, and everything that pointed to the others points to it.
+    Returns if there were duplicates.
+    """
+
+    table = model.__table__
+    if has_index(conn, table.name, f"ix_{table.name}_natural_key"):
+        return False
+
+    keys = [table.c[name] for name in model.natural_key]
+    groups = (
+        select(
+            *keys,
+            func.min(table.c.id).label("keep"),
+            func.max(table.c.id).label("newest"),
+        )
+        .group_by(*keys)
+        .having(func.count() > 1)
+        .subquery()
+    )
+    same_key = and_(*(table.c[name] == groups.c[name] for name in model.natural_key))
+    selection = (
+        select(table.c.id, groups.c.keep, groups.c.newest)
+        .join(groups, same_key)
+        .filter(table.c.id != groups.c.keep)
+    )
+    rows = conn.execute(selection).all()
+    if not rows:
+        return False
+
+    pairs = [dict(duplicate=id, keeper=keep) for id, keep, _ in rows]
+    groups_ids = {(keep, new) for _, keep, new in rows}
+    newest = [dict(keeper=keep, newest=new) for keep, new in groups_ids]
+    for name in carried:
+        value = select(table.c[name]).filter(table.c.id == bindparam("newest"))
+        statement = update(table).filter(table.c.id == bindparam("keeper"))
+        conn.execute(statement.values({name: value.scalar_subquery()}), newest)
+
+    for referencing, column, other in references:
+        source = referencing.c[column]
+        statement = update(referencing).filter(source == bindparam("duplicate"))
+        if other is not None:
+            # the keeper could have the same row already
+            existing = referencing.alias()
+            statement = statement.filter(
+                ~exists().where(
+                    and_(
+                        existing.c[column] == bindparam("keeper"),
+                        existing.c[other] == referencing.c[other],
+                    )
+                )
+            )
+        conn.execute(statement.values({column: bindparam("keeper")}), pairs)
+        if other is not None:
+            leftovers = delete(referencing).filter(source == bindparam("duplicate"))
+            conn.execute(leftovers, pairs)
+
+    conn.execute(delete(table).filter(table.c.id == bindparam("duplicate")), pairs)
+    return True
+
+
+def merge_all_duplicates(conn: Connection) -> None:
+    # has to go before the unique indexes are created
+    message, user_chat = Message.__table__, UserChat.__table__  # type: ignore
+    connection_chat = ConnectionChat.__table__  # type: ignore
+    merge_duplicates(
+        conn,
+        Chat,
+        ["name"],
+        [
+            (message, "chat_id", None),
+            (user_chat, "chat_id", "user_id"),
+            (connection_chat, "chat_id", "connection_id"),
+        ],
+    )
+    users_merged = merge_duplicates(
+        conn,
+        User,
+        [],
+        [(message, "author_id", None), (user_chat, "user_id", "chat_id")],
+    )
+    if users_merged:
+        # the connections of the kept users get the chats of the merged ones
+        user = User.__table__  # type: ignore
+        selection = (
+            select(user.c.connection_id, user_chat.c.chat_id)
+            .join(user, user.c.id == user_chat.c.user_id)
+            .distinct()
+        )
+        statement = insert_for(conn.dialect.name, ConnectionChat).from_select(
+            ["connection_id", "chat_id"], selection
+        )
+        conn.execute(statement.on_conflict_do_nothing())
+    # messages of the merged chats could be duplicates now
+    merge_duplicates(conn, Message, ["text", "timestamp"], [])
+
+
+def add_message_autoincrement(conn: Connection) -> None:
+    # without AUTOINCREMENT sqlite gives out the ids of the deleted newest
+    # messages again, it can't be added to a table, so the table is copied
+    if conn.dialect.name != "sqlite":
+        return
+    schema = conn.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'message'")
+    ).scalar_one()
+    if "AUTOINCREMENT" in schema.upper():
+        return
+
+    # the triggers of the full-text index go with the renamed table,
+    # and are created again by search.create_index
+    conn.execute(text("ALTER TABLE message RENAME TO message_old"))
+    indexes = conn.execute(
+        text(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+            " AND tbl_name = 'message_old' AND sql IS NOT NULL"
+        )
+    ).scalars()
+    for name in indexes.all():
+        conn.execute(text(f'DROP INDEX "{name}"'))
+    table = Message.__table__  # type: ignore[attr-defined]
+    table.create(conn)
+    columns = ", ".join(f'"{column.name}"' for column in table.columns)
+    conn.execute(
+        text(f"INSERT INTO message ({columns}) SELECT {columns} FROM message_old")
+    )
+    conn.execute(text("DROP TABLE message_old"))
+
+
+def migrate(conn: Connection) -> None:
+    migrate_chat_lists(conn)
+    merge_all_duplicates(conn)
+    add_message_autoincrement(conn)
+    create_missing_indexes(conn)
+    drop_replaced_indexes(conn)
+    search.create_index(conn)
@@ -1,13 +1,14 @@
 from __future__ import annotations
 
-from bisect import bisect
 from datetime import datetime, timedelta, timezone
 from enum import Enum
-from typing import Any, List, Optional, cast
+from typing import Any, ClassVar, Optional, Tuple, cast
 
+from sqlalchemy import BigInteger
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.sql.elements import ColumnClause
-from sqlalchemy.sql.schema import Column
-from sqlmodel import JSON, Field, Relationship, SQLModel
+from sqlalchemy.sql.schema import Column, Index
+from sqlmodel import Field, Relationship, SQLModel
 
 
 # instead of sqlmodel.col()
@@ -16,6 +17,13 @@ def col(attr: Any) -> ColumnClause:
     return cast(ColumnClause, attr)
 
 
+# dialect specific insert, it supports "ON CONFLICT"
+def insert_for(dialect: str, model: Any) -> Any:
+    if dialect == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
 TZ_UTC = timezone.utc
 TZ_MOSCOW = timezone(timedelta(hours=3))
 
@@ -44,11 +52,31 @@ class BaseModel(SQLModel):
 
 
 class PlatformModel(BaseModel):
-    target_id: int
+    # platform ids (telegram chats for example) do not fit into 32 bits
+    target_id: int = Field(sa_column=Column(BigInteger, nullable=False))
     platform: Platform
 
+    # columns that identify the object on its platform,
+    # each table has a unique index over them
+    natural_key: ClassVar[Tuple[str, ...]] = ("platform", "target_id")
+
+
+def natural_key_index(table: str, *columns: str) -> Index:
+    return Index(f"ix_{table}_natural_key", *columns, unique=True)
+
 
 class Message(PlatformModel, table=True):
+    __table_args__ = (
+        natural_key_index("message", "platform", "chat_id", "target_id"),
+        # keyset pagination goes in (timestamp, id) order
+        Index("ix_message_timestamp_id", "timestamp", "id"),
+        # unread messages of a chat are a range of ids after the read cursor
+        Index("ix_message_chat_id_id", "chat_id", "id"),
+        # archiving deletes messages, their ids must not be given out again
+        {"sqlite_autoincrement": True},
+    )
+    natural_key: ClassVar[Tuple[str, ...]] = ("platform", "chat_id", "target_id")
+
     text: str
     timestamp: datetime
     author_id: int = Field(foreign_key="user.id")
@@ -61,6 +89,8 @@ NAME_SEPARATOR = chr(1)
 
 
 class Chat(PlatformModel, table=True):
+    __table_args__ = (natural_key_index("chat", "platform", "target_id"),)
+
     name: str
 
     @staticmethod
@@ -71,31 +101,60 @@ class Chat(PlatformModel, table=True):
         return self.name.replace(NAME_SEPARATOR, sep)
 
 
-def _unique_append(lst: List[int], item: int) -> List[int]:
-    ind = bisect(lst, item)
-    if not (ind > 0 and lst[ind - 1] == item):
-        # otherwise list is not updated in the db
-        lst = list(lst)
-        lst.insert(ind, item)
-    return lst
-
-
 class User(PlatformModel, table=True):
-    chats: List[int] = Field(default_factory=list, sa_column=Column(JSON))
-    connection_id: int = Field(foreign_key="connecteduser.id")
-    connection: ConnectedUser = Relationship()
+    __table_args__ = (natural_key_index("user", "platform", "target_id"),)
 
-    def add_chat(self, chat: Chat) -> None:
-        assert chat.id is not None
-        self.chats = _unique_append(self.chats, chat.id)
-        self.connection.chats = _unique_append(self.connection.chats, chat.id)
+    connection_id: int = Field(foreign_key="connecteduser.id", index=True)
+    connection: ConnectedUser = Relationship()
 
 
 class ConnectedUser(BaseModel, table=True):
-    chats: List[int] = Field(default_factory=list, sa_column=Column(JSON))
+    pass
 
-    def add_chats_from(self, other: ConnectedUser) -> None:
-        self.chats = sorted(set(self.chats).union(other.chats))
+
+# memberships are indexed in both directions,
+# by the primary key and by the reversed index
+class UserChat(SQLModel, table=True):
+    __table_args__ = (Index("ix_userchat_chat_id", "chat_id", "user_id"),)
+
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    chat_id: int = Field(foreign_key="chat.id", primary_key=True)
+
+
+class ConnectionChat(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_connectionchat_chat_id", "chat_id", "connection_id"),
+    )
+
+    connection_id: int = Field(foreign_key="connecteduser.id", primary_key=True)
+    chat_id: int = Field(foreign_key="chat.id", primary_key=True)
+
+
+# the last message of the chat that was shown by /new,
+# ids grow in the order in which the messages were written
+class ReadCursor(SQLModel, table=True):
+    connection_id: int = Field(foreign_key="connecteduser.id", primary_key=True)
+    chat_id: int = Field(foreign_key="chat.id", primary_key=True)
+    last_id: int
+
+
+# old messages are moved out of the message table into archive files,
+# every file has messages of one chat from first to last (timestamp, id)
+class Segment(BaseModel, table=True):
+    __table_args__ = (
+        Index("ix_segment_chat_id_last", "chat_id", "last_timestamp", "last_id"),
+    )
+
+    chat_id: int = Field(foreign_key="chat.id")
+    first_timestamp: datetime
+    first_id: int
+    last_timestamp: datetime
+    last_id: int
+    count: int
+    # relative to the archive directory
+    path: str
+    # bloom filter of the words of the messages, see archive.word_filter
+    words: Optional[bytes] = None
 
 
 Message.update_forward_refs()
@@ -0,0 +1,237 @@
+"""
+Outgoing messages
+---
+Replies are queued and sent by separate tasks,
+so waiting for the rate limits of a platform
+does not hold up the handling of incoming messages.
+"""
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+)
+
+from .ingest import KeyedLock, TaskSet
+from .metrics import RETRIES, SENT, stage
+from .ttldict import TTLDict
+
+SendFunc = Callable[[Any, str, bool, bool], Awaitable[None]]
+
+logger = logging.getLogger(__name__)
+
+
+class RetryAfter(Exception):
+    """
+    Raised by the send functions when the platform asks to slow down,
+    delay is how many seconds to wait if the platform told it.
+    """
+
+    delay: Optional[float]
+
+    def __init__(self, delay: Optional[float] = None) -> None:
+        super().__init__(delay)
+        self.delay = delay
+
+
+class RateLimit(NamedTuple):
+    # messages per second on average
+    rate: float
+    # messages that can be sent at once
+    burst: int
+
+
+class TokenBucket:
+    __slots__ = "rate", "capacity", "tokens", "updated"
+
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
+
+    def __init__(self, limit: RateLimit) -> None:
+        self.rate = limit.rate
+        self.capacity = limit.burst
+        self.tokens = limit.burst
+        self.updated = monotonic()
+
+    def reserve(self) -> float:
+        """
+        Takes a token and returns how many seconds to wait for it,
+        the tokens are taken in the order of the calls.
+        """
+
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    async def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Outbox:
+    """
+    Sends the queued messages in the order they were queued
+    for every chat, respecting the rate limits of the platform
+    and of the chat, and retrying when the platform asks to slow down.
+    ---
+    Every message waits in its own task, so a chat that waits for its limits
+    or for a retry does not hold up the others. At most `workers` messages
+    are being sent at once.
+    """
+
+    workers: int
+    retries: int
+    backoff: float
+    limits: Dict[Type[Any], Tuple[Optional[RateLimit], Optional[RateLimit]]]
+    # metrics label of the platform which messages have the type
+    platforms: Dict[Type[Any], str]
+
+    def __init__(
+        self,
+        workers: int,
+        max_size: int = 0,
+        retries: int = 3,
+        backoff: float = 1.0,
+        chat_ttl: float = 60,
+    ) -> None:
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.limits = {}
+        self.platforms = {}
+        self._tasks = TaskSet(max_size)
+        self._chat_locks: KeyedLock[Tuple[Type[Any], Hashable]] = KeyedLock()
+        self._sending: Optional[asyncio.Semaphore] = None
+        self._buckets: Dict[Type[Any], TokenBucket] = {}
+        # buckets of the chats that were not used for a while are dropped
+        self._chat_buckets: TTLDict[Hashable, TokenBucket] = TTLDict(chat_ttl)
+
+    def limit(
+        self,
+        type: Type[Any],
+        platform: str,
+        limit: Optional[RateLimit] = None,
+        chat_limit: Optional[RateLimit] = None,
+    ) -> None:
+        """
+        Sets the platform which messages have this type and its rate limits,
+        None means that there is no limit.
+        """
+
+        self.platforms[type] = platform
+        self.limits[type] = limit, chat_limit
+        self._buckets.pop(type, None)
+
+    @property
+    def depth(self) -> int:
+        return len(self._tasks)
+
+    async def put(
+        self,
+        chat: Hashable,
+        send: SendFunc,
+        target: Any,
+        text: str,
+        mention: bool = False,
+        raw: bool = False,
+        on_give_up: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        Queues the message, it is sent later in reply to the target,
+        on_give_up is called if it is never sent.
+        """
+
+        key = (type(target), chat)
+        args = key, send, target, text, mention, raw, on_give_up
+        await self._tasks.submit(self._deliver, *args)
+
+    async def _wait_for_limits(self, key: Tuple[Type[Any], Hashable]) -> None:
+        limit, chat_limit = self.limits.get(key[0], (None, None))
+        if chat_limit is not None:
+            bucket = self._chat_buckets.get(key) or TokenBucket(chat_limit)
+            # set again, so the bucket of an active chat does not expire
+            self._chat_buckets[key] = bucket
+            await bucket.acquire()
+        if limit is not None:
+            platform_bucket = self._buckets.get(key[0])
+            if platform_bucket is None:
+                platform_bucket = self._buckets[key[0]] = TokenBucket(limit)
+            await platform_bucket.acquire()
+
+    async def _deliver(
+        self,
+        key: Tuple[Type[Any], Hashable],
+        send: SendFunc,
+        target: Any,
+        text: str,
+        mention: bool,
+        raw: bool,
+        on_give_up: Optional[Callable[[], None]],
+    ) -> None:
+        if self._sending is None:
+            # created here, so it is bound to the running loop
+            self._sending = asyncio.Semaphore(self.workers)
+        platform = self.platforms.get(key[0], "unknown")
+        sent = False
+        try:
+            # the messages of a chat wait for each other, the others don't
+            async with self._chat_locks(key):
+                for attempt in range(self.retries + 1):
+                    await self._wait_for_limits(key)
+                    try:
+                        async with self._sending:
+                            with stage("send"):
+                                await send(target, text, mention, raw)
+                        SENT.inc(platform)
+                        sent = True
+                        return
+                    except RetryAfter as e:
+                        RETRIES.inc(platform)
+                        if attempt == self.retries:
+                            raise
+                        delay = e.delay
+                        if delay is None:
+                            delay = self.backoff * 2**attempt
+                        logger.warning(
+                            "Asked to slow down, retrying in %.1f s", delay
+                        )
+                        await asyncio.sleep(delay)
+        finally:
+            if not sent and on_give_up is not None:
+                on_give_up()
+
+    def expire(self) -> None:
+        self._chat_buckets.expire()
+
+    async def stop(self) -> None:
+        await self._tasks.stop()
+        # the next start may happen in another loop
+        self._sending = None
+
+    async def join(self) -> None:
+        await self._tasks.join()
+
+    @asynccontextmanager
+    async def running(self) -> AsyncGenerator["Outbox", None]:
+        try:
+            yield self
+        finally:
+            await self.stop()
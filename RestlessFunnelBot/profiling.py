@@ -0,0 +1,163 @@
+"""
+Accounting of the SQL statements of every handled message
+---
+Turned on by options.PROFILE_QUERIES, the statements are counted
+and timed with the engine events and attributed to the message
+that is handled in the current context. Messages that run more
+statements than options.QUERY_BUDGET are logged with a warning.
+"""
+
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from heapq import heappush, heappushpop
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import options
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    __slots__ = "name", "messages", "count", "time", "slowest"
+
+    name: str
+    # how many messages are handled together, like in a batch
+    messages: int
+    count: int
+    # seconds
+    time: float
+    # min-heap of (seconds, statement)
+    slowest: List[Tuple[float, str]]
+
+    def __init__(self, name: str, messages: int = 1) -> None:
+        self.name = name
+        self.messages = messages
+        self.count = 0
+        self.time = 0.0
+        self.slowest = []
+
+    def add(self, statement: str, seconds: float) -> None:
+        self.count += 1
+        self.time += seconds
+        item = (seconds, statement)
+        if len(self.slowest) < options.QUERY_SLOWEST:
+            heappush(self.slowest, item)
+        else:
+            heappushpop(self.slowest, item)
+
+    @property
+    def over_budget(self) -> bool:
+        return self.count > options.QUERY_BUDGET * self.messages
+
+    def describe(self) -> str:
+        lines = [
+            f"{self.name}: {self.count} statements for {self.messages} messages, "
+            f"{self.time * 1000:.1f} ms"
+        ]
+        for seconds, statement in sorted(self.slowest, reverse=True):
+            lines.append(f"  {seconds * 1000:.1f} ms: {' '.join(statement.split())}")
+        return "\n".join(lines)
+
+
+class Totals:
+    __slots__ = "messages", "count", "time", "over_budget"
+
+    def __init__(self) -> None:
+        self.messages = 0
+        self.count = 0
+        self.time = 0.0
+        self.over_budget = 0
+
+
+current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+# statistics of everything that was profiled, by name
+totals: Dict[str, Totals] = {}
+_listening = False
+
+
+def _before_execute(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+    conn.info.setdefault("query_start", []).append(perf_counter())
+
+
+def _after_execute(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+    seconds = perf_counter() - conn.info["query_start"].pop()
+    stats = current.get()
+    if stats is not None:
+        stats.add(statement, seconds)
+
+
+def enable() -> None:
+    global _listening
+    if not _listening:
+        # applies to every engine, including the ones created later
+        event.listen(Engine, "before_cursor_execute", _before_execute)
+        event.listen(Engine, "after_cursor_execute", _after_execute)
+        _listening = True
+
+
+def disable() -> None:
+    global _listening
+    if _listening:
+        event.remove(Engine, "before_cursor_execute", _before_execute)
+        event.remove(Engine, "after_cursor_execute", _after_execute)
+        _listening = False
+
+
+def rename(name: str) -> None:
+    """
+    Gives a more specific name to the message that is being profiled.
+    """
+
+    stats = current.get()
+    if stats is not None:
+        stats.name = name
+
+
+@contextmanager
+def profile(name: str, messages: int = 1) -> Iterator[Optional[QueryStats]]:
+    """
+    Attributes the statements run inside of the block to this name.
+    """
+
+    if not _listening:
+        yield None
+        return
+
+    stats = QueryStats(name, messages)
+    token = current.set(stats)
+    try:
+        yield stats
+    finally:
+        current.reset(token)
+        record(stats)
+
+
+def record(stats: QueryStats) -> None:
+    total = totals.get(stats.name)
+    if total is None:
+        total = totals[stats.name] = Totals()
+    total.messages += stats.messages
+    total.count += stats.count
+    total.time += stats.time
+
+    if stats.over_budget:
+        total.over_budget += 1
+        logger.warning("Query budget exceeded by %s", stats.describe())
+    else:
+        logger.debug("%s", stats.describe())
+
+
+def report() -> str:
+    lines = []
+    for name, total in sorted(totals.items()):
+        lines.append(
+            f"{name}: {total.count / total.messages:.1f} statements "
+            f"and {total.time / total.messages * 1000:.2f} ms per message, "
+            f"{total.over_budget} over the budget"
+        )
+    return "\n".join(lines)
@@ -4,9 +4,29 @@ and also enables debugging if this file is run as the main
 """
 
 import asyncio
+from contextlib import asynccontextmanager
+from importlib import import_module
+from time import perf_counter
+from types import ModuleType
+from typing import AsyncGenerator, Dict, Iterable, List, Optional
 
-from RestlessFunnelBot import discord_bot, options, telegram_bot, vk_bot
+from RestlessFunnelBot import metrics, options
+from RestlessFunnelBot.archive import retention
+from RestlessFunnelBot.bot import bot
+from RestlessFunnelBot.common import dispatcher, ingestor, sweeper
 from RestlessFunnelBot.database import db_tables
+from RestlessFunnelBot.models import Platform
+
+# imported only when the platform is run, each one pulls in its sdk
+PLATFORM_MODULES: Dict[Platform, str] = {
+    Platform.VK: "RestlessFunnelBot.vk_bot",
+    Platform.DISCORD: "RestlessFunnelBot.discord_bot",
+    Platform.TELEGRAM: "RestlessFunnelBot.telegram_bot",
+}
+
+
+def load_platforms(platforms: Iterable[Platform]) -> List[ModuleType]:
+    return [import_module(PLATFORM_MODULES[platform]) for platform in platforms]
 
 
 async def _close_all_aiohttp_clients():
@@ -19,22 +39,47 @@ async def _close_all_aiohttp_clients():
             await obj.close()
 
 
-async def run_all() -> None:
+@asynccontextmanager
+async def serving() -> AsyncGenerator[None, None]:
+    """
+    Runs the database and the workers that handle the messages.
+    """
+
+    metrics_server = metrics.running(options.METRICS_HOST, options.METRICS_PORT)
+    async with metrics_server, db_tables(), ingestor.running():
+        # stopped in reverse, so the queued messages still get to
+        # the ingestor and the replies to them still get sent
+        async with bot.outbox.running(), dispatcher.running(), sweeper.running():
+            async with retention.running():
+                yield
+
+
+async def run_all(platforms: Optional[Iterable[Platform]] = None) -> None:
+    if platforms is None:
+        platforms = [Platform(name) for name in options.PLATFORMS]
+    platforms = list(dict.fromkeys(platforms))
+
+    started = perf_counter()
+    modules = load_platforms(platforms)
+    load_time = perf_counter() - started
+
     try:
-        async with db_tables():
-            await asyncio.gather(
-                vk_bot.run(),
-                discord_bot.run(),
-                telegram_bot.run(),
+        async with serving():
+            ready_time = perf_counter() - started - load_time
+            names = ", ".join(platform.value for platform in platforms)
+            print(
+                f"Startup: {names} imported in {load_time:.2f}s, "
+                f"ready in {ready_time:.2f}s"
             )
+            await asyncio.gather(*(module.run() for module in modules))
     except (KeyboardInterrupt, asyncio.CancelledError):
         print("Exiting ...")
     finally:
         await _close_all_aiohttp_clients()
 
 
-def run_all_sync() -> None:
-    asyncio.run(run_all())
+def run_all_sync(platforms: Optional[Iterable[Platform]] = None) -> None:
+    asyncio.run(run_all(platforms))
 
 
 run = run_all_sync
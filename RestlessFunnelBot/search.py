@@ -0,0 +1,110 @@
+"""
+Full-text index over the message texts
+---
+SQLite uses an external content FTS5 table kept in sync by triggers,
+PostgreSQL uses a GIN index over the text search vector.
+"""
+
+from typing import Any
+
+from sqlalchemy import DDL, column, event, func, literal_column, table, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import Select
+from sqlmodel import select
+
+from .models import Message, col
+
+FTS_TABLE = "message_fts"
+TS_CONFIG = "simple"
+
+message_fts = table(FTS_TABLE, column("rowid"))
+
+SQLITE_INDEX = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        text, content='message', content_rowid='id'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON message BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text)
+        VALUES ('delete', old.id, old.text);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update
+    AFTER UPDATE OF text ON message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text)
+        VALUES ('delete', old.id, old.text);
+        INSERT INTO {FTS_TABLE}(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+]
+
+POSTGRES_INDEX = [
+    f"""
+    CREATE INDEX IF NOT EXISTS ix_message_text_search
+    ON message USING gin (to_tsvector('{TS_CONFIG}', text))
+    """,
+]
+
+# triggers are dropped together with the message table, but the index is not
+event.listen(
+    Message.__table__,  # type: ignore[attr-defined]
+    "before_drop",
+    DDL(f"DROP TABLE IF EXISTS {FTS_TABLE}").execute_if(dialect="sqlite"),
+)
+
+
+def create_index(conn: Connection) -> None:
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+            dict(name=FTS_TABLE),
+        ).first()
+        for statement in SQLITE_INDEX:
+            conn.execute(text(statement))
+        if exists is None:
+            # index the messages that were stored before
+            conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    elif dialect == "postgresql":
+        for statement in POSTGRES_INDEX:
+            conn.execute(text(statement))
+
+
+def sqlite_query(query: str) -> str:
+    # every word is quoted, so the user can't break the fts5 query syntax
+    words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+    return " ".join(words)
+
+
+def search_messages(dialect: str, query: str, *args: Any) -> Select:
+    """
+    Selects the messages that contain all of the words of the query,
+    the most relevant ones go first.
+    """
+
+    if dialect == "sqlite":
+        match = literal_column(FTS_TABLE).op("MATCH")(sqlite_query(query))
+        return (
+            select(Message)
+            .join(message_fts, message_fts.c.rowid == col(Message.id))
+            .filter(match, *args)
+            .order_by(literal_column("rank"), col(Message.id).desc())
+        )
+
+    # same expression as in the index, otherwise the index is not used
+    config = literal_column(f"'{TS_CONFIG}'::regconfig")
+    vector = func.to_tsvector(config, col(Message.text))
+    ts_query = func.plainto_tsquery(config, query)
+    return (
+        select(Message)
+        .filter(vector.op("@@")(ts_query), *args)
+        .order_by(func.ts_rank(vector, ts_query).desc(), col(Message.id).desc())
+    )
@@ -0,0 +1,414 @@
+"""
+Running the platforms in separate processes
+---
+Every platform, or every shard of discord, runs in its own process
+and hands the mapped messages to a single writer process that owns
+the database. The replies go back to the process of the platform,
+which sends them. Processes that crash are started again.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import tempfile
+import time
+from importlib import import_module
+from itertools import count
+from multiprocessing.process import BaseProcess
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    Hashable,
+    Iterable,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+)
+
+from . import common, options
+from .bot import bot
+from .common import Incoming, dispatch_incoming
+from .models import Platform
+from .run import PLATFORM_MODULES, serving
+from .ttldict import TTLDict
+
+logger = logging.getLogger(__name__)
+
+# multiprocessing queues have no public type
+Queue = Any
+# module of the platform and the options that are changed for its process
+Worker = Tuple[str, Dict[str, Any]]
+RequestId = Tuple[int, int]
+
+# strings, so they are still equal after going through a queue
+# to the platforms: stop receiving messages, to the writer: finish and exit
+STOP = "stop"
+# to the platforms: the writer exited, exit after sending the replies
+DONE = "done"
+
+# seconds between the checks of the processes
+CHECK_INTERVAL = 0.5
+# seconds a thread waits for a queue before checking if it was cancelled
+POLL_INTERVAL = 0.1
+
+
+class Request(NamedTuple):
+    worker: str
+    # unique across the restarts of the process of the platform
+    id: RequestId
+    incoming: Incoming
+    is_private: bool
+    # the longest text and the largest file that the platform accepts
+    max_length: int
+    max_file_size: int
+
+
+class Reply(NamedTuple):
+    id: RequestId
+    # path of the file if there is a name
+    text: str
+    mention: bool
+    raw: bool
+    name: Optional[str] = None
+
+
+async def get(source: Queue) -> Any:
+    # the thread gives up regularly, so the loop is not held when cancelled
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            return await loop.run_in_executor(None, source.get, True, POLL_INTERVAL)
+        except queue.Empty:
+            pass
+
+
+class RemoteMessage:
+    """
+    Stands in the writer for the message that is in the process of its platform.
+    """
+
+    __slots__ = "worker", "id"
+
+    worker: str
+    id: RequestId
+
+    def __init__(self, worker: str, id: RequestId) -> None:
+        self.worker = worker
+        self.id = id
+
+
+# queues of the replies to the platforms, by the names of their processes
+reply_queues: Dict[str, Queue] = {}
+# the limits are looked up by the type of the message, so there is one type
+# per platform, the longest text and the largest file
+remote_types: Dict[Tuple[Platform, int, int], Type[RemoteMessage]] = {}
+
+
+async def send_reply(msg: RemoteMessage, text: str, mention: bool, raw: bool) -> None:
+    reply_queues[msg.worker].put(Reply(msg.id, text, mention, raw))
+
+
+async def send_file_reply(msg: RemoteMessage, path: Path, name: str) -> None:
+    # renamed, so it is not removed here, the process of the platform does it
+    descriptor, handed = tempfile.mkstemp(suffix=path.suffix)
+    os.close(descriptor)
+    os.replace(path, handed)
+    reply_queues[msg.worker].put(Reply(msg.id, handed, False, False, name))
+
+
+def remote_type(
+    platform: Platform, max_length: int, max_file_size: int
+) -> Type[RemoteMessage]:
+    key = platform, max_length, max_file_size
+    result = remote_types.get(key)
+    if result is None:
+        name = f"RemoteMessage_{platform.value}_{max_length}_{max_file_size}"
+        result = type(name, (RemoteMessage,), {"__slots__": ()})
+        # the process of the platform respects its rate limits
+        bot.send_function(result, platform, max_length)(send_reply)
+        if max_file_size:
+            bot.file_function(result, max_file_size)(send_file_reply)
+        remote_types[key] = result
+    return result
+
+
+async def run_writer(inbox: Queue, replies: Dict[str, Queue]) -> None:
+    reply_queues.update(replies)
+    async with serving():
+        while True:
+            request = await get(inbox)
+            if request == STOP:
+                break
+            incoming = request.incoming
+            message_type = remote_type(
+                incoming.platform, request.max_length, request.max_file_size
+            )
+            target = message_type(request.worker, request.id)
+            await dispatch_incoming(incoming, target, request.is_private)
+
+
+class Forwarder:
+    """
+    Hands the messages of the platform to the writer
+    and sends the replies that come back.
+    """
+
+    worker: str
+    inbox: Queue
+    stopping: bool
+    # chat and message of the commands, by the ids of their requests
+    pending: TTLDict[RequestId, Tuple[Hashable, Any]]
+
+    def __init__(self, worker: str, inbox: Queue) -> None:
+        self.worker = worker
+        self.inbox = inbox
+        self.stopping = False
+        self.pending = TTLDict(options.REPLY_TTL)
+        self._pid = os.getpid()
+        self._ids = count()
+
+    async def forward(self, incoming: Incoming, in_msg: Any, is_private: bool) -> None:
+        id = (self._pid, next(self._ids))
+        if is_private:
+            self.pending.expire()
+            self.pending[id] = incoming.chat["target_id"], in_msg
+        max_length = bot.max_lengths[type(in_msg)]
+        max_file_size = bot.max_file_sizes.get(type(in_msg), 0)
+        self.inbox.put(
+            Request(self.worker, id, incoming, is_private, max_length, max_file_size)
+        )
+
+    async def reply(self, reply: Reply) -> None:
+        entry = self.pending.get(reply.id)
+        if entry is None:
+            logger.warning("Dropped a reply that came too late to %s", self.worker)
+            return
+        chat, in_msg = entry
+        if reply.name is not None:
+            await bot.put_file(chat, in_msg, Path(reply.text), reply.name)
+            return
+        send = bot.send_functions[type(in_msg)]
+        await bot.outbox.put(chat, send, in_msg, reply.text, reply.mention, reply.raw)
+
+    async def receive(self, replies: Queue, adapter: asyncio.Task, closed: Any) -> None:
+        while True:
+            reply = await get(replies)
+            if reply == DONE:
+                return
+            if reply == STOP:
+                self.stopping = True
+                adapter.cancel()
+                await asyncio.gather(adapter, return_exceptions=True)
+                # everything that was forwarded is in the queue after that
+                self.inbox.close()
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.inbox.join_thread
+                )
+                closed.set()
+            else:
+                await self.reply(reply)
+
+
+async def run_platform(
+    worker: str, module_name: str, inbox: Queue, replies: Queue, closed: Any
+) -> None:
+    module = import_module(module_name)
+    forwarder = Forwarder(worker, inbox)
+    common.forward = forwarder.forward
+
+    async with bot.outbox.running():
+        adapter = asyncio.ensure_future(module.run())
+        receiver = asyncio.ensure_future(forwarder.receive(replies, adapter, closed))
+        await asyncio.wait({adapter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        if not forwarder.stopping and not receiver.done():
+            # the process exits with an error and is started again
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+            adapter.result()
+            raise RuntimeError(f"{worker} stopped by itself")
+        await receiver
+
+
+def child_main(
+    settings: Dict[str, Any], main: Callable[..., Coroutine[Any, Any, None]], *args: Any
+) -> None:
+    # ctrl+c reaches every process, the supervisor stops them in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name, value in settings.items():
+        setattr(options, name, value)
+    asyncio.run(main(*args))
+
+
+class Child:
+    """
+    Process that is started again when it crashes.
+    """
+
+    name: str
+    args: Tuple[Any, ...]
+    process: Optional[BaseProcess]
+    started: float
+    # crashes in a row, the delay before the restart grows with them
+    crashes: int
+    restart_at: Optional[float]
+
+    def __init__(self, name: str, *args: Any) -> None:
+        self.name = name
+        self.args = args
+        self.process = None
+        self.started = 0.0
+        self.crashes = 0
+        self.restart_at = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self, context: Any) -> None:
+        self.process = context.Process(
+            target=child_main, args=self.args, name=self.name, daemon=True
+        )
+        self.process.start()
+        self.started = time.monotonic()
+
+    def check(self, context: Any) -> None:
+        process = self.process
+        if process is None or process.is_alive():
+            return
+
+        now = time.monotonic()
+        if self.restart_at is None:
+            if now - self.started > options.RESTART_MAX_DELAY:
+                # it worked for a while, so it is not crashing in a loop
+                self.crashes = 0
+            delay = min(
+                options.RESTART_DELAY * 2**self.crashes, options.RESTART_MAX_DELAY
+            )
+            self.crashes += 1
+            self.restart_at = now + delay
+            logger.warning(
+                "%s exited with code %s, restarting in %.1f s",
+                self.name,
+                process.exitcode,
+                delay,
+            )
+        elif now >= self.restart_at:
+            self.restart_at = None
+            self.start(context)
+
+    def join(self, timeout: float) -> None:
+        if self.process is None:
+            return
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logger.warning("%s did not stop in time, killing it", self.name)
+            self.process.kill()
+            self.process.join()
+
+
+def current_settings() -> Dict[str, Any]:
+    return {name: value for name, value in vars(options).items() if name.isupper()}
+
+
+class Supervisor:
+    """
+    Runs the writer and the processes of the platforms,
+    starts them again when they crash and stops them in order:
+    the platforms stop receiving, the writer handles what is left,
+    then the platforms send the last replies.
+    """
+
+    writer: Child
+    platforms: Dict[str, Child]
+
+    def __init__(self, workers: Dict[str, Worker]) -> None:
+        # forking a process with a running loop and open connections is unsafe
+        self.context = multiprocessing.get_context("spawn")
+        self.inbox = self.context.Queue()
+        self.replies = {name: self.context.Queue() for name in workers}
+        self.closed = {name: self.context.Event() for name in workers}
+
+        settings = current_settings()
+        self.writer = Child("writer", settings, run_writer, self.inbox, self.replies)
+        self.platforms = {
+            name: Child(
+                name,
+                {**settings, **changed},
+                run_platform,
+                name,
+                module,
+                self.inbox,
+                self.replies[name],
+                self.closed[name],
+            )
+            for name, (module, changed) in workers.items()
+        }
+
+    def start(self) -> None:
+        self.writer.start(self.context)
+        for child in self.platforms.values():
+            child.start(self.context)
+        print("Processes: writer, " + ", ".join(self.platforms))
+
+    def check(self) -> None:
+        self.writer.check(self.context)
+        for child in self.platforms.values():
+            child.check(self.context)
+
+    def stop(self) -> None:
+        timeout = options.SHUTDOWN_TIMEOUT
+        running = [name for name, child in self.platforms.items() if child.alive]
+        for name in running:
+            self.replies[name].put(STOP)
+        for name in running:
+            self.closed[name].wait(timeout)
+
+        self.inbox.put(STOP)
+        self.writer.join(timeout)
+
+        for name in self.platforms:
+            self.replies[name].put(DONE)
+        for child in self.platforms.values():
+            child.join(timeout)
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, interrupt)
+        self.start()
+        try:
+            while True:
+                time.sleep(CHECK_INTERVAL)
+                self.check()
+        except KeyboardInterrupt:
+            print("Exiting ...")
+        finally:
+            self.stop()
+
+
+def interrupt(signum: int, frame: Any) -> None:
+    # stopped the same way as with ctrl+c
+    raise KeyboardInterrupt
+
+
+def platform_workers(platforms: Iterable[Platform]) -> Dict[str, Worker]:
+    workers: Dict[str, Worker] = {}
+    for platform in platforms:
+        module = PLATFORM_MODULES[platform]
+        if platform is Platform.DISCORD and options.DISCORD_SHARDS > 1:
+            for shard in range(options.DISCORD_SHARDS):
+                workers[f"discord-{shard}"] = module, dict(DISCORD_SHARD_ID=shard)
+        else:
+            workers[platform.value] = module, {}
+    return workers
+
+
+def supervise(platforms: Optional[Iterable[Platform]] = None) -> None:
+    if platforms is None:
+        platforms = [Platform(name) for name in options.PLATFORMS]
+    Supervisor(platform_workers(dict.fromkeys(platforms))).run()
@@ -1,20 +1,36 @@
+import asyncio
 import logging
-from typing import Any, Dict
+import secrets
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncGenerator, Dict
 
 from aiogram import Bot, Dispatcher, executor, utils
 from aiogram.types import Chat as TargetChat
+from aiogram.types import InputFile
 from aiogram.types import ChatType as TargetChatType
 from aiogram.types import Message as TargetMessage
 from aiogram.types import ParseMode
+from aiogram.types import Update
 from aiogram.types import User as TargetUser
+from aiogram.utils.exceptions import RetryAfter as TargetRetryAfter
+from aiogram.utils.parts import MAX_MESSAGE_LENGTH
+from aiohttp import web
 
-from . import bot_secrets
+from . import bot_secrets, options
 from .__metadata__ import BOT_NAME
 from .bot import bot as main_bot
-from .common import handle_message
+from .common import dispatch_message
 from .mappers import model_mapper
 from .models import TELEGRAM as PLATFORM
 from .models import Chat, Message, User, from_moscow_tz
+from .outbox import RateLimit, RetryAfter
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+RATE_LIMIT = RateLimit(rate=30, burst=30)
+CHAT_RATE_LIMIT = RateLimit(rate=1, burst=3)
+# https://core.telegram.org/bots/api#senddocument
+MAX_FILE_SIZE = 50 * 1024 * 1024
 
 
 @model_mapper(TargetMessage, Message)
@@ -41,7 +57,9 @@ def chat_to_model(chat: TargetChat) -> Dict[str, Any]:
     )
 
 
-@main_bot.send_function(TargetMessage)
+@main_bot.send_function(
+    TargetMessage, PLATFORM, MAX_MESSAGE_LENGTH, RATE_LIMIT, CHAT_RATE_LIMIT
+)
 async def send(msg: TargetMessage, text: str, mention: bool, raw: bool) -> None:
     parse_mode = None
     if raw:
@@ -52,10 +70,21 @@ async def send(msg: TargetMessage, text: str, mention: bool, raw: bool) -> None:
         else:
             text = f"`{text}`"
 
-    if mention:
-        await msg.reply(text, parse_mode=parse_mode)
-    else:
-        await msg.answer(text, parse_mode=parse_mode)
+    try:
+        if mention:
+            await msg.reply(text, parse_mode=parse_mode)
+        else:
+            await msg.answer(text, parse_mode=parse_mode)
+    except TargetRetryAfter as e:
+        raise RetryAfter(e.timeout) from e
+
+
+@main_bot.file_function(TargetMessage, MAX_FILE_SIZE)
+async def send_file(msg: TargetMessage, path: Path, name: str) -> None:
+    try:
+        await msg.answer_document(InputFile(path, filename=name))
+    except TargetRetryAfter as e:
+        raise RetryAfter(e.timeout) from e
 
 
 logging.basicConfig(level=logging.INFO)
@@ -67,16 +96,70 @@ dp = Dispatcher(bot=bot)
 @dp.message_handler()
 async def on_message(in_msg: TargetMessage) -> None:
     is_private = in_msg.chat.type == TargetChatType.PRIVATE
-    await handle_message(PLATFORM, in_msg, in_msg.chat, in_msg.from_user, is_private)
+    await dispatch_message(PLATFORM, in_msg, in_msg.chat, in_msg.from_user, is_private)
+
+
+# https://core.telegram.org/bots/api#setwebhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def receive_update(request: web.Request) -> web.Response:
+    secret = request.headers.get(SECRET_HEADER, "").encode()
+    if not secrets.compare_digest(secret, request.app["secret"].encode()):
+        return web.Response(status=403)
+    update = Update.to_object(await request.json())
+    # every request is handled in its own task, so updates are handled
+    # concurrently, telegram limits how many of them are in flight
+    Dispatcher.set_current(dp)
+    Bot.set_current(dp.bot)
+    await dp.process_update(update)
+    return web.Response()
+
+
+@asynccontextmanager
+async def webhook_server(
+    host: str, port: int, path: str, secret: str
+) -> AsyncGenerator[None, None]:
+    """
+    Receives the updates that telegram posts to the path.
+    """
+
+    app = web.Application()
+    app["secret"] = secret
+    app.router.add_post(path, receive_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    try:
+        yield
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook() -> None:
+    url = options.TELEGRAM_WEBHOOK_URL
+    host, port = options.TELEGRAM_WEBHOOK_HOST, options.TELEGRAM_WEBHOOK_PORT
+    path = options.TELEGRAM_WEBHOOK_PATH
+    secret = options.TELEGRAM_WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+    async with webhook_server(host, port, path, secret):
+        await bot.set_webhook(
+            url,
+            max_connections=options.TELEGRAM_WEBHOOK_CONNECTIONS,
+            secret_token=secret,
+        )
+        print(f"Telegram webhook: {url} -> http://{host}:{port}{path}")
+        # until cancelled, the webhook stays set, so nothing is lost meanwhile
+        await asyncio.get_running_loop().create_future()
 
 
 async def run() -> None:
-    # try:
-    await dp.start_polling()
-    # finally:
-    #     await dp.wait_closed()
-    #     dp.stop_polling()
-    #     await bot.close()
+    if options.TELEGRAM_WEBHOOK_URL:
+        await run_webhook()
+    else:
+        # the webhook is removed, if it was set before
+        await dp.start_polling()
 
 
 def run_sync() -> None:
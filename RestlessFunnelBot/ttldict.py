@@ -1,6 +1,13 @@
-from time import time
+import asyncio
+import inspect
+import logging
+from contextlib import asynccontextmanager
+from heapq import heapify, heappop, heappush
+from time import monotonic
 from typing import (
     Any,
+    AsyncGenerator,
+    Callable,
     Dict,
     Generic,
     Hashable,
@@ -28,7 +35,7 @@ class TTLValue(Generic[V]):
 
     def __init__(self, value: V, ttl: float) -> None:
         self.value = value
-        self.expires = time() + ttl
+        self.expires = monotonic() + ttl
 
     def __repr__(self) -> str:
         names = ["value", "expires"]
@@ -37,21 +44,40 @@ class TTLValue(Generic[V]):
 
 
 _Val = TTLValue[V]
+# (expires, order, key, value), stale entries are skipped
+_Entry = Tuple[float, int, Any, _Val]
 
 
+logger = logging.getLogger(__name__)
+
 _DEFAULT: Any = object()
+# the heap is rebuilt when it has this many times more entries than the dict
+_COMPACT_RATIO = 2
+_COMPACT_MIN = 64
 
 
 class TTLDict(Dict[K, V]):
-    __slots__ = "_ttl", "expire_count"
+    """
+    Dict whose items expire after `ttl` seconds.
+    ---
+    Expiration times are kept in a min-heap,
+    so expire() does not depend on the insertion order.
+    Times are taken from the monotonic clock.
+    """
+
+    __slots__ = "_ttl", "expire_count", "_heap", "_order"
 
     _ttl: float
     expire_count: int
+    _heap: List[_Entry]
+    _order: int
 
     def __init__(self, ttl: float, expire_count: int = -1) -> None:
         super().__init__()
         self._ttl = ttl
         self.expire_count = expire_count
+        self._heap = []
+        self._order = 0
 
     # def __contains__(self, key: Any) -> bool:
     #     # self.expire()
@@ -60,7 +86,7 @@ class TTLDict(Dict[K, V]):
     def __getitem__(self, key: K) -> V:
         # self.expire()
         value = cast(_Val, super().__getitem__(key))
-        if time() <= value.expires:
+        if monotonic() <= value.expires:
             return value.value
         super().__delitem__(key)
         return cast(_Val, super().__getitem__(key)).value
@@ -71,6 +97,24 @@ class TTLDict(Dict[K, V]):
             value = cast(V, TTLValue(value, self._ttl))
         super().__setitem__(key, value)
 
+        self._order += 1
+        heap = self._heap
+        heappush(heap, (value.expires, self._order, key, value))  # type: ignore
+        if len(heap) > _COMPACT_MIN and len(heap) > _COMPACT_RATIO * len(self):
+            self._compact()
+
+    def _is_current(self, entry: _Entry) -> bool:
+        # entries of the removed or replaced values are stale
+        return super().get(entry[2]) is entry[3]
+
+    def _compact(self) -> None:
+        self._heap = [entry for entry in self._heap if self._is_current(entry)]
+        heapify(self._heap)
+
+    def clear(self) -> None:
+        super().clear()
+        self._heap.clear()
+
     # def __delitem__(self, key: K) -> None:
     #     # self.expire()
     #     super().__delitem__(key)
@@ -92,7 +136,7 @@ class TTLDict(Dict[K, V]):
         if value_ is default:
             return value_
         value = cast(_Val, value_)
-        if time() <= value.expires:
+        if monotonic() <= value.expires:
             return value.value
         super().__delitem__(key)
         return cast(Union[V, T], default)
@@ -110,26 +154,83 @@ class TTLDict(Dict[K, V]):
         """
         Removes and returns expired items from the dict.
         ---
-        This function relies on the fact that dict is ordered.
-        More often calls -> faster execution time.
-        Complexity is ~O(n*sigmiod(x)) where n is number of keys
-        and x is how much time passed from the last update.
+        Complexity is O(k*log(n)) where k is number of expired items
+        and n is number of keys, at most expire_count items are removed
+        (all of them if it's negative).
         """
 
-        keys = []
+        values = []
         count = self.expire_count
-
-        current_time = time()
-        for key, value in super().items():
-            if current_time <= cast(_Val, value).expires:
-                break
-            keys.append(key)
-
+        heap = self._heap
+
+        current_time = monotonic()
+        while heap and count != 0 and heap[0][0] < current_time:
+            entry = heappop(heap)
+            if not self._is_current(entry):
+                continue
+            values.append(entry[3].value)
+            super().__delitem__(entry[2])
             count -= 1
-            if count == 0:
-                break
 
-        return [self.pop(key) for key in keys]
+        return values
 
     def key_expires_at(self, key: K) -> float:
+        """
+        Returns expiration time of the key according to time.monotonic().
+        """
+
         return cast(_Val, super().__getitem__(key)).expires
+
+
+class Sweeper:
+    """
+    Calls the function every `interval` seconds in the background,
+    so that expiration does not happen on the hot path.
+    Coroutine functions are awaited.
+    """
+
+    __slots__ = "interval", "function", "_task"
+
+    interval: float
+    function: Callable[[], Any]
+    _task: Optional["asyncio.Task[None]"]
+
+    def __init__(self, interval: float, function: Callable[[], Any]) -> None:
+        self.interval = interval
+        self.function = function
+        self._task = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if not self.is_running:
+            self._task = asyncio.ensure_future(self._work())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @asynccontextmanager
+    async def running(self) -> AsyncGenerator["Sweeper", None]:
+        self.start()
+        try:
+            yield self
+        finally:
+            await self.stop()
+
+    async def _work(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                result = self.function()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                logger.exception("Sweep failed")
@@ -1,18 +1,32 @@
+import asyncio
 from datetime import datetime
-from typing import Any, Dict, cast
+from pathlib import Path
+from typing import Any, Dict, List
 
+from vkbottle import DocMessagesUploader, VKAPIError
 from vkbottle.bot import Bot
 from vkbottle.bot import Message as TargetMessage
 from vkbottle_types.objects import MessagesConversation as TargetChat
 from vkbottle_types.objects import MessagesConversationPeerType as TargetChatType
+from vkbottle_types.objects import MessagesMessageActionStatus as TargetActionType
 from vkbottle_types.objects import UsersUserFull as TargetUser
 
-from . import bot_secrets
+from . import bot_secrets, options
 from .bot import bot as main_bot
-from .common import handle_message
+from .common import dispatch_message
+from .loader import BatchLoader
 from .mappers import model_mapper
 from .models import VK as PLATFORM
 from .models import Chat, Message, User
+from .outbox import RateLimit, RetryAfter
+
+# https://dev.vk.com/method/messages.send
+MAX_MESSAGE_LENGTH = 4096
+# https://dev.vk.com/api/api-requests#Limits
+RATE_LIMIT = RateLimit(rate=20, burst=20)
+CHAT_RATE_LIMIT = RateLimit(rate=1, burst=3)
+# https://dev.vk.com/method/docs.getMessagesUploadServer
+MAX_FILE_SIZE = 200 * 1024 * 1024
 
 
 @model_mapper(TargetMessage, Message)
@@ -46,12 +60,30 @@ def chat_to_model(chat: TargetChat) -> Dict[str, Any]:
     )
 
 
-@main_bot.send_function(TargetMessage)
+@main_bot.send_function(
+    TargetMessage, PLATFORM, MAX_MESSAGE_LENGTH, RATE_LIMIT, CHAT_RATE_LIMIT
+)
 async def send(msg: TargetMessage, text: str, mention: bool, raw: bool) -> None:
-    if mention:
-        await msg.reply(text)
-    else:
-        await msg.answer(text)
+    try:
+        if mention:
+            await msg.reply(text)
+        else:
+            await msg.answer(text)
+    # too many requests per second and flood control
+    except (VKAPIError[6], VKAPIError[9]) as e:
+        raise RetryAfter() from e
+
+
+@main_bot.file_function(TargetMessage, MAX_FILE_SIZE)
+async def send_file(msg: TargetMessage, path: Path, name: str) -> None:
+    try:
+        # the uploader reads the whole file, vk has no streaming upload
+        document = await DocMessagesUploader(bot.api).upload(
+            title=name, file_source=str(path), peer_id=msg.peer_id
+        )
+        await msg.answer(attachment=document)
+    except (VKAPIError[6], VKAPIError[9]) as e:
+        raise RetryAfter() from e
 
 
 bot = Bot(token=bot_secrets.VK_API_TOKEN)
@@ -67,16 +99,46 @@ async def on_ready() -> None:
         GROUP_NAME = group.name
 
 
+async def fetch_chats(peer_ids: List[int]) -> Dict[int, TargetChat]:
+    response = await bot.api.messages.get_conversations_by_id(peer_ids=peer_ids)
+    return {chat.peer.id: chat for chat in response.items}
+
+
+async def fetch_users(user_ids: List[int]) -> Dict[int, TargetUser]:
+    users = await bot.api.users.get(user_ids=user_ids)
+    return {user.id: user for user in users}
+
+
+# https://dev.vk.com/method/messages.getConversationsById
+chats: BatchLoader[int, TargetChat] = BatchLoader(
+    fetch_chats,
+    options.VK_LOOKUP_TTL,
+    options.VK_LOOKUP_CACHE_SIZE,
+    options.VK_LOOKUP_REFRESH,
+    max_batch=100,
+)
+# https://dev.vk.com/method/users.get
+users: BatchLoader[int, TargetUser] = BatchLoader(
+    fetch_users,
+    options.VK_LOOKUP_TTL,
+    options.VK_LOOKUP_CACHE_SIZE,
+    options.VK_LOOKUP_REFRESH,
+    max_batch=1000,
+)
+
+
 @bot.on.message()
 async def on_message(in_msg: TargetMessage) -> None:
-    peer_ids = cast(list, in_msg.peer_id)
-    (chat,) = (await bot.api.messages.get_conversations_by_id(peer_ids)).items
-    user_ids = cast(list, in_msg.from_id)
-    (author,) = await bot.api.users.get(user_ids)
+    action = in_msg.action
+    if action is not None and action.type == TargetActionType.CHAT_TITLE_UPDATE:
+        chats.refresh(in_msg.peer_id)
+    chat, author = await asyncio.gather(
+        chats.load(in_msg.peer_id), users.load(in_msg.from_id)
+    )
 
     # also works: is_private = in_msg.peer_id == in_msg.from_id
     is_private = chat.peer.type == TargetChatType.USER
-    await handle_message(PLATFORM, in_msg, chat, author, is_private)
+    await dispatch_message(PLATFORM, in_msg, chat, author, is_private)
 
 
 async def run() -> None:
@@ -0,0 +1,113 @@
+"""
+Cost of /link and /unlink for accounts with many linked users
+---
+The other account gets USERS linked users with a chat each,
+the statements and the time of merging it and splitting it again
+should not grow with the number of users.
+"""
+
+import os
+from time import perf_counter
+from typing import Dict, List, Tuple, cast
+
+from RestlessFunnelBot import profiling
+from RestlessFunnelBot.database import make_db
+from RestlessFunnelBot.models import (
+    TELEGRAM,
+    Chat,
+    ConnectionChat,
+    User,
+    UserChat,
+)
+from RestlessFunnelBot.profiling import totals
+
+from fakes import FakeChat, FakeClient, flush
+from utils import do_test, run_with_database, setup
+
+setup()
+
+SIZES = os.environ.get("RESTLESS_BENCH_USERS", "1,10,1000")
+USERS = [int(size) for size in SIZES.split(",")]
+# the largest account may take that many times longer than the smallest one
+MAX_RATIO = 3
+
+
+async def add_users(connection_id: int, count: int) -> None:
+    async with make_db(TELEGRAM) as db:
+        ids = range(1, count + 1)
+        chats = [db.create(Chat, target_id=-i, name=f"chat {i}") for i in ids]
+        users = [
+            db.create(User, target_id=-i, connection_id=connection_id)
+            for i in ids
+        ]
+        await db.flush()
+        await db.insert_ignore(
+            UserChat,
+            [
+                dict(user_id=user.id, chat_id=chat.id)
+                for user, chat in zip(users, chats)
+            ],
+        )
+        await db.insert_ignore(
+            ConnectionChat,
+            [dict(connection_id=connection_id, chat_id=chat.id) for chat in chats],
+        )
+
+
+def statements(name: str) -> int:
+    total = totals.get(name)
+    return 0 if total is None else total.count
+
+
+def measure(users: int) -> Tuple[Dict[str, int], float]:
+    result: Dict[str, int] = {}
+    elapsed: List[float] = []
+
+    async def test():
+        first, second = FakeClient(1), FakeClient(2)
+        await first.say(FakeChat(10), "a")
+        await second.say(FakeChat(20), "b")
+        await flush()
+        async with make_db(TELEGRAM) as db:
+            user = await db.read_one(User, target_id=2)
+        await add_users(cast(int, user.connection_id), users)
+
+        reply = await first.command("/link")
+        key = reply.splitlines()[-1].split(" ", 1)[1]
+        before = statements("/link")
+        start = perf_counter()
+        assert await second.command(f"/link {key}") == "Successfully linked!"
+        elapsed.append(perf_counter() - start)
+        result["link"] = statements("/link") - before
+
+        start = perf_counter()
+        assert "Successfully" in await second.command("/unlink all")
+        elapsed.append(perf_counter() - start)
+        result["unlink"] = statements("/unlink")
+        assert f"chat {users}" in await first.command("/chats")
+
+    totals.clear()
+    profiling.enable()
+    try:
+        run_with_database("sqlite", test)
+    finally:
+        profiling.disable()
+    return result, sum(elapsed)
+
+
+def test_link_cost_is_flat():
+    results = {users: measure(users) for users in USERS}
+    print()
+    for users, (counts, seconds) in results.items():
+        print(
+            f"{users} linked users: {counts['link']} statements to link, "
+            f"{counts['unlink']} to unlink, {seconds * 1000:.1f} ms"
+        )
+
+    smallest, largest = results[min(USERS)], results[max(USERS)]
+    assert smallest[0] == largest[0]
+    assert largest[1] < smallest[1] * MAX_RATIO
+
+
+if __name__ == "__main__":
+    do_test(__file__)
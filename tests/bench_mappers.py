@@ -0,0 +1,58 @@
+"""
+Cost of a single map_model call against the previous type resolution,
+which intersected the registered types with the mro on every call.
+Set RESTLESS_BENCH_CALLS to change the number of calls.
+"""
+
+import os
+from timeit import timeit
+from typing import Any, Dict, Optional, Type
+
+from RestlessFunnelBot import mappers
+from RestlessFunnelBot.mappers import get_mapped_type, map_model
+
+from fakes import FakeChat, FakeMessage, FakeUser
+from utils import do_test, setup
+
+setup()
+
+CALLS = int(os.environ.get("RESTLESS_BENCH_CALLS", 100_000))
+
+
+def old_get_mapped_type(type: Type[Any]) -> Optional[Type[Any]]:
+    intersection = mappers._model_mappers.keys() & type.__mro__
+    if len(intersection) == 0:
+        return None
+    return intersection.pop()
+
+
+def old_map_model(obj: Any) -> Dict[str, Any]:
+    type_key = old_get_mapped_type(type(obj))
+    if type_key is None:
+        raise KeyError(f"No mapping found for type {type(obj)}")
+    model, mapper = mappers._model_mappers[type_key]
+    return mapper(obj)
+
+
+def per_call_ns(function: Any, obj: Any) -> float:
+    return timeit(lambda: function(obj), number=CALLS) / CALLS * 10**9
+
+
+def test_resolution_cost():
+    msg = FakeMessage(1, "text", FakeChat(1), FakeUser(1))
+    get_mapped_type(FakeMessage)
+
+    old = per_call_ns(old_get_mapped_type, FakeMessage)
+    new = per_call_ns(get_mapped_type, FakeMessage)
+    old_map = per_call_ns(old_map_model, msg)
+    new_map = per_call_ns(map_model, msg)
+    print(
+        f"\ntype resolution: {old:.0f} ns -> {new:.0f} ns, "
+        f"map_model: {old_map:.0f} ns -> {new_map:.0f} ns"
+    )
+    assert new < old
+    assert new_map < old_map
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,176 @@
+"""
+Throughput and latency of the whole message pipeline
+---
+Fake platform objects go through the real handle_message,
+the ingestor, the commands and the outbox into a sqlite database.
+The mix is configured with the environment variables below,
+RESTLESS_BENCH_DATABASE can be a database url, for example
+"sqlite+aiosqlite://" for an in-memory database.
+
+The results are compared with the baseline of the same scenario
+in bench_pipeline.json, RESTLESS_BENCH_SAVE=1 stores them as the new
+baseline, and RESTLESS_BENCH_CHECK=1 fails on a regression.
+"""
+
+import asyncio
+import json
+import os
+import random
+from pathlib import Path
+from statistics import quantiles
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List
+
+from RestlessFunnelBot.bot import bot
+from RestlessFunnelBot.common import Incoming, ingestor
+
+from fakes import FakeChat, FakeClient, flush
+from utils import do_test, run_with_database, setup
+
+setup()
+
+
+def env(name: str, default: Any) -> Any:
+    return type(default)(os.environ.get(f"RESTLESS_BENCH_{name}", default))
+
+
+PUBLIC = env("PUBLIC", 1_000)
+COMMANDS = env("COMMANDS", 50)
+CHATS = env("CHATS", 50)
+USERS = env("USERS", 200)
+# clients that send at the same time
+SENDERS = env("SENDERS", 20)
+DATABASE = env("DATABASE", "sqlite")
+COMMAND_MIX = ["/list", "/chats", "/link"]
+
+BASELINE_PATH = Path(__file__).with_suffix(".json")
+# a regression is a result that is this many times worse than the baseline
+TOLERANCE = 1.5
+
+
+def scenario() -> str:
+    return (
+        f"public={PUBLIC} commands={COMMANDS} chats={CHATS} users={USERS} "
+        f"senders={SENDERS} database={DATABASE.split(':')[0]}"
+    )
+
+
+def percentiles(timings: List[float]) -> Dict[str, float]:
+    if len(timings) < 2:
+        timings = timings * 2 or [0.0, 0.0]
+    cuts = quantiles(timings, n=100)
+    return dict(
+        p50_ms=cuts[49] * 1000, p95_ms=cuts[94] * 1000, p99_ms=cuts[98] * 1000
+    )
+
+
+async def timed(timings: List[float], action: Callable[[], Awaitable[None]]) -> None:
+    start = perf_counter()
+    await action()
+    timings.append(perf_counter() - start)
+
+
+async def drive(rng: random.Random) -> Dict[str, Any]:
+    clients = [FakeClient(user) for user in range(1, USERS + 1)]
+    # group chats have negative ids, like in telegram
+    chats = [FakeChat(-chat) for chat in range(1, CHATS + 1)]
+    actions = [("public", i) for i in range(PUBLIC)]
+    actions += [("command", i) for i in range(COMMANDS)]
+    rng.shuffle(actions)
+
+    timings: Dict[str, List[float]] = dict(public=[], command=[])
+    queue: asyncio.Queue = asyncio.Queue()
+    for action in actions:
+        queue.put_nowait(action)
+
+    # public messages are measured till they are written to the database
+    posted: Dict[str, float] = {}
+    write = ingestor.handler
+
+    async def timed_write(batch: List[Incoming]) -> None:
+        await write(batch)
+        written = perf_counter()
+        for incoming in batch:
+            timings["public"].append(written - posted[incoming.message["text"]])
+
+    async def sender() -> None:
+        while not queue.empty():
+            kind, i = queue.get_nowait()
+            client = rng.choice(clients)
+            if kind == "public":
+                text = f"message {i}"
+                posted[text] = perf_counter()
+                await client.say(rng.choice(chats), text)
+            else:
+                text = COMMAND_MIX[i % len(COMMAND_MIX)]
+                chat = client.private_chat
+                await timed(timings[kind], lambda: client.say(chat, text))
+
+    ingestor.handler = timed_write
+    try:
+        start = perf_counter()
+        await asyncio.gather(*(sender() for _ in range(SENDERS)))
+        # everything is written and every reply is sent
+        await bot.outbox.join()
+        await flush()
+        elapsed = perf_counter() - start
+    finally:
+        ingestor.handler = write
+
+    return dict(
+        messages_per_second=(PUBLIC + COMMANDS) / elapsed,
+        public=percentiles(timings["public"]),
+        command=percentiles(timings["command"]),
+    )
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    regressions = []
+    if result["messages_per_second"] * TOLERANCE < baseline["messages_per_second"]:
+        regressions.append("messages_per_second")
+    for kind in ("public", "command"):
+        for name, value in result[kind].items():
+            if value > baseline[kind][name] * TOLERANCE:
+                regressions.append(f"{kind} {name}")
+    return regressions
+
+
+def report(result: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    print(f"\n{scenario()}")
+    old = baseline.get("messages_per_second")
+    print(
+        f"throughput: {result['messages_per_second']:.0f} messages/s"
+        + (f" (baseline {old:.0f})" if old else "")
+    )
+    for kind in ("public", "command"):
+        values = ", ".join(
+            f"{name[:3]} {value:.2f} ms"
+            + (f" ({baseline[kind][name]:.2f})" if baseline else "")
+            for name, value in result[kind].items()
+        )
+        print(f"{kind} latency: {values}")
+
+
+def test_pipeline():
+    result: Dict[str, Any] = {}
+
+    async def test():
+        result.update(await drive(random.Random(42)))
+
+    run_with_database(DATABASE, test)
+
+    baselines = {}
+    if BASELINE_PATH.exists():
+        baselines = json.loads(BASELINE_PATH.read_text())
+    baseline = baselines.get(scenario(), {})
+    report(result, baseline)
+
+    if env("SAVE", 0):
+        baselines[scenario()] = result
+        BASELINE_PATH.write_text(json.dumps(baselines, indent=4) + "\n")
+    elif baseline and env("CHECK", 0):
+        assert compare(result, baseline) == []
+
+
+if __name__ == "__main__":
+    do_test(__file__)
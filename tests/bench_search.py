@@ -0,0 +1,100 @@
+"""
+Search latency on a big archive
+---
+Set RESTLESS_BENCH_MESSAGES to change the size of the archive,
+for example to a few millions.
+"""
+
+import os
+import random
+from datetime import datetime
+from statistics import median, quantiles
+from time import perf_counter
+from typing import List, cast
+
+from RestlessFunnelBot.common import accessible_chat_ids
+from RestlessFunnelBot.database import make_db
+from RestlessFunnelBot.models import (
+    TELEGRAM,
+    Chat,
+    ConnectedUser,
+    ConnectionChat,
+    Message,
+    User,
+    col,
+)
+from RestlessFunnelBot.search import search_messages
+
+from utils import do_test, run_with_database, setup
+
+setup()
+
+MESSAGES = int(os.environ.get("RESTLESS_BENCH_MESSAGES", 20_000))
+CHATS = 50
+VOCABULARY = 20_000
+WORDS_PER_MESSAGE = 12
+CHUNK = 10_000
+QUERIES = 200
+PAGE = 10
+BUDGET_MS = 20
+
+
+async def fill(rng: random.Random, words: List[str]) -> int:
+    async with make_db(TELEGRAM) as db:
+        connection = db.create(ConnectedUser)
+        await db.flush()
+        user = db.create(User, target_id=1, connection_id=connection.id)
+        chats = [db.create(Chat, target_id=i, name=f"chat {i}") for i in range(CHATS)]
+        await db.flush()
+        await db.insert_ignore(
+            ConnectionChat,
+            [dict(connection_id=connection.id, chat_id=chat.id) for chat in chats],
+        )
+
+    now = datetime.utcnow()
+    for start in range(0, MESSAGES, CHUNK):
+        rows = [
+            dict(
+                target_id=i,
+                platform=TELEGRAM,
+                text=" ".join(rng.choices(words, k=WORDS_PER_MESSAGE)),
+                timestamp=now,
+                author_id=user.id,
+                chat_id=chats[i % CHATS].id,
+            )
+            for i in range(start, min(start + CHUNK, MESSAGES))
+        ]
+        async with make_db(TELEGRAM) as db:
+            await db.execute(Message.__table__.insert(), rows)  # type: ignore
+
+    return cast(int, connection.id)
+
+
+def test_search_latency():
+    rng = random.Random(42)
+    words = [f"word{i}" for i in range(VOCABULARY)]
+    timings: List[float] = []
+
+    async def test():
+        connection_id = await fill(rng, words)
+        accessible = col(Message.chat_id).in_(accessible_chat_ids(connection_id))
+        async with make_db(TELEGRAM, readonly=True) as db:
+            for _ in range(QUERIES):
+                query = " ".join(rng.choices(words, k=rng.randint(1, 2)))
+                selection = search_messages(db.dialect, query, accessible)
+                start = perf_counter()
+                (await db.fetch(selection.limit(PAGE))).all()
+                timings.append((perf_counter() - start) * 1000)
+
+    run_with_database("sqlite", test)
+
+    p95 = quantiles(timings, n=20)[-1]
+    print(
+        f"\nsearch over {MESSAGES} messages: "
+        f"median {median(timings):.2f} ms, p95 {p95:.2f} ms"
+    )
+    assert p95 < BUDGET_MS
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,105 @@
+"""
+Latency of the telegram webhook against long polling
+---
+The same recorded updates are posted to the webhook server
+and long polled from a fake Bot API server, the median latencies
+are printed for comparison.
+"""
+
+import asyncio
+from statistics import median
+from time import perf_counter
+from typing import Any, List
+
+import aiohttp
+from aiogram import Bot
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import web
+
+from utils import do_test
+
+from test_telegram import (  # noqa: F401, the fixture is used by name
+    PATH,
+    SECRET,
+    TOKEN,
+    Received,
+    free_port,
+    post,
+    received,
+    recorded_update,
+    telegram_bot,
+)
+
+UPDATES = 20
+
+
+async def webhook_latencies(received: Received) -> List[float]:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}{PATH}"
+    latencies = []
+    async with telegram_bot.webhook_server("127.0.0.1", port, PATH, SECRET):
+        async with aiohttp.ClientSession() as session:
+            for id in range(1, UPDATES + 1):
+                start = perf_counter()
+                assert await post(session, url, id) == 200
+                await received.event(id).wait()
+                latencies.append(received.times[id] - start)
+    return latencies
+
+
+async def polling_latencies(received: Received, monkeypatch) -> List[float]:
+    updates: asyncio.Queue = asyncio.Queue()
+
+    async def api(request: web.Request) -> web.Response:
+        result: Any = True
+        if request.match_info["method"] == "getUpdates":
+            # long polling, answers as soon as there is an update
+            result = [await updates.get()]
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    server = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+    polling_bot = Bot(TOKEN, server=server)
+    monkeypatch.setattr(telegram_bot.dp, "bot", polling_bot)
+    polling = asyncio.ensure_future(telegram_bot.dp.start_polling())
+    latencies = []
+    try:
+        for id in range(1, UPDATES + 1):
+            start = perf_counter()
+            await updates.put(recorded_update(id))
+            await received.event(id).wait()
+            latencies.append(received.times[id] - start)
+    finally:
+        telegram_bot.dp.stop_polling()
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+        await (await polling_bot.get_session()).close()
+        await runner.cleanup()
+    return latencies
+
+
+def test_webhook_latency_against_polling(received, monkeypatch):  # noqa: F811
+    async def test():
+        webhook = await webhook_latencies(received)
+        received.times.clear()
+        received.events.clear()
+        polling = await polling_latencies(received, monkeypatch)
+        return webhook, polling
+
+    webhook, polling = asyncio.run(test())
+    # the poller waits between the requests, the webhook gets them at once
+    print(
+        f"\nmedian latency of {UPDATES} updates: "
+        f"webhook {median(webhook) * 1000:.1f} ms, "
+        f"polling {median(polling) * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    do_test(__file__)
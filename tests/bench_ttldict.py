@@ -0,0 +1,102 @@
+"""
+TTLDict against the previous implementation
+---
+The previous expire() walked the dict in insertion order
+and stopped at the first live item, so items set again
+kept their old place and blocked the expired ones behind them.
+Set RESTLESS_BENCH_KEYS to change the number of keys.
+"""
+
+import gc
+import os
+import random
+from time import perf_counter, sleep, time
+from typing import Any, Callable, Dict, List
+
+from RestlessFunnelBot.ttldict import TTLDict, TTLValue
+
+from utils import do_test, setup
+
+setup()
+
+KEYS = int(os.environ.get("RESTLESS_BENCH_KEYS", 50_000))
+TTL = 0.5
+REFRESHED = 0.1
+REPEATS = 3
+# setting items may be slower because of the heap, but not by much
+SET_SLOWDOWN = 4
+
+
+class OldTTLDict(Dict[Any, Any]):
+    def __init__(self, ttl: float) -> None:
+        super().__init__()
+        self._ttl = ttl
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        value = TTLValue(value, 0)
+        value.expires = time() + self._ttl
+        super().__setitem__(key, value)
+
+    def expire(self) -> List[Any]:
+        keys = []
+        current_time = time()
+        for key, value in super().items():
+            if current_time <= value.expires:
+                break
+            keys.append(key)
+        return [self.pop(key).value for key in keys]
+
+
+def fill(data: Dict[Any, Any]) -> float:
+    start = perf_counter()
+    for key in range(KEYS):
+        data[key] = key
+    return perf_counter() - start
+
+
+def refresh(data: Dict[Any, Any], refreshed: List[int]) -> None:
+    for key in refreshed:
+        data[key] = key
+
+
+def run(make: Callable[[], Any], refreshed: List[int]) -> Dict[str, float]:
+    set_time = min(fill(make()) for _ in range(REPEATS))
+    data = make()
+    fill(data)
+    sleep(TTL / 2)
+    refresh(data, refreshed)
+    sleep(TTL / 2 + 0.1)
+
+    start = perf_counter()
+    expired = len(data.expire())
+    expire_time = perf_counter() - start
+    return dict(set=set_time, expire=expire_time, expired=expired)
+
+
+def test_expire_with_refreshed_keys():
+    rng = random.Random(42)
+    # the very first key is refreshed, so the old expire() removes nothing
+    refreshed = [0] + rng.sample(range(KEYS), int(KEYS * REFRESHED))
+    # like timeit, a collection in the middle would skew the timings
+    gc.collect()
+    gc.disable()
+    try:
+        old = run(lambda: OldTTLDict(TTL), refreshed)
+        new = run(lambda: TTLDict(TTL), refreshed)
+    finally:
+        gc.enable()
+
+    for name, result in ("old", old), ("new", new):
+        print(
+            f"\n{name}: set {KEYS} keys {result['set'] * 1000:.1f} ms, "
+            f"expire {result['expire'] * 1000:.1f} ms, "
+            f"expired {result['expired']:.0f}"
+        )
+
+    assert old["expired"] == 0
+    assert new["expired"] == KEYS - len(set(refreshed))
+    assert new["set"] < old["set"] * SET_SLOWDOWN
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,39 @@
+"""
+Platform that the supervisor tests run in a separate process
+---
+It crashes on the first start, then posts a public message
+and a command, the replies are written to the file
+from the RESTLESS_TEST_REPLIES environment variable.
+"""
+
+import asyncio
+import os
+from pathlib import Path
+
+from RestlessFunnelBot.bot import bot
+from RestlessFunnelBot.models import TELEGRAM
+
+from fakes import FakeChat, FakeClient, FakeMessage
+
+REPLIES_VARIABLE = "RESTLESS_TEST_REPLIES"
+
+
+async def send(msg: FakeMessage, text: str, mention: bool, raw: bool) -> None:
+    with open(os.environ[REPLIES_VARIABLE], "a") as file:
+        file.write(" ".join(text.split()) + "\n")
+
+
+async def run() -> None:
+    crashed = Path(os.environ[REPLIES_VARIABLE] + ".crashed")
+    if not crashed.exists():
+        crashed.touch()
+        raise RuntimeError("Crashed on the first start")
+
+    # only in the process of the platform, the other tests keep their send
+    bot.send_function(FakeMessage, TELEGRAM)(send)
+
+    client = FakeClient(1)
+    await client.post(FakeChat(-1), "public")
+    await client.post(client.private_chat, "/chats")
+    # until the supervisor stops it
+    await asyncio.Event().wait()
@@ -0,0 +1,118 @@
+"""
+Lightweight platform objects that go through the real pipeline
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+from itertools import count
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from RestlessFunnelBot.bot import bot
+from RestlessFunnelBot.common import (
+    dispatch_message,
+    dispatcher,
+    handle_message,
+    ingestor,
+)
+from RestlessFunnelBot.mappers import model_mapper
+from RestlessFunnelBot.models import TELEGRAM, Chat, Message, Platform, User
+
+
+@dataclass
+class FakeChat:
+    id: int
+    name: str = ""
+    private: bool = False
+
+    def __post_init__(self) -> None:
+        if not self.name:
+            self.name = f"chat {self.id}"
+
+
+@dataclass
+class FakeUser:
+    id: int
+
+
+@dataclass
+class FakeMessage:
+    id: int
+    text: str
+    chat: FakeChat
+    author: FakeUser
+    date: datetime = field(default_factory=datetime.utcnow)
+
+
+@model_mapper(FakeMessage, Message)
+def message_to_model(msg: FakeMessage) -> Dict[str, Any]:
+    return dict(target_id=msg.id, text=msg.text, timestamp=msg.date)
+
+
+@model_mapper(FakeChat, Chat)
+def chat_to_model(chat: FakeChat) -> Dict[str, Any]:
+    return dict(target_id=chat.id, name=Chat.generate_name(chat.name))
+
+
+@model_mapper(FakeUser, User)
+def user_to_model(user: FakeUser) -> Dict[str, Any]:
+    return dict(target_id=user.id)
+
+
+# (chat id, text) of every reply
+sent: List[Tuple[int, str]] = []
+
+
+@bot.send_function(FakeMessage, TELEGRAM)
+async def send(msg: FakeMessage, text: str, mention: bool, raw: bool) -> None:
+    # like a real client, it lets other handlers run
+    await asyncio.sleep(0)
+    sent.append((msg.chat.id, text))
+
+
+# the largest file that the fake platform accepts
+MAX_FILE_SIZE = 1024 * 1024
+# (chat id, name, contents) of every file
+files: List[Tuple[int, str, bytes]] = []
+
+
+@bot.file_function(FakeMessage, MAX_FILE_SIZE)
+async def send_file(msg: FakeMessage, path: Path, name: str) -> None:
+    await asyncio.sleep(0)
+    files.append((msg.chat.id, name, path.read_bytes()))
+
+
+message_ids = count(1)
+
+
+class FakeClient:
+    """
+    Sends messages on behalf of one user.
+    """
+
+    def __init__(self, user_id: int, platform: Platform = TELEGRAM) -> None:
+        self.user = FakeUser(user_id)
+        self.platform = platform
+        self.private_chat = FakeChat(user_id, private=True)
+
+    async def say(self, chat: FakeChat, text: str) -> None:
+        msg = FakeMessage(next(message_ids), text, chat, self.user)
+        await handle_message(self.platform, msg, chat, self.user, chat.private)
+
+    async def post(self, chat: FakeChat, text: str) -> None:
+        # goes through the dispatcher, like the messages of the real clients
+        msg = FakeMessage(next(message_ids), text, chat, self.user)
+        await dispatch_message(self.platform, msg, chat, self.user, chat.private)
+
+    async def command(self, text: str) -> str:
+        start = len(sent)
+        await self.say(self.private_chat, text)
+        await bot.outbox.join()
+        return "\n".join(text for _, text in sent[start:])
+
+
+async def flush() -> None:
+    await dispatcher.stop()
+    await ingestor.stop()
+    await bot.outbox.stop()
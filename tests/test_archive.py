@@ -0,0 +1,158 @@
+"""
+Most of these tests run against every configured database backend
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from RestlessFunnelBot import archive, options
+from RestlessFunnelBot.common import LIST_PAGE_SIZE, SEARCH_PAGE_SIZE
+from RestlessFunnelBot.database import make_db, setup_engines, sqlite_url
+from RestlessFunnelBot.models import TELEGRAM, Message, Segment
+
+from fakes import FakeChat, FakeClient, flush
+from utils import database_urls, do_test, run_with_database, setup
+
+setup()
+
+with_databases = pytest.mark.parametrize("url", database_urls())
+
+SEGMENT_SIZE = 20
+
+
+@pytest.fixture(autouse=True)
+def archive_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(options, "ARCHIVE_PATH", str(tmp_path))
+    archive.segment_cache.clear()
+
+
+async def count(model) -> int:
+    async with make_db(TELEGRAM) as db:
+        return await db.count(model)
+
+
+async def compact_all() -> int:
+    # everything that was written so far is older than that
+    return await archive.compact(datetime.utcnow() + timedelta(seconds=1), SEGMENT_SIZE)
+
+
+@with_databases
+def test_compact(url, tmp_path):
+    async def test():
+        client = FakeClient(1)
+        for i in range(SEGMENT_SIZE + 5):
+            await client.say(FakeChat(10), f"message {i}")
+        await client.say(FakeChat(11), "other chat")
+        await flush()
+
+        assert await compact_all() == SEGMENT_SIZE + 6
+        assert await count(Message) == 0
+        # the first chat has more messages than fit into a segment
+        assert await count(Segment) == 3
+        assert len(list(tmp_path.glob("*/*.jsonl.gz"))) == 3
+        assert await compact_all() == 0
+
+        # ids of the archived messages are not given out again
+        await client.say(FakeChat(10), "after")
+        await flush()
+        async with make_db(TELEGRAM) as db:
+            (msg,) = await db.read_all(Message)
+        assert msg.id is not None and msg.id > SEGMENT_SIZE + 6
+
+    run_with_database(url, test)
+
+
+@with_databases
+def test_list_reads_archive(url):
+    async def test():
+        client = FakeClient(1)
+        total = LIST_PAGE_SIZE + 10
+        for i in range(total // 2):
+            await client.say(FakeChat(10 + i % 2), f"message {i}")
+        await flush()
+        await compact_all()
+        for i in range(total // 2, total):
+            await client.say(FakeChat(10 + i % 2), f"message {i}")
+        await flush()
+
+        first = await client.command("/list")
+        second = await client.command("/list next")
+        assert first.endswith("/list next")
+        assert "/list next" not in second
+        # in the order of writing, across the archive and the database
+        replies = first + second
+        positions = [replies.index(f"message {i}\n") for i in range(total)]
+        assert positions == sorted(positions)
+        assert f"{total}) " in second
+
+    run_with_database(url, test)
+
+
+@with_databases
+def test_search_reads_archive(url):
+    async def test():
+        client = FakeClient(1)
+        for i in range(SEARCH_PAGE_SIZE):
+            await client.say(FakeChat(10), f"old needle {i}")
+        await flush()
+        await compact_all()
+        for i in range(5):
+            await client.say(FakeChat(10), f"new needle {i}")
+        await client.say(FakeChat(10), "hay")
+        await flush()
+
+        first = await client.command("/search needle")
+        assert "new needle 4" in first
+        assert "old needle 9" in first
+        assert first.endswith("/search next")
+        second = await client.command("/search next")
+        assert "old needle 0" in second
+        assert f"{SEARCH_PAGE_SIZE + 5})" in second
+        assert "Nothing more" in await client.command("/search next")
+        assert "Nothing was found" in await client.command("/search hay needle")
+        assert "Nothing was found" in await client.command('/search " *')
+
+        stats = await client.command("/stats")
+        assert f"Archived messages: {SEARCH_PAGE_SIZE}" in stats
+
+    run_with_database(url, test)
+
+
+
+@with_databases
+def test_search_skips_segments_without_words(url, monkeypatch):
+    opened = []
+    read_file = archive.read_file
+
+    def counted(path):
+        opened.append(path)
+        return read_file(path)
+
+    monkeypatch.setattr(archive, "read_file", counted)
+
+    async def test():
+        client = FakeClient(1)
+        for chat in range(10, 15):
+            await client.say(FakeChat(chat), f"chat {chat}")
+        await client.say(FakeChat(12), "needle")
+        await flush()
+        await compact_all()
+
+        assert "needle" in await client.command("/search needle")
+        assert len(opened) == 1
+        assert "Nothing was found" in await client.command("/search missing")
+        assert len(opened) == 1
+
+    run_with_database(url, test)
+
+
+def test_archive_is_next_to_the_database(monkeypatch, tmp_path):
+    monkeypatch.setattr(options, "ARCHIVE_PATH", "")
+    path = tmp_path / "sqlite.db"
+    monkeypatch.setattr(options, "DATABASE_URL", sqlite_url(path))
+    setup_engines()
+    assert archive.archive_path() == tmp_path / "archive"
+
+
+if __name__ == "__main__":
+    do_test(__file__)
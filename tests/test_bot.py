@@ -0,0 +1,42 @@
+from RestlessFunnelBot.bot import TextChunks, split_text
+
+from utils import do_test, setup
+
+setup()
+
+LIMIT = 10
+
+
+def test_split_short():
+    assert split_text("short", LIMIT) == ["short"]
+    assert split_text("", LIMIT) == [""]
+
+
+def test_split_on_lines():
+    assert split_text("12345\n12345\n1", LIMIT) == ["12345", "12345\n1"]
+
+
+def test_split_long_line():
+    assert split_text("1" * 25, LIMIT) == ["1" * 10, "1" * 10, "1" * 5]
+
+
+def test_chunks():
+    chunks = TextChunks(LIMIT)
+    assert chunks.add("1234") == []
+    assert chunks.add("1234") == []
+    assert chunks.add("12") == ["1234\n1234"]
+    assert chunks.add("1" * 25) == ["12", "1" * 10, "1" * 10, "1" * 5]
+    assert chunks.finish() == []
+
+
+def test_chunks_fit_the_limit():
+    chunks = TextChunks(LIMIT)
+    parts = []
+    for i in range(100):
+        parts.extend(chunks.add(str(i) * (i % 7)))
+    parts.extend(chunks.finish())
+    assert all(len(part) <= LIMIT for part in parts)
+
+
+if __name__ == "__main__":
+    do_test(__file__)
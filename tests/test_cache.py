@@ -0,0 +1,57 @@
+from time import sleep
+
+from RestlessFunnelBot.cache import IdentityCache, LRUCache
+from RestlessFunnelBot.models import Platform
+
+from utils import do_test, setup
+
+setup()
+
+TTL = 0.3
+B_TTL = 0.5
+PLATFORM = Platform.TELEGRAM
+
+
+def test_lru_eviction():
+    cache: LRUCache[int, int] = LRUCache(TTL, 2)
+    cache.set(1, 1)
+    cache.set(2, 2)
+    assert cache.get(1) == 1
+    cache.set(3, 3)
+    assert cache.get(2) is None
+    assert cache.get(1) == 1
+    assert cache.get(3) == 3
+    assert cache.stats() == dict(size=2, hits=3, misses=1)
+
+
+def test_lru_expiration():
+    cache: LRUCache[int, int] = LRUCache(TTL, 2)
+    cache.set(1, 1)
+    sleep(B_TTL)
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+
+def test_renamed_chat_misses():
+    cache = IdentityCache(TTL, 8)
+    cache.set_chat(PLATFORM, dict(target_id=1, name="old"), 10)
+    assert cache.get_chat_id(PLATFORM, dict(target_id=1, name="old")) == 10
+    assert cache.get_chat_id(PLATFORM, dict(target_id=1, name="new")) is None
+
+
+def test_forget_connection():
+    cache = IdentityCache(TTL, 8)
+    cache.set_user(PLATFORM, 1, 10, 100)
+    cache.set_user(PLATFORM, 2, 20, 200)
+    cache.add_membership(10, 100, 5)
+    cache.add_membership(20, 200, 5)
+
+    cache.forget_connection(100)
+    assert cache.get_user(PLATFORM, 1) is None
+    assert cache.get_user(PLATFORM, 2) == (20, 200)
+    assert not cache.has_membership(10, 100, 5)
+    assert cache.has_membership(20, 200, 5)
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,146 @@
+"""
+Commands of different users are handled at the same time
+"""
+
+import asyncio
+import random
+
+import pytest
+from RestlessFunnelBot.bot import Context, bot
+from RestlessFunnelBot.common import dispatcher, ingestor
+from RestlessFunnelBot.database import make_db
+from RestlessFunnelBot.models import DISCORD, TELEGRAM, Message
+
+from fakes import FakeChat, FakeClient, flush, sent
+from utils import database_urls, do_test, run_with_database, setup
+
+setup()
+
+pytestmark = pytest.mark.parametrize("url", database_urls())
+
+CLIENTS = 40
+COMMANDS = 5
+REPLIES = 3
+MAX_DELAY = 0.005
+WAIT_TIMEOUT = 5
+
+
+async def echo(ctx: Context, text: str) -> None:
+    for i in range(REPLIES):
+        await asyncio.sleep(random.uniform(0, MAX_DELAY))
+        await ctx.send(f"{ctx.msg.author.target_id} {text} {i}")
+
+
+@pytest.fixture(autouse=True)
+def echo_command(monkeypatch):
+    # the commands are shared by the bot, so they are restored after each test
+    monkeypatch.setitem(bot.commands, "echo", echo)
+
+
+def test_replies_reach_their_chats(url):
+    async def test():
+        clients = [
+            FakeClient(i, DISCORD if i % 2 else TELEGRAM) for i in range(1, CLIENTS + 1)
+        ]
+        start = len(sent)
+        await asyncio.gather(
+            *(
+                client.say(client.private_chat, f"/echo {n}")
+                for client in clients
+                for n in range(COMMANDS)
+            )
+        )
+
+        await flush()
+        # replies of a command are joined into one message
+        replies = sent[start:]
+        assert len(replies) == CLIENTS * COMMANDS
+        for chat_id, text in replies:
+            for line in text.splitlines():
+                assert line.split()[0] == str(chat_id)
+
+    run_with_database(url, test)
+
+
+def test_dispatched_commands_keep_order(url):
+    async def test():
+        clients = [FakeClient(i) for i in range(1, CLIENTS + 1)]
+        start = len(sent)
+        for n in range(COMMANDS):
+            for client in clients:
+                await client.post(client.private_chat, f"/echo {n}")
+        await flush()
+
+        for client in clients:
+            replies = [
+                line.split()[1:]
+                for chat_id, text in sent[start:]
+                if chat_id == client.user.id
+                for line in text.splitlines()
+            ]
+            assert replies == [
+                [str(n), str(i)] for n in range(COMMANDS) for i in range(REPLIES)
+            ]
+
+    run_with_database(url, test)
+
+
+def test_commands_are_limited(url, monkeypatch):
+    running = 0
+    most = 0
+    full: asyncio.Event
+
+    async def busy(ctx: Context, text: str) -> None:
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        if running == bot.max_commands:
+            full.set()
+        # waits for the others, so that they all run at the same time
+        await asyncio.wait_for(full.wait(), WAIT_TIMEOUT)
+        running -= 1
+
+    monkeypatch.setitem(bot.commands, "busy", busy)
+
+    async def test():
+        nonlocal full
+        full = asyncio.Event()
+        clients = [FakeClient(i) for i in range(1, bot.max_commands * 2 + 1)]
+        await asyncio.gather(
+            *(client.say(client.private_chat, "/busy") for client in clients)
+        )
+
+    run_with_database(url, test)
+    assert most == bot.max_commands
+
+
+
+def test_commands_do_not_hold_up_messages(url, monkeypatch):
+    released: asyncio.Event
+
+    async def wait(ctx: Context, text: str) -> None:
+        await asyncio.wait_for(released.wait(), WAIT_TIMEOUT)
+
+    monkeypatch.setitem(bot.commands, "wait", wait)
+
+    async def test():
+        nonlocal released
+        released = asyncio.Event()
+        clients = [FakeClient(i) for i in range(1, bot.max_commands + 1)]
+        # every command that can run at once is waiting
+        for client in clients:
+            await client.post(client.private_chat, "/wait")
+        await clients[0].post(FakeChat(100), "public")
+        await ingestor.stop()
+
+        async with make_db(TELEGRAM) as db:
+            assert await db.count(Message, text="public") == 1
+        assert len(dispatcher) == len(clients)
+        released.set()
+        await flush()
+
+    run_with_database(url, test)
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,340 @@
+"""
+These tests run against every configured database backend
+"""
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.dialects import sqlite
+from RestlessFunnelBot import profiling
+from RestlessFunnelBot.common import handle_message
+from RestlessFunnelBot.database import make_db
+from RestlessFunnelBot.models import TELEGRAM, Chat, ConnectionChat, Message, User
+from RestlessFunnelBot.profiling import totals
+
+from fakes import FakeChat, FakeClient, FakeMessage, flush
+from utils import database_urls, do_test, run_with_database, setup
+
+setup()
+
+pytestmark = pytest.mark.parametrize("url", database_urls())
+
+# target ids that do not fit into 32 bits
+BIG_ID = -1001234567890
+
+
+async def count(model) -> int:
+    async with make_db(TELEGRAM) as db:
+        return await db.count(model)
+
+
+def test_messages_are_stored(url):
+    async def test():
+        client = FakeClient(1)
+        for i in range(10):
+            await client.say(FakeChat(i % 3), f"message {i}")
+        await flush()
+
+        assert await count(Message) == 10
+        assert await count(Chat) == 3
+        assert await count(User) == 1
+        assert await count(ConnectionChat) == 3
+
+    run_with_database(url, test)
+
+
+def test_chat_is_renamed_in_place(url):
+    async def test():
+        client = FakeClient(BIG_ID)
+        await client.say(FakeChat(BIG_ID, "old"), "first")
+        await client.say(FakeChat(BIG_ID, "new"), "second")
+        await flush()
+
+        async with make_db(TELEGRAM) as db:
+            (chat,) = await db.read_all(Chat)
+        assert chat.name == "new"
+        assert chat.target_id == BIG_ID
+
+    run_with_database(url, test)
+
+
+def test_redelivered_message_is_not_duplicated(url):
+    async def test():
+        client = FakeClient(1)
+        chat = FakeChat(1)
+        msg = FakeMessage(10**6, "text", chat, client.user)
+        for _ in range(3):
+            await client.say(chat, "filler")
+        await flush()
+
+        await handle_message(client.platform, msg, chat, client.user, False)
+        await handle_message(client.platform, msg, chat, client.user, False)
+        await flush()
+
+        assert await count(Message) == 4
+
+        # edited messages are redelivered with the new text
+        msg.text = "edited"
+        await handle_message(client.platform, msg, chat, client.user, False)
+        await flush()
+        async with make_db(TELEGRAM) as db:
+            stored = await db.read_one(Message, target_id=msg.id)
+        assert stored.text == "edited"
+        assert await count(Message) == 4
+
+    run_with_database(url, test)
+
+
+def test_batch_statements_do_not_grow(url):
+    statements = []
+
+    async def write(messages: int) -> None:
+        clients = [FakeClient(user) for user in range(1, messages + 1)]
+        chats = [FakeChat(-chat) for chat in range(1, messages + 1)]
+        totals.clear()
+        for client, chat in zip(clients, chats):
+            await client.say(chat, "message")
+        await flush()
+        statements.append(totals["ingest"].count)
+
+    async def test():
+        await write(2)
+        await write(30)
+        # the same senders, so only the messages are written
+        await write(2)
+        await write(30)
+
+    profiling.enable()
+    try:
+        run_with_database(url, test)
+    finally:
+        profiling.disable()
+    new_senders, known_senders = statements[:2], statements[2:]
+    # only the messages themselves are written
+    assert known_senders == [1, 1]
+    # a connection is created for every new user
+    assert new_senders[1] - new_senders[0] <= 30 - 2
+
+
+def test_link_and_unlink(url):
+    async def test():
+        first, second = FakeClient(1), FakeClient(2)
+        await first.say(FakeChat(10), "a")
+        await second.say(FakeChat(20), "b")
+        await flush()
+
+        reply = await first.command("/link")
+        key = reply.splitlines()[-1].split(" ", 1)[1]
+        assert await second.command(f"/link {key}") == "Successfully linked!"
+        assert "chat 10" in await second.command("/chats")
+        assert "chat 20" in await first.command("/chats")
+
+        assert "Successfully" in await first.command("/unlink all")
+        assert "chat 20" not in await first.command("/chats")
+        assert "chat 10" not in await second.command("/chats")
+
+    run_with_database(url, test)
+
+
+def test_public_message_right_after_link(url):
+    async def test():
+        first, second = FakeClient(1), FakeClient(2)
+        await first.say(FakeChat(10), "a")
+        await second.say(FakeChat(20), "b")
+        await flush()
+
+        reply = await first.command("/link")
+        key = reply.splitlines()[-1].split(" ", 1)[1]
+        await second.command(f"/link {key}")
+        # the ids of the second user are cached with its old connection
+        await second.say(FakeChat(30), "c")
+        await flush()
+        assert "chat 30" in await first.command("/chats")
+
+        await first.command("/unlink all")
+        await second.say(FakeChat(40), "d")
+        await flush()
+        assert "chat 40" not in await first.command("/chats")
+        assert "chat 40" in await second.command("/chats")
+
+    run_with_database(url, test)
+
+
+def test_list(url):
+    async def test():
+        client, other = FakeClient(1), FakeClient(2)
+        await client.say(FakeChat(1), "visible")
+        await other.say(FakeChat(2), "hidden")
+        await flush()
+
+        reply = await client.command("/list")
+        assert "visible" in reply
+        assert "hidden" not in reply
+
+    run_with_database(url, test)
+
+
+def test_list_pages(url):
+    async def test():
+        from RestlessFunnelBot.common import LIST_PAGE_SIZE
+
+        client = FakeClient(1)
+        for i in range(LIST_PAGE_SIZE + 2):
+            await client.say(FakeChat(1), f"message {i}")
+        await flush()
+
+        first = await client.command("/list")
+        assert first.startswith("List of all messages")
+        assert f"message {LIST_PAGE_SIZE - 1}\n" in first
+        assert f"message {LIST_PAGE_SIZE}\n" not in first
+        assert first.endswith("/list next")
+
+        second = await client.command("/list next")
+        assert f"{LIST_PAGE_SIZE + 1}) " in second
+        assert f"message {LIST_PAGE_SIZE + 1}\n" in second
+        assert "/list next" not in second
+        assert "nothing to continue" in await client.command("/list next")
+
+    run_with_database(url, test)
+
+
+def test_new_messages(url):
+    async def test():
+        from RestlessFunnelBot.common import LIST_PAGE_SIZE
+
+        client, other = FakeClient(1), FakeClient(2)
+        for i in range(3):
+            await client.say(FakeChat(1), f"old {i}")
+        await other.say(FakeChat(3), "hidden")
+        await flush()
+
+        first = await client.command("/new")
+        assert first.startswith("New messages")
+        assert "old 2" in first
+        assert "hidden" not in first
+        assert "There are no new messages" in await client.command("/new")
+
+        await client.say(FakeChat(2), "new in another chat")
+        await other.say(FakeChat(1), "new 1")
+        await flush()
+        second = await client.command("/new")
+        assert "old" not in second
+        assert second.index("new in another chat") < second.index("new 1")
+
+        for i in range(LIST_PAGE_SIZE + 1):
+            await other.say(FakeChat(1), f"many {i}")
+        await flush()
+        assert (await client.command("/new")).endswith("/new")
+        last = await client.command("/new")
+        assert f"many {LIST_PAGE_SIZE}" in last
+        assert "/new" not in last
+
+        # linked accounts keep what each of them read
+        reply = await client.command("/link")
+        key = reply.splitlines()[-1].split(" ", 1)[1]
+        await other.command(f"/link {key}")
+        linked = await other.command("/new")
+        assert "hidden" in linked
+        assert "many" not in linked
+        assert "There are no new messages" in await client.command("/new")
+
+    run_with_database(url, test)
+
+
+def test_new_messages_scan_the_index(url):
+    if url != "sqlite":
+        pytest.skip("the plan is checked on sqlite")
+
+    async def test():
+        from RestlessFunnelBot.common import unread_messages
+
+        selection = unread_messages(1, 10).compile(
+            dialect=sqlite.dialect(), compile_kwargs=dict(literal_binds=True)
+        )
+        async with make_db(TELEGRAM) as db:
+            plan = await db.execute(text(f"EXPLAIN QUERY PLAN {selection}"))
+            details = " ".join(row[-1] for row in plan)
+        assert "ix_message_chat_id_id (chat_id=? AND id>?)" in details
+
+    run_with_database(url, test)
+
+
+def test_aggregates(url):
+    async def test():
+        first, second = FakeClient(1), FakeClient(2)
+        for i in range(6):
+            await first.say(FakeChat(1), f"first {i}")
+        for i in range(3):
+            await second.say(FakeChat(2), f"second {i}")
+        await flush()
+
+        async with make_db(TELEGRAM) as db:
+            assert await db.count(Message) == 9
+            assert await db.count(Message, text="first 0") == 1
+            by_chat = await db.count_by(Message, Message.chat_id)
+            assert [amount for _, amount in by_chat] == [6, 3]
+            assert len(await db.count_by(Message, Message.chat_id, limit=1)) == 1
+            oldest, newest = await db.min_max(Message, Message.timestamp)
+            assert oldest <= newest
+
+    run_with_database(url, test)
+
+
+def test_stats(url):
+    async def test():
+        client = FakeClient(1)
+        for i in range(4):
+            # private chat of the client has id 1, so the rooms start from 10
+            await client.say(FakeChat(10 + i % 2, f"room {i % 2}"), f"message {i}")
+        await FakeClient(2).say(FakeChat(5), "hidden")
+        await flush()
+
+        reply = await client.command("/stats")
+        assert "Messages: 4" in reply
+        assert "room 0 - 2" in reply
+        assert "room 1 - 2" in reply
+        assert f"{TELEGRAM.value} 1 - 4" in reply
+        assert "chat 5" not in reply
+
+    run_with_database(url, test)
+
+
+def test_search(url):
+    async def test():
+        client, other = FakeClient(1), FakeClient(2)
+        await client.say(FakeChat(1), "the quick brown fox")
+        await client.say(FakeChat(1), "a lazy dog")
+        await client.say(FakeChat(1), 'quotes " and * are fine')
+        await other.say(FakeChat(2), "another quick fox")
+        await flush()
+
+        reply = await client.command("/search quick fox")
+        assert "the quick brown fox" in reply
+        assert "another" not in reply
+        assert "lazy" not in reply
+        assert "Nothing" in await client.command('/search " *')
+        assert "Nothing was found" in await client.command("/search cat")
+
+    run_with_database(url, test)
+
+
+def test_search_pages(url):
+    async def test():
+        from RestlessFunnelBot.common import SEARCH_PAGE_SIZE
+
+        client = FakeClient(1)
+        for i in range(SEARCH_PAGE_SIZE + 2):
+            await client.say(FakeChat(1), f"needle {i}")
+        await flush()
+
+        first = await client.command("/search needle")
+        assert f"{SEARCH_PAGE_SIZE})" in first
+        assert "/search next" in first
+        second = await client.command("/search next")
+        assert f"{SEARCH_PAGE_SIZE + 2})" in second
+        assert "Nothing more" in await client.command("/search next")
+
+    run_with_database(url, test)
+
+
+if __name__ == "__main__":
+    do_test(__file__)
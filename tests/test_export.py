@@ -0,0 +1,162 @@
+"""
+The export tests run against every configured database backend
+"""
+
+import csv
+import gzip
+import io
+import json
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+from RestlessFunnelBot import archive, options
+from RestlessFunnelBot.__metadata__ import BOT_NAME
+from RestlessFunnelBot.bot import bot
+from RestlessFunnelBot.common import handle_message
+from RestlessFunnelBot.export import FIELDS, parse_range
+from RestlessFunnelBot.outbox import RetryAfter
+
+import fakes
+from fakes import FakeChat, FakeClient, FakeMessage, FakeUser, flush
+from utils import database_urls, do_test, run_with_database, setup
+
+setup()
+
+with_databases = pytest.mark.parametrize("url", database_urls())
+
+
+@pytest.fixture(autouse=True)
+def archive_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(options, "ARCHIVE_PATH", str(tmp_path))
+    archive.segment_cache.clear()
+    fakes.files.clear()
+
+
+def temporary_files() -> int:
+    return len(list(Path(tempfile.gettempdir()).glob("tmp*.jsonl*")))
+
+
+async def say_at(client: FakeClient, chat: FakeChat, text: str, date: datetime):
+    msg = FakeMessage(next(fakes.message_ids), text, chat, client.user, date)
+    await handle_message(client.platform, msg, chat, client.user, False)
+
+
+@with_databases
+def test_export_jsonl(url):
+    async def test():
+        client = FakeClient(1)
+        for i in range(5):
+            await client.say(FakeChat(10), f"old {i}")
+        await flush()
+        await archive.compact(datetime.utcnow() + timedelta(seconds=1), 2)
+        for i in range(3):
+            await client.say(FakeChat(11), f"new {i}")
+        await FakeClient(2).say(FakeChat(12), "not accessible")
+        await flush()
+
+        files_before = temporary_files()
+        reply = await client.command("/export")
+        assert "Exported 8 messages" in reply
+        [(chat_id, name, data)] = fakes.files
+        assert chat_id == client.private_chat.id
+        assert name == f"{BOT_NAME}-export.jsonl"
+        rows = [json.loads(line) for line in data.decode().splitlines()]
+        # archived messages go first, in the order of writing
+        texts = [row["text"] for row in rows]
+        assert texts == [f"old {i}" for i in range(5)] + [f"new {i}" for i in range(3)]
+        assert set(rows[0]) == set(FIELDS)
+        assert rows[0]["author"] == 1
+        assert rows[0]["chat"].endswith("chat 10")
+        # the sent file is removed
+        assert temporary_files() == files_before
+
+    run_with_database(url, test)
+
+
+@with_databases
+def test_export_csv_range(url):
+    async def test():
+        client = FakeClient(1)
+        chat = FakeChat(10)
+        for day in range(1, 6):
+            # noon utc is the same day in moscow
+            await say_at(client, chat, f"day {day}", datetime(2024, 1, day, 12))
+        await flush()
+
+        reply = await client.command("/export csv.gz 2024-01-02..2024-01-04")
+        assert "Exported 3 messages" in reply
+        [(_, name, data)] = fakes.files
+        assert name.endswith(".csv.gz")
+        rows = list(csv.reader(io.StringIO(gzip.decompress(data).decode())))
+        assert tuple(rows[0]) == FIELDS
+        assert [row[-1] for row in rows[1:]] == ["day 2", "day 3", "day 4"]
+
+        await client.command("/export csv 2024-01-05")
+        assert fakes.files[-1][2].decode().count("day") == 1
+        reply = await client.command("/export 2024-02-01..")
+        assert "no messages" in reply
+        assert len(fakes.files) == 2
+
+    run_with_database(url, test)
+
+
+@with_databases
+def test_export_errors(url, monkeypatch):
+    async def test():
+        client = FakeClient(1)
+        await client.say(FakeChat(10), "a message that does not fit")
+        await flush()
+
+        reply = await client.command("/export xml")
+        assert "I don't understand 'xml'" in reply
+        assert "/export [jsonl|csv]" in reply
+
+        monkeypatch.setitem(bot.max_file_sizes, FakeMessage, 10)
+        files_before = temporary_files()
+        reply = await client.command("/export")
+        assert "try a shorter range or a compressed format" in reply
+        assert temporary_files() == files_before
+
+        monkeypatch.delitem(bot.max_file_sizes, FakeMessage)
+        assert "can't send files" in await client.command("/export")
+        assert fakes.files == []
+
+    run_with_database(url, test)
+
+
+@with_databases
+def test_file_is_removed_when_retries_run_out(url, monkeypatch):
+    async def send_file(msg: FakeMessage, path: Path, name: str) -> None:
+        raise RetryAfter(0)
+
+    monkeypatch.setitem(bot.file_functions, FakeMessage, send_file)
+    monkeypatch.setattr(bot.outbox, "retries", 1)
+
+    async def test():
+        client = FakeClient(1)
+        await client.say(FakeChat(10), "message")
+        await flush()
+
+        files_before = temporary_files()
+        await client.command("/export")
+        await bot.outbox.join()
+        assert temporary_files() == files_before
+
+    run_with_database(url, test)
+
+
+def test_parse_range():
+    parsed = parse_range("2024-01-02")
+    assert parsed is not None
+    start, end = parsed
+    # midnight in moscow is three hours earlier in utc
+    assert start == datetime(2024, 1, 1, 21)
+    assert end == datetime(2024, 1, 2, 21)
+    assert parse_range("..2024-01-02") == (None, end)
+    assert parse_range("2024-13-01") is None
+
+
+if __name__ == "__main__":
+    do_test(__file__)
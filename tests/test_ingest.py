@@ -0,0 +1,125 @@
+import asyncio
+from typing import List
+
+from RestlessFunnelBot.ingest import BatchQueue, KeyedLock, TaskSet
+
+from utils import do_test, setup
+
+setup()
+
+BATCH_SIZE = 4
+INTERVAL = 0.05
+WORKERS = 3
+
+
+def make_queue(batches: List[List[int]]) -> BatchQueue[int]:
+    async def handler(batch: List[int]) -> None:
+        batches.append(batch)
+
+    return BatchQueue(handler, BATCH_SIZE, INTERVAL)
+
+
+def test_flush_by_size():
+    batches: List[List[int]] = []
+
+    async def main():
+        queue = make_queue(batches)
+        async with queue.running():
+            for i in range(BATCH_SIZE * 2):
+                await queue.put(i)
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            assert batches == [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+    asyncio.run(main())
+
+
+def test_flush_by_time():
+    batches: List[List[int]] = []
+
+    async def main():
+        queue = make_queue(batches)
+        async with queue.running():
+            await queue.put(1)
+            await asyncio.sleep(INTERVAL / 2)
+            assert batches == []
+            await asyncio.sleep(INTERVAL)
+            assert batches == [[1]]
+
+    asyncio.run(main())
+
+
+def test_stop_flushes():
+    batches: List[List[int]] = []
+
+    async def main():
+        queue = make_queue(batches)
+        async with queue.running():
+            for i in range(BATCH_SIZE + 1):
+                await queue.put(i)
+        assert batches == [[0, 1, 2, 3], [4]]
+        assert not queue.is_running
+
+    asyncio.run(main())
+
+
+def test_failing_handler_keeps_working():
+    batches: List[List[int]] = []
+
+    async def handler(batch: List[int]) -> None:
+        if batch == [0]:
+            raise ValueError
+        batches.append(batch)
+
+    async def main():
+        queue: BatchQueue[int] = BatchQueue(handler, 1, INTERVAL)
+        async with queue.running():
+            await queue.put(0)
+            await queue.put(1)
+        assert batches == [[1]]
+
+    asyncio.run(main())
+
+
+def test_keyed_lock():
+    order: List[str] = []
+    locks: KeyedLock[int] = KeyedLock()
+
+    async def hold(key: int, name: str) -> None:
+        async with locks(key):
+            order.append(f"{name} start")
+            await asyncio.sleep(INTERVAL)
+            order.append(f"{name} end")
+
+    async def main():
+        await asyncio.gather(hold(1, "a"), hold(1, "b"), hold(2, "c"))
+        assert len(locks) == 0
+
+    asyncio.run(main())
+    # same keys wait for each other, different ones don't
+    assert order.index("a end") < order.index("b start")
+    assert order.index("c start") < order.index("a end")
+
+
+def test_task_set_limits_unfinished_jobs():
+    async def job() -> None:
+        await asyncio.sleep(INTERVAL)
+
+    async def main():
+        tasks = TaskSet(WORKERS)
+        async with tasks.running():
+            for _ in range(WORKERS):
+                await tasks.submit(job)
+            assert len(tasks) == WORKERS
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            # waits until one of them is done
+            await tasks.submit(job)
+            assert loop.time() - start >= INTERVAL * 0.9
+        assert not tasks.is_running
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    do_test(__file__)
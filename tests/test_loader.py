@@ -0,0 +1,81 @@
+import asyncio
+from typing import Dict, List
+
+import pytest
+from RestlessFunnelBot.loader import BatchLoader
+
+from utils import do_test, setup
+
+setup()
+
+TTL = 10
+SIZE = 100
+REFRESH = 0.05
+MISSING = -1
+
+
+def make_loader(calls: List[List[int]], **kwargs) -> BatchLoader[int, str]:
+    async def fetch(keys: List[int]) -> Dict[int, str]:
+        calls.append(sorted(keys))
+        await asyncio.sleep(0)
+        return {key: f"{key} v{len(calls)}" for key in keys if key != MISSING}
+
+    return BatchLoader(fetch, TTL, SIZE, **kwargs)
+
+
+def test_concurrent_loads_are_batched():
+    calls: List[List[int]] = []
+
+    async def main():
+        loader = make_loader(calls)
+        values = await asyncio.gather(*(loader.load(key) for key in (1, 2, 1, 3)))
+        assert values == ["1 v1", "2 v1", "1 v1", "3 v1"]
+        assert await loader.load(2) == "2 v1"
+
+    asyncio.run(main())
+    assert calls == [[1, 2, 3]]
+
+
+def test_max_batch():
+    calls: List[List[int]] = []
+
+    async def main():
+        loader = make_loader(calls, max_batch=2)
+        await asyncio.gather(*(loader.load(key) for key in range(5)))
+
+    asyncio.run(main())
+    assert calls == [[0, 1], [2, 3], [4]]
+
+
+def test_missing_key():
+    calls: List[List[int]] = []
+
+    async def main():
+        loader = make_loader(calls)
+        with pytest.raises(KeyError):
+            await loader.load(MISSING)
+
+    asyncio.run(main())
+
+
+def test_refresh():
+    calls: List[List[int]] = []
+
+    async def main():
+        loader = make_loader(calls, refresh_after=REFRESH)
+        assert await loader.load(1) == "1 v1"
+        await asyncio.sleep(REFRESH * 2)
+        # the old value is returned while the new one is loaded
+        assert await loader.load(1) == "1 v1"
+        await asyncio.sleep(REFRESH / 2)
+        assert await loader.load(1) == "1 v2"
+
+        loader.refresh(1)
+        assert await loader.load(1) == "1 v3"
+
+    asyncio.run(main())
+    assert len(calls) == 3
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,71 @@
+from typing import Any, Dict
+
+import pytest
+from RestlessFunnelBot.mappers import (
+    get_mapped_type,
+    map_model,
+    map_models,
+    model_mapper,
+)
+
+from utils import do_test, setup
+
+setup()
+
+
+class Base:
+    pass
+
+
+class Derived(Base):
+    pass
+
+
+class MoreDerived(Derived):
+    pass
+
+
+class Unknown:
+    pass
+
+
+class Model:
+    pass
+
+
+@model_mapper(Base, Model)
+def base_to_model(obj: Base) -> Dict[str, Any]:
+    return dict(mapper="base")
+
+
+def test_base_mapper_is_used_for_subclasses():
+    assert get_mapped_type(MoreDerived) is Base
+    assert map_model(MoreDerived()) == dict(mapper="base")
+
+
+def test_most_derived_mapper_wins():
+    assert get_mapped_type(MoreDerived) is Base
+
+    @model_mapper(Derived, Model)
+    def derived_to_model(obj: Derived) -> Dict[str, Any]:
+        return dict(mapper="derived")
+
+    # the resolved types are forgotten when a mapper is registered
+    assert get_mapped_type(MoreDerived) is Derived
+    assert map_model(MoreDerived()) == dict(mapper="derived")
+    assert map_model(Base()) == dict(mapper="base")
+
+
+def test_unknown_type():
+    assert get_mapped_type(Unknown) is None
+    with pytest.raises(KeyError):
+        map_model(Unknown())
+
+
+def test_map_models():
+    assert map_models([Base(), Base()]) == [dict(mapper="base")] * 2
+    assert map_models([]) == []
+
+
+if __name__ == "__main__":
+    do_test(__file__)
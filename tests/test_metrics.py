@@ -0,0 +1,83 @@
+import socket
+from timeit import timeit
+
+import aiohttp
+from RestlessFunnelBot import metrics
+from RestlessFunnelBot.metrics import Counter, Histogram, render, stage
+
+from fakes import FakeChat, FakeClient, flush
+from utils import do_test, run_with_database, setup
+
+setup()
+
+# stage() is on the hot path, it has to be cheap when nothing is measured
+DISABLED_BUDGET_NS = 1000
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_histogram():
+    histogram = Histogram("test_seconds", "Test", ("name",), buckets=(0.1, 1))
+    histogram.observe(0.05, "a")
+    histogram.observe(0.5, "a")
+    histogram.observe(5, "a")
+    assert histogram.render().splitlines() == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{name="a",le="0.1"} 1',
+        'test_seconds_bucket{name="a",le="1"} 2',
+        'test_seconds_bucket{name="a",le="+Inf"} 3',
+        'test_seconds_sum{name="a"} 5.55',
+        'test_seconds_count{name="a"} 3',
+    ]
+
+
+def test_disabled_metrics_are_not_counted():
+    counter = Counter("test_total", "Test")
+    counter.inc()
+    with stage("test"):
+        pass
+    assert counter.values == {}
+    assert 'stage="test"' not in render()
+
+    per_call = timeit(lambda: stage("test"), number=10_000) / 10_000
+    assert per_call * 10**9 < DISABLED_BUDGET_NS
+
+
+def test_endpoint():
+    port = free_port()
+    pages = []
+
+    async def test():
+        client = FakeClient(1)
+        async with metrics.running("127.0.0.1", port):
+            await client.say(FakeChat(-1), "public")
+            await client.command("/chats")
+            await client.post(FakeChat(-1), "dispatched")
+            await client.post(client.private_chat, "/chats")
+            await flush()
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                    assert response.status == 200
+                    pages.append(await response.text())
+
+    run_with_database("sqlite", test)
+    (text,) = pages
+    for name in ("map", "make_message", "command", "write_batch", "send", "commit"):
+        assert f'restless_stage_seconds_count{{stage="{name}"}}' in text
+    assert 'restless_messages_total{platform="telegram",kind="public"} 2' in text
+    assert 'restless_commands_total{command="chats"} 2' in text
+    assert 'restless_sent_total{platform="telegram"} 2' in text
+    for kind in ("public", "private"):
+        labels = f'platform="telegram",kind="{kind}"'
+        assert f"restless_dispatch_wait_seconds_count{{{labels}}} 1" in text
+    assert 'restless_ttldict_size{dict="auth_ids"} ' in text
+    assert 'restless_identity_cache{table="users",kind="misses"} ' in text
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,213 @@
+"""
+Databases made by the first version of the bot are brought up to date
+"""
+
+import asyncio
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from sqlalchemy import delete, inspect
+from RestlessFunnelBot import database, options
+from RestlessFunnelBot.database import make_db
+from RestlessFunnelBot.models import (
+    TELEGRAM,
+    Chat,
+    ConnectionChat,
+    Message,
+    User,
+    UserChat,
+)
+from RestlessFunnelBot.search import search_messages
+
+from utils import do_test, setup
+
+setup()
+
+BASELINE_SCHEMA = """
+CREATE TABLE chat (
+    id INTEGER NOT NULL,
+    target_id INTEGER NOT NULL,
+    platform VARCHAR(8) NOT NULL,
+    name VARCHAR NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE TABLE connecteduser (
+    chats JSON,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE TABLE user (
+    chats JSON,
+    id INTEGER NOT NULL,
+    target_id INTEGER NOT NULL,
+    platform VARCHAR(8) NOT NULL,
+    connection_id INTEGER NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY(connection_id) REFERENCES connecteduser (id)
+);
+CREATE TABLE message (
+    id INTEGER NOT NULL,
+    target_id INTEGER NOT NULL,
+    platform VARCHAR(8) NOT NULL,
+    text VARCHAR NOT NULL,
+    timestamp DATETIME NOT NULL,
+    author_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY(author_id) REFERENCES user (id),
+    FOREIGN KEY(chat_id) REFERENCES chat (id)
+);
+"""
+
+TIMESTAMP = "2022-10-20 10:00:00.000000"
+
+
+def run_migrated(
+    path: Path, rows: str, test: Callable[[], Awaitable[None]], monkeypatch
+) -> None:
+    """
+    Starts the bot on a database with the schema and the rows of the first version.
+    """
+
+    with sqlite3.connect(path) as conn:
+        conn.executescript(BASELINE_SCHEMA + rows)
+    conn.close()
+
+    # the database is kept, not recreated
+    monkeypatch.setattr(options, "DEV_MODE", False)
+
+    async def main() -> None:
+        database.setup_engines(database.sqlite_url(path))
+        try:
+            await database.db_startup()
+            await test()
+        finally:
+            await database.db_shutdown()
+
+    asyncio.run(main())
+
+
+def test_duplicates_are_merged(tmp_path, monkeypatch):
+    # the chat was renamed and the user and the message were stored twice
+    rows = f"""
+    INSERT INTO connecteduser VALUES ('[1]', 1), ('[2]', 2);
+    INSERT INTO chat VALUES (1, -100, 'TELEGRAM', 'Old'), (2, -100, 'TELEGRAM', 'New');
+    INSERT INTO user VALUES ('[1]', 1, 5, 'TELEGRAM', 1), ('[2]', 2, 5, 'TELEGRAM', 2);
+    INSERT INTO message VALUES
+        (1, 7, 'TELEGRAM', 'hello', '{TIMESTAMP}', 1, 1),
+        (2, 7, 'TELEGRAM', 'hello again', '{TIMESTAMP}', 2, 2),
+        (3, 8, 'TELEGRAM', 'other', '{TIMESTAMP}', 2, 2);
+    """
+
+    async def test():
+        async with make_db(TELEGRAM) as db:
+            chats = await db.read_all(Chat)
+            users = await db.read_all(User)
+            messages = await db.read_all(Message)
+            user_chats = await db.read_all(UserChat)
+            connection_chats = await db.read_all(ConnectionChat, connection_id=1)
+
+            def indexes(conn):
+                return {
+                    index["name"]
+                    for table in ("chat", "user", "message")
+                    for index in inspect(conn).get_indexes(table)
+                }
+
+            names = await (await db.connection()).run_sync(indexes)
+
+        assert [(chat.id, chat.name) for chat in chats] == [(1, "New")]
+        assert [user.id for user in users] == [1]
+        stored = [(msg.id, msg.text, msg.chat_id, msg.author_id) for msg in messages]
+        assert sorted(stored) == [
+            (1, "hello again", 1, 1),
+            (3, "other", 1, 1),
+        ]
+        assert [(row.user_id, row.chat_id) for row in user_chats] == [(1, 1)]
+        assert [row.chat_id for row in connection_chats] == [1]
+        assert {
+            "ix_chat_natural_key",
+            "ix_user_natural_key",
+            "ix_message_natural_key",
+        } <= names
+
+    run_migrated(tmp_path / "sqlite.db", rows, test, monkeypatch)
+
+
+def test_chat_lists_are_moved(tmp_path, monkeypatch):
+    # memberships used to be json lists in the rows of users and connections
+    rows = """
+    INSERT INTO connecteduser VALUES ('[1, 2, 3]', 1), (NULL, 2);
+    INSERT INTO chat VALUES
+        (1, -1, 'TELEGRAM', 'a'), (2, -2, 'TELEGRAM', 'b'), (3, -3, 'TELEGRAM', 'c');
+    INSERT INTO user VALUES
+        ('[1, 2]', 1, 5, 'TELEGRAM', 1),
+        ('[3]', 2, 6, 'TELEGRAM', 1),
+        ('[]', 3, 7, 'TELEGRAM', 2);
+    """
+
+    async def test():
+        async with make_db(TELEGRAM) as db:
+            user_chats = await db.read_all(UserChat)
+            connection_chats = await db.read_all(ConnectionChat)
+
+            def columns(conn):
+                inspector = inspect(conn)
+                return {
+                    table: {column["name"] for column in inspector.get_columns(table)}
+                    for table in ("user", "connecteduser")
+                }
+
+            tables = await (await db.connection()).run_sync(columns)
+
+        assert sorted((row.user_id, row.chat_id) for row in user_chats) == [
+            (1, 1),
+            (1, 2),
+            (2, 3),
+        ]
+        assert sorted((row.connection_id, row.chat_id) for row in connection_chats) == [
+            (1, 1),
+            (1, 2),
+            (1, 3),
+        ]
+        assert "chats" not in tables["user"]
+        assert "chats" not in tables["connecteduser"]
+
+    run_migrated(tmp_path / "sqlite.db", rows, test, monkeypatch)
+
+
+
+def test_message_ids_are_not_reused(tmp_path, monkeypatch):
+    rows = f"""
+    INSERT INTO connecteduser VALUES ('[1]', 1);
+    INSERT INTO chat VALUES (1, -1, 'TELEGRAM', 'a');
+    INSERT INTO user VALUES ('[1]', 1, 5, 'TELEGRAM', 1);
+    INSERT INTO message VALUES
+        (1, 7, 'TELEGRAM', 'first', '{TIMESTAMP}', 1, 1),
+        (2, 8, 'TELEGRAM', 'newest', '{TIMESTAMP}', 1, 1);
+    """
+
+    async def test():
+        async with make_db(TELEGRAM) as db:
+            found = await db.fetch(search_messages(db.dialect, "first"))
+            assert [msg.id for msg in found.all()] == [1]
+            await db.execute(delete(Message).filter_by(id=2))
+            msg = db.create(
+                Message,
+                target_id=9,
+                platform=TELEGRAM,
+                text="new",
+                timestamp=datetime.utcnow(),
+                author_id=1,
+                chat_id=1,
+            )
+            await db.flush()
+            assert msg.id == 3
+
+    run_migrated(tmp_path / "sqlite.db", rows, test, monkeypatch)
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -0,0 +1,120 @@
+import asyncio
+from time import monotonic
+from typing import Any, List, Tuple, cast
+
+import pytest
+from RestlessFunnelBot.bot import Context, bot
+from RestlessFunnelBot.models import Message
+from RestlessFunnelBot.outbox import Outbox, RateLimit, RetryAfter, TokenBucket
+
+from fakes import FakeChat, FakeMessage, FakeUser, sent
+from utils import do_test, setup
+
+setup()
+
+RATE = 20
+BURST = 2
+BACKOFF = 0.01
+
+
+def test_bucket_waits_after_burst():
+    bucket = TokenBucket(RateLimit(RATE, BURST))
+    assert [bucket.reserve() for _ in range(BURST)] == [0, 0]
+    # the next tokens are reserved one after another
+    assert bucket.reserve() == pytest.approx(1 / RATE, rel=0.1)
+    assert bucket.reserve() == pytest.approx(2 / RATE, rel=0.1)
+
+
+def test_chat_limit():
+    times: List[Tuple[int, float]] = []
+
+    async def send(chat: int, text: str, mention: bool, raw: bool) -> None:
+        times.append((chat, monotonic()))
+
+    first, other = 1, 2
+
+    async def main():
+        outbox = Outbox(1)
+        outbox.limit(int, "test", chat_limit=RateLimit(RATE, 1))
+        async with outbox.running():
+            start = monotonic()
+            for chat in (first, first, first, other):
+                await outbox.put(chat, send, chat, "text")
+            await outbox.join()
+        return start
+
+    start = asyncio.run(main())
+    first_times = [time - start for chat, time in times if chat == first]
+    other_times = [time - start for chat, time in times if chat == other]
+    # the other chat does not wait for the first one
+    assert other_times[0] < 1 / RATE
+    assert first_times[2] >= 2 / RATE * 0.9
+
+
+def test_retry_after():
+    attempts: List[float] = []
+
+    async def send(target: Any, text: str, mention: bool, raw: bool) -> None:
+        attempts.append(monotonic())
+        if len(attempts) < 3:
+            raise RetryAfter(BACKOFF if len(attempts) == 1 else None)
+
+    async def main():
+        outbox = Outbox(1, backoff=BACKOFF)
+        async with outbox.running():
+            await outbox.put(1, send, 1, "text")
+
+    asyncio.run(main())
+    assert len(attempts) == 3
+    # told delay, then backoff * 2 ** 1
+    assert attempts[2] - attempts[1] >= BACKOFF * 2 * 0.9
+
+
+def test_retry_does_not_hold_up_other_chats():
+    times: List[Tuple[int, float]] = []
+
+    async def send(chat: int, text: str, mention: bool, raw: bool) -> None:
+        times.append((chat, monotonic()))
+        if len(times) == 1:
+            raise RetryAfter(BACKOFF * 10)
+
+    async def main():
+        outbox = Outbox(1, retries=1)
+        async with outbox.running():
+            start = monotonic()
+            await outbox.put(1, send, 1, "retried")
+            await outbox.put(1, send, 1, "after")
+            await outbox.put(2, send, 2, "other")
+            await asyncio.sleep(BACKOFF * 5)
+            assert outbox.depth == 2
+        return start
+
+    start = asyncio.run(main())
+    # the other chat is sent to while the first one waits for the retry
+    assert [chat for chat, _ in times] == [1, 2, 1, 1]
+    assert times[1][1] - start < BACKOFF * 5
+
+
+def test_sends_are_joined():
+    chat = FakeChat(1, private=True)
+    target = FakeMessage(1, "/start", chat, FakeUser(1))
+    msg = cast(Message, Message(chat_id=1))
+
+    async def main():
+        start = len(sent)
+        async with bot.outbox.running():
+            ctx = Context(bot, cast(Any, None), msg, target)
+            await ctx.send("a")
+            await ctx.send("b")
+            await ctx.send("code", raw=True)
+            await ctx.send("c" * ctx.max_length)
+            await ctx.send("d")
+            await ctx.flush()
+        return sent[start:]
+
+    replies = asyncio.run(main())
+    assert [text for _, text in replies] == ["a\nb", "code", "c" * 2000, "d"]
+
+
+if __name__ == "__main__":
+    do_test(__file__)
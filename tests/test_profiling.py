@@ -0,0 +1,53 @@
+import logging
+
+from RestlessFunnelBot import options, profiling
+from RestlessFunnelBot.profiling import profile, totals
+
+from fakes import FakeChat, FakeClient, flush
+from utils import do_test, run_with_database, setup
+
+setup()
+
+
+def run_commands() -> None:
+    async def test():
+        client = FakeClient(1)
+        await client.say(FakeChat(-1), "public")
+        await client.command("/chats")
+        await flush()
+
+    totals.clear()
+    profiling.enable()
+    try:
+        run_with_database("sqlite", test)
+    finally:
+        profiling.disable()
+
+
+def test_disabled_profile_is_empty():
+    with profile("test") as stats:
+        assert stats is None
+
+
+def test_messages_are_accounted():
+    run_commands()
+    assert set(totals) == {"/chats", "ingest"}
+    assert totals["/chats"].messages == 1
+    assert totals["ingest"].messages == 1
+    # the command looks up the sender and its chats at least
+    assert totals["/chats"].count >= 2
+    assert "/chats: " in profiling.report()
+
+
+def test_budget_warning(caplog, monkeypatch):
+    monkeypatch.setattr(options, "QUERY_BUDGET", 1)
+    with caplog.at_level(logging.WARNING, profiling.__name__):
+        run_commands()
+    warnings = [record.getMessage() for record in caplog.records]
+    prefix = "Query budget exceeded by /chats"
+    assert any(message.startswith(prefix) for message in warnings)
+    assert totals["/chats"].over_budget == 1
+
+
+if __name__ == "__main__":
+    do_test(__file__)
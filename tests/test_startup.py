@@ -0,0 +1,59 @@
+import subprocess
+import sys
+from typing import List
+
+from utils import do_test, setup
+
+setup()
+
+# seconds, measured in a fresh interpreter, so the sdks are not cached,
+# python -X importtime -c "import RestlessFunnelBot" shows what takes them
+IMPORT_BUDGET = 1.5
+SDKS = ("aiogram", "discord", "vkbottle")
+
+MEASURE = f"""
+import sys
+from time import perf_counter
+started = perf_counter()
+import RestlessFunnelBot
+print(perf_counter() - started)
+print(",".join(name for name in {SDKS!r} if name in sys.modules))
+"""
+
+LOAD_TELEGRAM = f"""
+import sys
+from types import ModuleType
+try:
+    from RestlessFunnelBot import bot_secrets
+except ImportError:
+    # the secrets are not in the repository, a token of the right form is enough
+    bot_secrets = ModuleType("RestlessFunnelBot.bot_secrets")
+    bot_secrets.TELEGRAM_API_TOKEN = "123456:" + "A" * 35
+    sys.modules[bot_secrets.__name__] = bot_secrets
+from RestlessFunnelBot.models import Platform
+from RestlessFunnelBot.run import load_platforms
+load_platforms([Platform.TELEGRAM])
+print(",".join(name for name in {SDKS!r} if name in sys.modules))
+"""
+
+
+def run_python(code: str) -> List[str]:
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return result.stdout.splitlines()
+
+
+def test_import_budget():
+    seconds, sdks = run_python(MEASURE)
+    assert sdks == ""
+    assert float(seconds) < IMPORT_BUDGET
+
+
+def test_only_selected_platforms_are_imported():
+    (sdks,) = run_python(LOAD_TELEGRAM)
+    assert sdks == "aiogram"
+
+
+if __name__ == "__main__":
+    do_test(__file__)
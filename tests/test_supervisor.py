@@ -0,0 +1,47 @@
+import sqlite3
+from time import monotonic, sleep
+
+from RestlessFunnelBot import database, options
+from RestlessFunnelBot.supervisor import Supervisor
+
+from fake_platform import REPLIES_VARIABLE
+from utils import do_test, setup
+
+setup()
+
+# seconds, the processes import the package and create the database
+TIMEOUT = 30
+
+
+def test_supervisor(tmp_path, monkeypatch):
+    replies = tmp_path / "replies.txt"
+    path = tmp_path / "sqlite.db"
+    monkeypatch.setenv(REPLIES_VARIABLE, str(replies))
+    monkeypatch.setattr(options, "DATABASE_URL", database.sqlite_url(path))
+    monkeypatch.setattr(options, "RESTART_DELAY", 0.1)
+
+    supervisor = Supervisor({"fake": ("fake_platform", {})})
+    supervisor.start()
+    try:
+        deadline = monotonic() + TIMEOUT
+        while not replies.exists() and monotonic() < deadline:
+            sleep(0.1)
+            supervisor.check()
+    finally:
+        supervisor.stop()
+
+    platform = supervisor.platforms["fake"]
+    assert platform.crashes == 1
+    assert platform.process is not None and platform.process.exitcode == 0
+    assert supervisor.writer.process is not None
+    assert supervisor.writer.process.exitcode == 0
+    # the reply of the command went through the writer
+    assert "chat" in replies.read_text().lower()
+    with sqlite3.connect(path) as conn:
+        # the public message was written by the writer before it exited,
+        # private ones are not stored
+        assert conn.execute("SELECT text FROM message").fetchall() == [("public",)]
+
+
+if __name__ == "__main__":
+    do_test(__file__)
@@ -1,2 +1,142 @@
-# https://github.com/aiogram/aiogram/issues/378
-# https://github.com/aiogram/aiogram/tree/master/tests
+"""
+Webhook receiver of telegram
+---
+Recorded updates are posted to the local server, the latencies
+against long polling are measured in bench_telegram.py.
+"""
+
+import asyncio
+import socket
+import sys
+from time import perf_counter
+from types import ModuleType
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+import pytest
+
+from utils import do_test, setup
+
+setup()
+
+SECRET = "test-secret"
+PATH = "/telegram"
+TOKEN = "123456:" + "A" * 35
+
+try:
+    from RestlessFunnelBot import bot_secrets  # noqa: F401
+except ImportError:
+    # the secrets are not in the repository, a token of the right form is enough
+    fake_secrets = ModuleType("RestlessFunnelBot.bot_secrets")
+    setattr(fake_secrets, "TELEGRAM_API_TOKEN", TOKEN)
+    sys.modules[fake_secrets.__name__] = fake_secrets
+
+from RestlessFunnelBot import telegram_bot  # noqa: E402
+
+
+def recorded_update(update_id: int) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "from": {"id": 1, "is_bot": False, "first_name": "Test"},
+            "chat": {"id": -1001234567890, "title": "Chat", "type": "supergroup"},
+            "date": 1700000000,
+            "text": f"message {update_id}",
+        },
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Received:
+    """
+    Stands for the pipeline, records when the messages came.
+    """
+
+    def __init__(self) -> None:
+        # when set, the messages wait till this many of them have started
+        self.together = 0
+        self.all_started: Optional[asyncio.Event] = None
+        self.log: List[Tuple[str, int]] = []
+        self.times: Dict[int, float] = {}
+        self.events: Dict[int, asyncio.Event] = {}
+
+    def event(self, id: int) -> asyncio.Event:
+        return self.events.setdefault(id, asyncio.Event())
+
+    async def __call__(self, platform, in_msg, chat, author, is_private) -> None:
+        id = in_msg.message_id
+        self.log.append(("start", id))
+        if self.together:
+            if self.all_started is None:
+                self.all_started = asyncio.Event()
+            if len(self.log) == self.together:
+                self.all_started.set()
+            # handled one by one they would never all start, the first one
+            # gives up and ends before the next one starts
+            try:
+                await asyncio.wait_for(self.all_started.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+        self.log.append(("end", id))
+        self.times[id] = perf_counter()
+        self.event(id).set()
+
+
+@pytest.fixture
+def received(monkeypatch) -> Received:
+    result = Received()
+    monkeypatch.setattr(telegram_bot, "dispatch_message", result)
+    return result
+
+
+async def post(session: aiohttp.ClientSession, url: str, update_id: int) -> int:
+    headers = {telegram_bot.SECRET_HEADER: SECRET}
+    async with session.post(url, json=recorded_update(update_id), headers=headers) as r:
+        return r.status
+
+
+def test_wrong_secret_is_rejected(received):
+    async def test():
+        port = free_port()
+        url = f"http://127.0.0.1:{port}{PATH}"
+        async with telegram_bot.webhook_server("127.0.0.1", port, PATH, SECRET):
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url, json=recorded_update(1)) as response:
+                    assert response.status == 403
+                headers = {telegram_bot.SECRET_HEADER: "wrong"}
+                async with session.post(
+                    url, json=recorded_update(2), headers=headers
+                ) as response:
+                    assert response.status == 403
+        assert received.times == {}
+
+    asyncio.run(test())
+
+
+def test_updates_are_handled_concurrently(received):
+    ids = range(1, 11)
+    received.together = len(ids)
+
+    async def test():
+        port = free_port()
+        url = f"http://127.0.0.1:{port}{PATH}"
+        async with telegram_bot.webhook_server("127.0.0.1", port, PATH, SECRET):
+            async with aiohttp.ClientSession() as session:
+                statuses = await asyncio.gather(*(post(session, url, id) for id in ids))
+        assert statuses == [200] * len(ids)
+
+    asyncio.run(test())
+    assert sorted(id for event, id in received.log if event == "end") == list(ids)
+    # every update has started before the first one ended
+    events = [event for event, _ in received.log]
+    assert events.index("end") == len(ids)
+
+
+if __name__ == "__main__":
+    do_test(__file__)
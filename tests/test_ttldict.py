@@ -1,7 +1,8 @@
+import asyncio
 from time import sleep
 
 import pytest
-from RestlessFunnelBot.ttldict import TTLDict
+from RestlessFunnelBot.ttldict import Sweeper, TTLDict
 
 from utils import do_test, setup
 
@@ -149,5 +150,55 @@ def test_pop():
     assert not contains(data, KEY)
 
 
+def test_expire_after_reset():
+    data: TTLDict[int, int] = TTLDict(TTL)
+
+    data[KEY] = VALUE
+    sleep(S_TTL)
+    data[KEY + 1] = VALUE
+    sleep(S_TTL)
+    # the first key lives longer now, but it is still first in the dict
+    data[KEY] = VALUE
+    sleep(TTL - S_TTL)
+    assert data.expire() == [VALUE]
+    assert contains(data, KEY)
+    assert not contains(data, KEY + 1)
+
+
+def test_expire_count():
+    data: TTLDict[int, int] = TTLDict(S_TTL, 2)
+
+    for i in range(5):
+        data[i] = i
+    sleep(B_TTL)
+    assert data.expire() == [0, 1]
+    assert data.expire() == [2, 3]
+    assert data.expire() == [4]
+    assert data.expire() == []
+
+
+def test_heap_is_compacted():
+    data: TTLDict[int, int] = TTLDict(TTL)
+
+    for i in range(1000):
+        data[KEY] = i
+    assert len(data._heap) <= 64
+    assert data[KEY] == 999
+
+
+def test_sweeper():
+    data: TTLDict[int, int] = TTLDict(S_TTL)
+
+    async def main():
+        data[KEY] = VALUE
+        async with Sweeper(S_TTL / 2, data.expire).running() as sweeper:
+            await asyncio.sleep(B_TTL)
+            assert sweeper.is_running
+        assert not sweeper.is_running
+
+    asyncio.run(main())
+    assert not contains(data, KEY)
+
+
 if __name__ == "__main__":
     do_test(__file__)